@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    ChunkIndex.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import os
+import re
+import zlib
+import struct
+import hashlib
+import tempfile
+from helpers import initLogs
+from GateSQLite import GateSQLite
+from ImageSchema import SCHEMA_VERSION, getSchemaVersion
+
+
+class Chunker:
+    """Splits a stream of data into content-defined chunks (boundaries depend on the data around them,
+    so an insertion or a deletion changes the chunks near it only, the rest of the file gives the same chunks).
+    Candidate boundaries are anchor bytes found by regex (C speed, no python loop per byte): line ends,
+    it is ~1/256 of bytes for binary data. The chunk is cut after the anchor if CRC32 of the preceding 'window' bytes
+    has zero bits of 'mask' (so a text with long lines, a dump with one line of rows for example, is cut by maxSize).
+    Chunk size is between minSize and maxSize (long runs without anchors, zeros for example, are cut by maxSize).
+    The data is hashed by update() as it is read, finished chunks are kept in 'chunks' or passed to onChunk
+    (memory usage does not depend on the file size with onChunk, see ChunkSpool).
+
+    Attributes:
+       minSize: Min chunk size (except the last chunk).
+       maxSize: Max chunk size.
+       mask: CRC32 mask for boundaries (0xFF gives chunks of ~64-96KB for binary data and text with short lines).
+       window: Number of bytes before the anchor to check.
+       onChunk: Function to call with every finished chunk (file offset, size, MD5 as binary string), or None.
+       chunks: List of finished chunks (file offset, size, MD5 as binary string), empty if onChunk is set.
+    """
+
+    ANCHORS = re.compile(r'\n')
+
+    def __init__(self, minSize=16 * 1024, maxSize=512 * 1024, mask=0xFF, window=48, onChunk=None):
+        """Inits Chunker object with chunk size limits.
+        """
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.mask = mask
+        self.window = window
+        self.onChunk = onChunk
+        self.chunks = []
+
+        self.offset = 0  # file offset of the current chunk
+        self.size = 0  # bytes of the current chunk
+        self.sum = hashlib.md5()
+        self.tail = ''  # the last 'window' bytes of data before the current update()
+
+    def update(self, data):
+        """Adds data (str, bytearray or buffer) to the stream.
+        """
+        n = len(data)
+        start = 0
+        while start < n:
+            # the first allowed boundary (min size) and the forced one (max size)
+            lo = start + max(self.minSize - self.size - 1, 0)
+            hi = start + self.maxSize - self.size
+            cut = -1
+            if lo < n:
+                for m in self.ANCHORS.finditer(data, lo, min(hi, n)):
+                    i = m.start() + 1
+                    if i >= self.window:
+                        win = buffer(data, i - self.window, self.window)
+                    else:
+                        win = self.tail[len(self.tail) - (self.window - i):] + str(buffer(data, 0, i))
+                    if not zlib.crc32(win) & self.mask:
+                        cut = i
+                        break
+            if cut < 0 and hi <= n:
+                cut = hi
+            if cut < 0:
+                self.sum.update(buffer(data, start))
+                self.size += n - start
+                break
+            self.sum.update(buffer(data, start, cut - start))
+            self.size += cut - start
+            self.endChunk()
+            start = cut
+
+        self.tail = (self.tail + str(buffer(data, max(n - self.window, 0))))[-self.window:]
+
+    def finish(self):
+        """Finishes the stream (the last chunk is added).
+
+        Returns:
+            List of chunks (file offset, size, MD5 as binary string), empty if onChunk is set.
+        """
+        if self.size:
+            self.endChunk()
+        return self.chunks
+
+    def endChunk(self):
+        """For internal usage.
+        """
+        if self.onChunk is not None:
+            self.onChunk(self.offset, self.size, self.sum.digest())
+        else:
+            self.chunks.append((self.offset, self.size, self.sum.digest()))
+        self.offset += self.size
+        self.size = 0
+        self.sum = hashlib.md5()
+
+
+class ChunkSpool:
+    """Chunks of one file with bounded memory (Chunker.onChunk = spool.add): the first maxRows chunks are kept
+    in memory, the rest are spilled to a temporary file (32 bytes per chunk), so a TB-sized file does not need
+    GBs of memory before its chunks are saved. The chunks are read back in order by iteration (it can be repeated).
+    The temporary file is deleted by close() or when the spool is dropped.
+
+    Attributes:
+       maxRows: Max number of chunks in memory.
+       count: Number of chunks.
+    """
+
+    ROW = struct.Struct('=QQ16s')
+
+    def __init__(self, maxRows=4096):
+        """Inits empty ChunkSpool object.
+        """
+        self.maxRows = maxRows
+        self.count = 0
+        self.rows = []
+        self.spill = None  # temporary file with chunks before 'rows'
+
+    def add(self, offset, size, digest):
+        """Adds the chunk (file offset, size, MD5 as binary string).
+        """
+        self.rows.append((offset, size, digest))
+        self.count += 1
+        if len(self.rows) >= self.maxRows:
+            if self.spill is None:
+                self.spill = tempfile.TemporaryFile(prefix='chunks-')
+            self.spill.seek(0, os.SEEK_END)
+            self.spill.write(''.join([self.ROW.pack(*row) for row in self.rows]))
+            self.rows = []
+
+    def __iter__(self):
+        """Yields chunks (file offset, size, MD5 as binary string) in order.
+        """
+        if self.spill is not None:
+            self.spill.seek(0)
+            while True:
+                data = self.spill.read(self.ROW.size * self.maxRows)
+                if not data:
+                    break
+                for pos in xrange(0, len(data), self.ROW.size):
+                    yield self.ROW.unpack_from(data, pos)
+        for row in self.rows:
+            yield row
+
+    def __len__(self):
+        """Gets number of chunks.
+        """
+        return self.count
+
+    def close(self):
+        """Deletes the temporary file.
+        """
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.rows = []
+
+
+class ChunkOverlap:
+    """Reports shared bytes of files by chunks of 'FileChunks' table (see FileSystemImage.chunkMinFileSize).
+    Files which share most of their data (VM images, database dumps, edited videos) have different MD5
+    checksums, but the most of their chunks are the same.
+    Shared bytes are counted by distinct chunks of the file (repeated chunks are counted once).
+
+    Attributes:
+       dbgate: GateSQLite connection to the image.
+    """
+
+    def __init__(self, dbname):
+        """Inits ChunkOverlap object with database file name of the image.
+        """
+        self.dbgate = GateSQLite(dbname)
+
+    def open(self):
+        """Opens the image.
+
+        Returns:
+            True or False.
+        """
+        if not os.path.exists(self.dbgate.dbname):
+            logging.error('image "%s" not found' % self.dbgate.dbname)
+            return False
+        if self.dbgate.con is None and not self.dbgate.open():
+            return False
+        version = getSchemaVersion(self.dbgate)
+        if version != SCHEMA_VERSION:
+            logging.error('image "%s" has schema version %s, use ImageSchema.migrateImage()' %
+                          (self.dbgate.dbname, str(version)))
+            return False
+        return True
+
+    def findOverlaps(self, n=20, minBytes=1):
+        """Finds pairs of files of the image with shared chunks.
+
+        Args:
+            n: Max number of pairs (with the most shared bytes).
+            minBytes: Min shared bytes of a pair.
+
+        Returns:
+            List of (path + fname, path + fname, shared bytes, fsize, fsize) or None if failed.
+        """
+        if not self.open():
+            return None
+        return self.dbgate.query(
+            "with fc as (select distinct fileId, hash, size from FileChunks where hash in"
+            "  (select hash from FileChunks group by hash having count(distinct fileId) > 1))"
+            " select fa.path || ffa.fname, fb.path || ffb.fname, sum(a.size) as shared, ffa.fsize, ffb.fsize"
+            " from fc a join fc b on a.hash = b.hash and a.fileId < b.fileId"
+            " join Files ffa on ffa.fileId = a.fileId join Folders fa on fa.foId = ffa.foId"
+            " join Files ffb on ffb.fileId = b.fileId join Folders fb on fb.foId = ffb.foId"
+            " group by a.fileId, b.fileId having shared >= %i order by shared desc limit %i" % (minBytes, n))
+
+    def compareImages(self, otherDbname, n=20, minBytes=1):
+        """Finds files of the image which share chunks with files of other image (for example, the previous snapshot).
+
+        Args:
+            otherDbname: Database file name of other image.
+            n: Max number of pairs (with the most shared bytes).
+            minBytes: Min shared bytes of a pair.
+
+        Returns:
+            List of (path + fname in this image, path + fname in other image, shared bytes, fsize, other fsize)
+            or None if failed.
+        """
+        if not self.open():
+            return None
+        if not os.path.exists(otherDbname) or not self.dbgate.attach(otherDbname, 'other'):
+            logging.error('image "%s" can not be attached' % otherDbname)
+            return None
+        try:
+            return self.dbgate.query(
+                "with fc as (select distinct fileId, hash, size from main.FileChunks"
+                "  where hash in (select hash from other.FileChunks)),"
+                " oc as (select distinct fileId, hash from other.FileChunks where hash in (select hash from fc))"
+                " select fa.path || ffa.fname, fb.path || ffb.fname, sum(a.size) as shared, ffa.fsize, ffb.fsize"
+                " from fc a join oc b on a.hash = b.hash"
+                " join main.Files ffa on ffa.fileId = a.fileId join main.Folders fa on fa.foId = ffa.foId"
+                " join other.Files ffb on ffb.fileId = b.fileId join other.Folders fb on fb.foId = ffb.foId"
+                " group by a.fileId, b.fileId having shared >= %i order by shared desc limit %i" % (minBytes, n))
+        finally:
+            self.dbgate.query("detach database other")
+
+
+def test_Chunker():
+    """Simple test.
+    """
+    initLogs(u"test_ChunkIndex.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    data = os.urandom(4 * 1024 * 1024)
+    chunker = Chunker()
+    for offset in xrange(0, len(data), 1000000):
+        chunker.update(data[offset:offset + 1000000])
+    chunks1 = set(chunk[2] for chunk in chunker.finish())
+    chunker = Chunker()
+    chunker.update('inserted' + data)
+    chunks2 = set(chunk[2] for chunk in chunker.finish())
+    logging.info('chunks=%i, the same after insertion=%i' % (len(chunks1), len(chunks1 & chunks2)))
+
+    spool = ChunkSpool(maxRows=8)
+    chunker = Chunker(onChunk=spool.add)
+    chunker.update(data)
+    chunker.finish()
+    logging.info('spooled chunks=%i, the same as in memory: %s' %
+                 (len(spool), str(set(chunk[2] for chunk in spool) == chunks1)))
+    spool.close()
+
+    for row in ChunkOverlap('test_FileSystemImage.sqlite').findOverlaps() or []:
+        logging.info(str(row))
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_Chunker()
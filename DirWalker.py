@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    DirWalker.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import os
+import stat
+import errno
+from collections import namedtuple
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir  # python 3.5+
+except ImportError:
+    try:
+        from scandir import scandir  # python 2.7, "pip install scandir"
+    except ImportError:
+        scandir = None
+
+
+# Directory entry with the result of one stat() call.
+#   name: File or folder name (without path).
+#   isLink: True if the entry is a symlink (st is taken from the link target).
+#   st: os.stat_result or None (if stat() failed).
+FileEntry = namedtuple('FileEntry', 'name isLink st')
+
+
+def listDir(curDir):
+    """Lists the directory and gets stat info for every entry (one stat() per entry).
+    Uses os.scandir() if available (file type comes from the directory read), os.listdir() + os.lstat() otherwise.
+
+    Returns:
+        Tuple of three lists (dirs, files, dirLinks) of FileEntry.
+        Symlinks to folders are returned in dirLinks (not in dirs).
+
+    Raises:
+        OSError: If the directory can not be listed.
+    """
+    if scandir is not None:
+        return listDirScandir(curDir)
+    return listDirLstat(curDir)
+
+
+def listDirScandir(curDir):
+    """For internal usage.
+    """
+    dirs, files, dirLinks = [], [], []
+    for entry in scandir(curDir):
+        try:
+            isLink = entry.is_symlink()
+            isDir = entry.is_dir()  # follows symlinks, False for broken links
+        except OSError:
+            isLink = isDir = False
+        st = None
+        try:
+            st = entry.stat()  # follows symlinks (the same as os.path.getsize() does)
+        except OSError:
+            pass
+        item = FileEntry(entry.name, isLink, st)
+        if isDir:
+            (dirLinks if isLink else dirs).append(item)
+        else:
+            files.append(item)
+    return dirs, files, dirLinks
+
+
+def listDirLstat(curDir):
+    """For internal usage.
+    """
+    return listNames(curDir, os.listdir(curDir))
+
+
+def listNames(curDir, names, skipMissing=False):
+    """Gets stat info for the given entries of the directory (without listing the directory).
+
+    Args:
+        curDir: The directory.
+        names: List of file and folder names in the directory.
+        skipMissing: If True, entries which do not exist (any more) are skipped.
+
+    Returns:
+        Tuple of three lists (dirs, files, dirLinks) of FileEntry (see listDir()).
+    """
+    dirs, files, dirLinks = [], [], []
+    for name in names:
+        st = None
+        isLink = False
+        try:
+            st = os.lstat(os.path.join(curDir, name))
+            if stat.S_ISLNK(st.st_mode):
+                isLink = True
+                st = os.stat(os.path.join(curDir, name))  # the link target
+        except OSError, e:
+            if skipMissing and e.errno == errno.ENOENT and not isLink:
+                continue
+            st = None
+        item = FileEntry(name, isLink, st)
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            (dirLinks if isLink else dirs).append(item)
+        else:
+            files.append(item)
+    return dirs, files, dirLinks
+
+
+def walkTree(top, onError=None, onDirLink=None, listJob=None, workers=1, window=0, stack=None):
+    """Walks top-down the directory tree (the same order as os.walk() does).
+    Symlinks to folders are not followed.
+    With workers > 1 the next folders (in walk order) are listed ahead in a pool of threads,
+    it hides readdir/stat latency of network file systems and disk arrays.
+    The order of folders is the same for any number of workers.
+
+    Args:
+        top: The root directory.
+        onError: Function to call with OSError instance if some directory can not be listed.
+        onDirLink: Function to call with full path of every symlink to folder.
+        listJob: Function to make a listing job for the directory (called in the walking thread):
+            listJob(curDir) returns a function without arguments (it can run in a worker thread),
+            which returns the same as listDir(curDir). Default is listing by listDir().
+        workers: Number of threads to list folders.
+        window: Max number of folders listed ahead (default is 8 * workers).
+        stack: List of folders to visit (the last one is visited first), default is [top].
+            The list is modified in place, so the caller can save it (with the yielded curDir)
+            to continue the walk later from the same place.
+
+    Yields:
+        Tuple (curDir, dirs, files), where dirs and files are lists of FileEntry.
+        The caller can remove items from dirs (in place) to skip some subfolders.
+    """
+    listJob = listJob or (lambda curDir: partial(listDir, curDir))
+    pool = ThreadPool(workers) if workers > 1 else None
+    window = window if window > 0 else 8 * workers
+    pending = {}  # path => AsyncResult
+
+    stack = stack if stack is not None else [top]
+    try:
+        while stack:
+            # list ahead the next folders to visit (the top of the stack)
+            if pool is not None:
+                for path in stack[-window:]:
+                    if path not in pending:
+                        pending[path] = pool.apply_async(listJob(path))
+
+            curDir = stack.pop()
+            try:
+                if pool is not None:
+                    dirs, files, dirLinks = pending.pop(curDir).get()
+                else:
+                    dirs, files, dirLinks = listJob(curDir)()
+            except OSError, e:
+                if onError is not None:
+                    onError(e)
+                continue
+
+            if onDirLink is not None:
+                for entry in dirLinks:
+                    onDirLink(os.path.join(curDir, entry.name))
+
+            yield curDir, dirs, files
+
+            # visit subfolders in listing order
+            for entry in reversed(dirs):
+                stack.append(os.path.join(curDir, entry.name))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    DuplicateFinder.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import sqlite3
+import itertools
+from helpers import initLogs, normpathEx, calcFileMD5, calcFilePartialMD5, imapThreaded
+from FileSystemImage import FileSystemImage
+from ImageSchema import IMAGE_OBJECTS, nowNs, md5ToBlob, blobToMD5
+
+
+class DuplicateFinder:
+    """Finds duplicate files in SQLite image (created by FileSystemImage.createImage()).
+    Stage 1: groups files by size, files with unique size are dropped (the candidates are streamed by size).
+    Stage 2: compares MD5 checksums of the first, the middle and the last blocks of files without MD5.
+    Stage 3: calculates full MD5 checksums for the remaining collisions only (existing MD5 checksums are reused).
+    Hard links of one inode (see 'FileLinks' table) are one file: the inode is read once,
+    a group has two inodes at least, all the links are listed in the group.
+    Table 'DupGroups' contains groups of duplicates (groupId, file size, MD5 checksum, number of files).
+    Table 'DupFiles' contains the list of duplicates (groupId, fileId).
+    Full MD5 checksums calculated by stage 3 are saved to 'FilesMD5' table too.
+
+    Attributes:
+       image: FileSystemImage (database connection and scan parameters).
+       minSize: Files smaller than minSize are ignored (empty files are always ignored).
+       blockSize: Block size for partial MD5 checksums.
+       bytesRead: Number of bytes read by the last findDuplicates().
+    """
+
+    def __init__(self, dbname):
+        """Inits DuplicateFinder object with database file name.
+        """
+        self.image = FileSystemImage(dbname)
+        self.image.dbgate.needTables(list(IMAGE_OBJECTS) + ['DupGroups', 'DupFiles'])
+        self.image.dbgate.defineTable('DupGroups', 'groupId integer primary key, fsize integer, md5 blob, nfiles integer')
+        self.image.dbgate.defineTable('DupFiles', 'groupId integer, fileId integer')
+
+        self.minSize = 1
+        self.blockSize = 64 * 1024
+        self.bytesRead = 0
+
+    def findDuplicates(self, whereSql="fname like '%'"):
+        """Finds duplicate files, saves results to 'DupGroups' and 'DupFiles' tables (previous results are deleted).
+
+        Args:
+            whereSql: A filter for files (the same as for FileSystemImage.calcMD5forFiles()).
+
+        Returns:
+            True or False.
+        """
+        dbgate = self.image.dbgate
+
+        # connect to database
+        if not self.image.openImage():
+            return False
+
+        # load scan parameters from database
+        if not self.image.loadScanParams():
+            return False
+
+        dbgate.trace('find-dups-start', 'where=[%s], min-size=%i' % (whereSql, self.minSize))
+
+        # stage 1: copy files with non-unique size to a temp table (the results are written while it is read)
+        minSize = max(self.minSize, 1)
+        if not self.image.loadFolderPaths() or \
+                dbgate.query("drop table if exists temp.DupCandidates") is None or \
+                dbgate.query("create temp table DupCandidates as select ff.fileId, ff.fsize, ff.fname, fo.path, "
+                             " md.md5, ff.ino, fl.dev, fl.nlink "
+                             " from Files ff join temp.FolderPaths fo on ff.foId = fo.foId "
+                             " left join FilesMD5 md on md.fileId = ff.fileId "
+                             " left join FileLinks fl on fl.fileId = ff.fileId "
+                             " where ff.fsize >= %i and (%s) and ff.fsize in "
+                             " (select ff.fsize from Files ff join temp.FolderPaths fo on ff.foId = fo.foId "
+                             "  where ff.fsize >= %i and (%s) group by ff.fsize having count(1) > 1)" %
+                             (minSize, whereSql, minSize, whereSql)) is None or \
+                dbgate.query("create index temp.DupCandidatesSize on DupCandidates (fsize, fileId)") is None:
+            dbgate.trace('error', 'select files for find duplicates failed')
+            return False
+
+        if dbgate.query("delete from DupFiles") is None or dbgate.query("delete from DupGroups") is None:
+            dbgate.trace('error', 'delete previous duplicates failed')
+            return False
+
+        self.bytesRead = 0
+        nFiles = nPartial = nFull = nGroups = nDups = 0
+
+        if not dbgate.beginBulk():
+            return False
+        try:
+            # process files of the same size (the candidates are read by parts, ordered by size)
+            rows = dbgate.iterQuery("select fileId, fsize, fname, path, md5, ino, dev, nlink from temp.DupCandidates "
+                                    " order by fsize, fileId")
+            for fsize, sizeRows in itertools.groupby(rows, key=lambda row: row[1]):
+                group = []
+                for row in sizeRows:
+                    fname = normpathEx(self.image.rootDir + row[3]) + row[2]
+                    group.append((int(row[0]), int(row[1]), fname, blobToMD5(row[4]),
+                                  self.image.getLinkKey(fname, row[6], row[5], row[7])))
+                nFiles += len(group)
+
+                n1, n2, groups = self.checkSizeGroup(group)
+                nPartial += n1
+                nFull += n2
+
+                # save groups of duplicates
+                for md5, fileIds in groups:
+                    nGroups += 1
+                    nDups += len(fileIds)
+                    dbgate.bulk("insert into DupGroups (groupId, fsize, md5, nfiles) values (?, ?, ?, ?)",
+                                (nGroups, fsize, md5ToBlob(md5), len(fileIds)))
+                    for fileId in fileIds:
+                        dbgate.bulk("insert into DupFiles (groupId, fileId) values (?, ?)", (nGroups, fileId))
+        except sqlite3.Error, e:
+            logging.exception(e.args[0])
+            dbgate.trace('error', 'select files for find duplicates failed')
+            return False
+        finally:
+            dbgate.endBulk()
+
+        dbgate.trace('find-dups-done', 'files=%i, partial-md5=%i, full-md5=%i, groups=%i, duplicates=%i, read=%iMB' %
+                     (nFiles, nPartial, nFull, nGroups, nDups, self.bytesRead // (1024 * 1024)))
+
+        return True
+
+    def checkSizeGroup(self, group):
+        """For internal usage.
+        Finds duplicates among files of the same size.
+
+        Args:
+            group: List of (fileId, fsize, fname, md5 or None, (dev, inode) of a file with hard links or None,
+                see FileSystemImage.getLinkKey()).
+
+        Returns:
+            Tuple (number of partial MD5, number of full MD5, list of (md5, list of fileIds)).
+        """
+        fsize = group[0][1]
+        nPartial = nFull = 0
+
+        # hard links of one inode are one file: [fileId, fsize, fname, md5 or None, fileIds, fileIds without MD5]
+        inodes = []
+        byKey = {}
+        for fileId, fsize_, fname, md5, key in group:
+            item = byKey.get(key) if key is not None else None
+            if item is None:
+                item = [fileId, fsize_, fname, md5, [], []]
+                inodes.append(item)
+                if key is not None:
+                    byKey[key] = item
+            item[3] = item[3] or md5
+            item[4].append(fileId)
+            if not md5:
+                item[5].append(fileId)
+        if len(inodes) < 2:
+            return nPartial, nFull, []
+
+        # stage 2: split files without MD5 by partial MD5 (not needed if files are small),
+        # a file can be a duplicate of other files of its partial MD5 or of the files with MD5
+        # (partial MD5 of one file of every known MD5 is compared)
+        known = [inode for inode in inodes if inode[3]]
+        unknown = [inode for inode in inodes if not inode[3]]
+        if fsize > 3 * self.blockSize and unknown:
+            samples = dict((inode[3], inode) for inode in reversed(known)).values()
+            parts = {}  # partial MD5 => [number of files with MD5, files without MD5]
+            failed = False
+            for item, partMD5 in imapThreaded(self.partialMD5Job, unknown + samples, self.image.hashWorkers):
+                self.bytesRead += 3 * self.blockSize
+                nPartial += 1
+                if not partMD5:
+                    failed = failed or bool(item[3])
+                    continue
+                part = parts.setdefault(partMD5, [0, []])
+                if item[3]:
+                    part[0] += 1
+                else:
+                    part[1].append(item)
+            # a file with MD5 is not readable: files without MD5 are compared with it by full MD5
+            unknown = [candidate for nKnown, items in parts.values() if len(items) > 1 or nKnown or failed
+                       for candidate in items]
+        candidates = known + unknown
+        if len(candidates) < 2:
+            return nPartial, nFull, []
+
+        # stage 3: split the remaining collisions by full MD5
+        full = {}
+        for item, md5 in imapThreaded(self.fullMD5Job, candidates, self.image.hashWorkers):
+            if not item[3]:
+                self.bytesRead += fsize
+                nFull += 1
+            if not md5:
+                continue
+            for fileId in item[5]:
+                self.image.dbgate.bulk("insert into FilesMD5 (fileId, md5, calcTime) values (?, ?, ?)",
+                                       (fileId, md5ToBlob(md5), nowNs()))
+            full.setdefault(md5, []).append(item)
+        result = []
+        for md5 in sorted(full.keys()):
+            if len(full[md5]) > 1:
+                result.append((md5, sorted(fileId for item in full[md5] for fileId in item[4])))
+        logging.debug('fsize=%i, files=%i, inodes=%i, groups=%i' % (fsize, len(group), len(inodes), len(full)))
+
+        return nPartial, nFull, result
+
+    def partialMD5Job(self, row):
+        """For internal usage (runs in worker threads).
+        """
+        return calcFilePartialMD5(row[2], row[1], self.blockSize)
+
+    def fullMD5Job(self, row):
+        """For internal usage (runs in worker threads).
+        """
+        return row[3] or calcFileMD5(row[2])
+
+
+def test_DuplicateFinder():
+    """Simple test.
+    """
+    initLogs(u"test_DuplicateFinder.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    DuplicateFinder('test_FileSystemImage.sqlite').findDuplicates("fname like '%'")
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_DuplicateFinder()
@@ -6,11 +6,25 @@
 """
 
 import logging
+import sqlite3
 import sys
 import os
+import time
+import json
+import itertools
+import shutil
+import tempfile
 from datetime import datetime
-from helpers import initLogs, normpathEx, calcMD5, calcFileMD5, getFileTimes
+from functools import partial
+from helpers import initLogs, normpathEx, calcDigests, calcFileDigests, isDigestAvailable, imapThreaded, \
+    getFilePhysicalOffset
 from GateSQLite import GateSQLite
+from DirWalker import walkTree, listDir, listNames
+from PathMatcher import PathMatcher
+from ScanMetrics import MB
+from ChunkIndex import Chunker, ChunkSpool
+from ImageSchema import IMAGE_TABLES, IMAGE_OBJECTS, IMAGE_PRAGMAS, SCHEMA_VERSION, defineImageTables, \
+    getSchemaVersion, setSchemaVersion, nowNs, fileTimesNs, md5ToBlob
 
 
 class FileSystemImage:
@@ -18,24 +32,94 @@ class FileSystemImage:
     Walks top-down the root directory and finds all subfolders and files.
     Calculates MD5 checksum for files (optionally).
     Saves file system info to SQLite database.
-    Table 'Folders' contains the list of subfolders.
-    Table 'Files' contains the list of files (folderId, file name, file size, create time, write time).
+    Table 'FolderTree' contains the list of subfolders (folderId, parent folderId, name, scan time, write time).
+    View 'Folders' contains the list of subfolders with paths (folderId, path, scan time, write time).
+    Table 'Files' contains the list of files (folderId, file name, file size, create time, write time, inode).
     Table 'FilesMD5' contains the list of MD5 checksums.
+    Table 'FilesDigests' contains other checksums (SHA-256, ...), they are calculated in the same pass as MD5.
+    Table 'FileChunks' contains content-defined chunks of large files (optional, see chunkMinFileSize).
+    Table 'FolderStats' contains recursive totals of folders (bytes, files, subfolders, the newest write time).
+    Table 'FileLinks' contains device and number of links of files with hard links, calcMD5forFiles() reads
+    every inode once and saves its checksums for all the links (sparse files are read without holes).
+    Timestamps are integer nanoseconds since epoch, MD5 checksums are 16-byte BLOBs (see ImageSchema.py).
+    A previous image of the same root directory can be used as a base image (incremental scan).
+    Long scans and MD5 calculations save checkpoints, interrupted ones can be continued by resume().
+    The image is written by a writer thread (see GateSQLite.writerQueueSize) in WAL mode (see ImageSchema.IMAGE_PRAGMAS),
+    so listing of folders and hashing do not wait for SQLite, the queue of writes is bounded.
 
     Attributes:
        dbgate: GateSQLite database connection.
        rootDir: The root directory to scan.
-       excludeList: The list of subfolders to exclude from scan list.
+       excludeList: The list of subfolders to exclude from scan list (rules, see PathMatcher).
+       excludeMatcher: PathMatcher compiled from excludeList (with hit counters).
+       folderIds: Dict of folders found but not scanned yet (relative path => (foId, parentId, name, mtime)),
+          used by createImage().
+       nextFoId: Folder id for the next found folder, used by createImage().
+       nextFileId: File id for the next found file, used by createImage().
+       baseDbname: The base image (database file name) or None, used by createImage().
+       baseFolders: Dict of folders of the base image (relative path => (foId, mtime, scanTime)) or None.
+       baseChildren: Dict of subfolder names of the base image (relative path => list of names).
+       baseFiles: Dict of files of the base image for the folder being scanned (fname => row) or None.
+       baseFilesByDir: Dict of baseFiles for the folders listed ahead (full path => baseFiles).
+       scanWorkers: Number of threads to list folders, used by createImage() (folder ids do not depend on it).
+       hashWorkers: Number of threads to calculate MD5 checksums, used by calcMD5forFiles().
+       digests: Checksums to calculate by calcMD5forFiles() besides MD5 (hashlib names, for example 'sha256').
+       hashMmapSize: Files larger than it are hashed by mmap, 0 to disable (see helpers.calcFileDigests()).
+       hashOrder: Order of files for calcMD5forFiles(): 'fileId' (as scanned), 'inode' (by inode number)
+          or 'extent' (by physical offset on the disk, see helpers.getFilePhysicalOffset(), falls back to inode).
+          Files are sorted by windows of pageRows files, it makes less seeks on HDD.
+       hashBigSize: For 'inode' and 'extent' order, files larger than it are hashed one by one in one thread
+          after the small files of the window (sequential reads of big files are not interleaved).
+       chunkMinFileSize: Files of this size or larger are split into content-defined chunks by calcMD5forFiles()
+          in the same read pass as MD5 (see ChunkIndex.py), 0 to disable.
+       pageRows: Number of files to fetch per query by calcMD5forFiles() (memory usage does not depend on image size).
+       throttle: IoThrottle to limit bytes/s, operations/s and concurrent I/O of scan and MD5 calculation, or None.
+       metrics: ScanMetrics to collect counters, latencies and progress (see ScanMetrics.py), or None.
+       checkpointSeconds: Save checkpoint (and commit the data) every N seconds, 0 to disable.
     """
 
     def __init__(self, dbname):
         """Inits FileSystemImage object with database file name or ':memory:'.
         """
         self.dbgate = GateSQLite(dbname)
-        self.dbgate.needTables(['Folders', 'Files', 'FilesMD5', 'ScanParams'])
+        self.dbgate.needTables(list(IMAGE_OBJECTS))
+        defineImageTables(self.dbgate)
+        self.dbgate.pragmas = list(IMAGE_PRAGMAS)
+        self.dbgate.writerQueueSize = 16
 
         self.rootDir = ''
         self.excludeList = []
+        self.excludeMatcher = PathMatcher()
+
+        self.folderIds = {}
+        self.nextFoId = 1
+        self.nextFileId = 1
+
+        self.baseDbname = None
+        self.baseFolders = None
+        self.baseChildren = {}
+        self.baseFiles = None
+        self.baseFilesByDir = {}
+        self.baseHasDigests = False
+        self.baseHasChunks = False
+        self.nDirsReused = 0
+        self.nMD5Reused = 0
+        self.nLinksReused = 0
+
+        self.scanWorkers = 1
+        self.hashWorkers = 1
+        self.digests = []
+        self.hashMmapSize = 0
+        self.hashAlgorithms = ['md5']
+        self.hashOrder = 'fileId'
+        self.hashBigSize = 64 * MB
+        self.chunkMinFileSize = 0
+
+        self.pageRows = 10000
+        self.metrics = None
+        self.throttle = None
+        self.checkpointSeconds = 60.0
+        self.checkpointTime = 0.0
 
     def loadScanParams(self):
         """Loads scan parameters from 'ScanParams' table.
@@ -58,34 +142,60 @@ class FileSystemImage:
         if q is None:
             logging.error('load params [ExcludePath] failed')
             return False
+        self.excludeMatcher = PathMatcher(self.rootDir)
         for row in q:
-            self.excludeList.append(row[0].replace('\\', '/').lower())
+            if not self.excludeMatcher.addRule(row[0]):
+                logging.error('load params [ExcludePath] failed, bad rule "%s"' % row[0])
+                return False
+        self.excludeList = list(self.excludeMatcher.rules)
 
         return True
 
-    def createImage(self, scanParams):
+    def openImage(self):
+        """Connects to database and validates/creates database schema.
+        Images with old schema must be converted by ImageSchema.migrateImage().
+
+        Returns:
+            True or False.
+        """
+        if self.dbgate.con is None and not self.dbgate.open():
+            logging.error('sqlite3 open failed')
+            return False
+        version = getSchemaVersion(self.dbgate)
+        if version not in [0, SCHEMA_VERSION]:
+            logging.error('image "%s" has schema version %s, use ImageSchema.migrateImage()' %
+                          (self.dbgate.dbname, str(version)))
+            return False
+        if not self.dbgate.openConn():
+            return False
+        return version == SCHEMA_VERSION or setSchemaVersion(self.dbgate)
+
+    def createImage(self, scanParams, baseDbname=None):
         """Creates SQLite image of the root directory without MD5 checksums.
 
+        Incremental scan (if baseDbname is set):
+        the folders with unchanged write time are not listed again (names are taken from the base image),
+        MD5 checksums are copied from the base image for files with unchanged size, write time and inode.
+        Use calcMD5forFiles(..., addOnly=True) after it to calculate MD5 for new and modified files only.
+
         Args:
             scanParams: Dict of parameters ('RootDirWin32', 'RootDirLinux', 'StorageName', 'ExcludePath1'..'ExcludePath%').
+            baseDbname: The previous image of the same root directory (database file name) or None.
 
         Returns:
             True or False.
         """
 
-        # define database schema
-        self.dbgate.defineTable('Folders', 'foId integer primary key AUTOINCREMENT, path text, scanTime text')
-        self.dbgate.defineTable('Files',
-                                'fileId integer primary key AUTOINCREMENT, foId integer, fname text, fsize integer, ctime text, wtime text')
-        self.dbgate.defineTable('FilesMD5', 'fileId integer primary key, md5 text, calcTime text')
-        self.dbgate.defineTable('ScanParams', 'name text, value text')
-
         # connect to database and validate/create database schema
-        if not self.dbgate.openConn():
+        if not self.openImage():
+            return False
+
+        if self.loadCheckpoint('scan') is not None:
+            logging.error('createImage, the image has unfinished scan, use resume()')
             return False
 
         # check that all the tables are empty
-        for tableName in self.dbgate.ntables:
+        for tableName in IMAGE_TABLES + ['History']:
             q = self.dbgate.query("select count(1) from %s" % tableName)
             if not q:
                 logging.error('createImage, tables empty validate failed')
@@ -96,8 +206,7 @@ class FileSystemImage:
 
         # save scan parameters to database
         for pname in scanParams.keys():
-            q = self.dbgate.query("insert into ScanParams (name, value) select '%s', '%s'" % (pname, scanParams[pname]))
-            if q is None:
+            if not self.dbgate.bulk("insert into ScanParams (name, value) values (?, ?)", (pname, scanParams[pname])):
                 logging.error('createImage, save scanParams to database failed')
                 return False
 
@@ -105,28 +214,145 @@ class FileSystemImage:
         if not self.loadScanParams():
             return False
 
-        self.dbgate.trace('create-image-start', 'root=[%s], ignore=%s' % (self.rootDir, str(self.excludeList)))
+        # load the base image (for incremental scan)
+        self.baseDbname = baseDbname
+        if baseDbname and not self.openBaseImage(baseDbname):
+            self.dbgate.trace('warning', 'base image "%s" is not used, full scan' % baseDbname)
+            self.baseDbname = self.baseFolders = None
+
+        # write the image in large transactions (see GateSQLite.beginBulk())
+        if not self.dbgate.beginBulk():
+            return False
+        try:
+            return self.scanTree()
+        finally:
+            self.dbgate.endBulk()
+
+    def resume(self):
+        """Continues unfinished createImage() and calcMD5forFiles() from the last checkpoints.
+        The data written after the checkpoint is deleted and written again, the finished work is not redone.
+
+        Returns:
+            True or False (True if there is nothing to continue).
+        """
+
+        # connect to database
+        if not self.openImage():
+            return False
+
+        # continue the scan
+        state = self.loadCheckpoint('scan')
+        if state is not None:
+            if not self.loadScanParams():
+                return False
+            self.baseDbname = state['baseDbname']
+            if self.baseDbname and not self.openBaseImage(self.baseDbname):
+                self.dbgate.trace('warning', 'base image "%s" is not used' % self.baseDbname)
+                self.baseDbname = self.baseFolders = None
+            if not self.dbgate.beginBulk():
+                return False
+            try:
+                if not self.scanTree(state):
+                    return False
+            finally:
+                self.dbgate.endBulk()
+
+        # continue MD5 calculation
+        state = self.loadCheckpoint('calc-md5')
+        if state is not None:
+            if not self.loadScanParams():
+                return False
+            self.digests = state['digests']
+            self.chunkMinFileSize = state.get('chunkMinFileSize', 0)
+            if not self.hashFiles(state):
+                return False
+
+        return True
+
+    def saveCheckpoint(self, name, state):
+        """For internal usage.
+        Saves checkpoint and commits it in one transaction with the data written before (bulk mode only).
+
+        Returns:
+            True or False.
+        """
+        self.checkpointTime = time.time()
+        if not self.dbgate.bulk("insert or replace into Checkpoints (name, state, saveTime) values (?, ?, ?)",
+                                (name, json.dumps(state), nowNs())):
+            return False
+        return self.dbgate.commitBulk()
+
+    def loadCheckpoint(self, name):
+        """For internal usage.
+
+        Returns:
+            Dict with the state or None (if there is no checkpoint).
+        """
+        q = self.dbgate.query("select state from Checkpoints where name = '%s'" % name)
+        return json.loads(q[0][0]) if q else None
+
+    def isCheckpointTime(self):
+        """For internal usage.
+        """
+        return self.checkpointSeconds > 0 and time.time() - self.checkpointTime >= self.checkpointSeconds
+
+    def scanTree(self, state=None):
+        """For internal usage.
+        Scans the tree from the root directory or from the checkpoint state (see resume()).
+        """
+        if state is None:
+            self.dbgate.trace('create-image-start', 'root=[%s], ignore=%s, base=%s' %
+                              (self.rootDir, str(self.excludeList), 'yes' if self.baseFolders is not None else 'no'))
+
+            nScaned = 0
+            nDirs = 1  # it's root dir
+            nFiles = 0
 
-        nScaned = 0
-        nDirs = 1  # it's root dir
-        nFiles = 0
+            # folder/file ids are assigned here (not by database), so the scan never looks up Folders
+            rootStat = None
+            try:
+                rootStat = os.stat(self.rootDir)
+            except OSError:
+                pass
+            self.folderIds = {'/': (1, None, '', fileTimesNs(rootStat)[1])}
+            self.nextFoId = 2
+            self.nextFileId = 1
+            self.nDirsReused = self.nMD5Reused = 0
+            stack = [self.rootDir]
+
+            # the first checkpoint (with scan parameters)
+            if not self.saveScanCheckpoint(stack, (nScaned, nDirs, nFiles)):
+                return False
+        else:
+            stack = state['stack']
+            nScaned, nDirs, nFiles = state['counters']
+            if not self.restoreScanState(state):
+                return False
+            self.dbgate.trace('create-image-resume', 'root=[%s], dirs-to-scan=%i, files=%i' %
+                              (self.rootDir, len(stack), nFiles))
 
-        # scan directory tree
-        for root, dirs, files in os.walk(self.rootDir):
+        if self.metrics is not None:
+            self.metrics.start('create-image', {'dirs': len(self.baseFolders)} if self.baseFolders else None)
+            self.dbgate.metrics = self.metrics
 
-            # TODO(dan.dolbilov): Do ignore symlinks.
-            # if os.path.islink(root):
-            #    self.dbgate.trace('dir-ignored-islink', '[%s]' % normpathEx(root) )
-            #    continue
+        # scan directory tree (symlinks to folders are not followed)
+        for root, dirs, files in walkTree(self.rootDir, onError=self.onWalkError, onDirLink=self.onDirLink,
+                                          listJob=self.listFolderJob, workers=self.scanWorkers, stack=stack):
+
+            # save checkpoint before the folder (it's not scanned yet)
+            if self.isCheckpointTime() and not self.saveScanCheckpoint(stack + [root], (nScaned, nDirs, nFiles)):
+                self.dbgate.trace('error', 'save checkpoint failed')
+                return False
 
             curDir = normpathEx(root)
+            self.baseFiles = self.baseFilesByDir.pop(root, None)
 
             curDirId, curPath = self.onFolderScanBegin(curDir)
             if curDirId < 0:
                 continue
 
             # save subfolders
-            if not self.addFolders(curPath, dirs):
+            if not self.addFolders(curDirId, curPath, dirs):
                 self.dbgate.trace('error', 'addFolders for path "%s" (id = %i) failed' % (curPath, curDirId))
                 return False
 
@@ -140,207 +366,856 @@ class FileSystemImage:
             nDirs += len(dirs)
             nFiles += len(files)
 
-            # find subfolders to ignore
-            ignored = []
-            for dirName in dirs:
-                dirFull = normpathEx(curDir + dirName).lower()
-                for excPath in self.excludeList:
-                    if dirFull.find(excPath) != -1:
-                        ignored.append(dirName)
-                        break
-            # exclude ignored subfolders from scan list
-            for dir_ in ignored:
-                dirs.remove(dir_)  # don't visit directories
-                self.dbgate.trace('dir-ignored', '[%s]' % normpathEx(curDir + dir_))
-
-        self.dbgate.trace('create-image-done', 'dirs=%i, files=%i, dirs-scaned=%i' % (nDirs, nFiles, nScaned))
+            # exclude ignored subfolders from scan list (don't visit directories)
+            if self.excludeList:
+                visit = []
+                for entry in dirs:
+                    dirFull = normpathEx(curDir + entry.name)
+                    if self.excludeMatcher.match(dirFull) is None:
+                        visit.append(entry)
+                    else:
+                        self.dbgate.trace('dir-ignored', '[%s]' % dirFull)
+                if self.metrics is not None:
+                    self.metrics.add('dirs-ignored', len(dirs) - len(visit))
+                dirs[:] = visit
+
+            if self.metrics is not None:
+                self.metrics.add('dirs')
+                self.metrics.add('files', len(files))
+                self.metrics.set('dirs-to-visit', len(stack) + len(dirs))
+                self.metrics.tick()
+
+        # save folders which were not scanned (ignored, listdir() failed)
+        for path_ in sorted(self.folderIds.keys()):
+            if not self.dbgate.bulk("insert into FolderTree (foId, parentId, name, mtime) values (?, ?, ?, ?)",
+                                    self.folderIds[path_]):
+                self.dbgate.trace('error', 'insert folder "%s" failed' % path_)
+        self.folderIds = {}
+        self.baseFilesByDir = {}
+
+        # recursive totals of folders (before the checkpoint is deleted, resume() calculates them again)
+        if not self.calcFolderStats():
+            self.dbgate.trace('error', 'calc folder stats failed')
+
+        if not self.dbgate.bulk("delete from Checkpoints where name = ?", ('scan',)):
+            self.dbgate.trace('error', 'delete checkpoint failed')
+
+        if self.excludeList:
+            self.dbgate.trace('exclude-hits', ', '.join(['[%s]=%i' % (rule, hits)
+                                                         for rule, hits in self.excludeMatcher.getHits()]))
+
+        self.dbgate.trace('create-image-done', 'dirs=%i, files=%i, dirs-scaned=%i, dirs-reused=%i, md5-reused=%i' %
+                          (nDirs, nFiles, nScaned, self.nDirsReused, self.nMD5Reused))
+        if self.throttle is not None:
+            self.dbgate.trace('io-throttle', self.throttle.getStats())
+        if self.metrics is not None:
+            self.dbgate.commitBulk()  # the last rows are written before the final snapshot
+            self.metrics.finish()
 
         return True
 
+    def saveScanCheckpoint(self, stack, counters):
+        """For internal usage.
+        Saves the walk frontier (folders to visit), folder ids of found folders and counters.
+        """
+        state = {'baseDbname': self.baseDbname, 'stack': stack, 'counters': counters,
+                 'folderIds': self.folderIds, 'nextFoId': self.nextFoId, 'nextFileId': self.nextFileId,
+                 'nDirsReused': self.nDirsReused, 'nMD5Reused': self.nMD5Reused,
+                 'excludeHits': self.excludeMatcher.hits}
+        return self.saveCheckpoint('scan', state)
+
+    def restoreScanState(self, state):
+        """For internal usage.
+        Restores the scan state from checkpoint, deletes rows written after the checkpoint.
+        """
+        self.folderIds = dict((path_, tuple(item)) for path_, item in state['folderIds'].items())
+        self.nextFoId = state['nextFoId']
+        self.nextFileId = state['nextFileId']
+        self.nDirsReused = state['nDirsReused']
+        self.nMD5Reused = state['nMD5Reused']
+        if len(state['excludeHits']) == len(self.excludeMatcher.hits):
+            self.excludeMatcher.hits = state['excludeHits']
+
+        # folders found before the checkpoint are saved when scanned (see onFolderScanBegin())
+        for item in self.folderIds.values():
+            if not self.dbgate.bulk("delete from FolderTree where foId = ?", (item[0],)):
+                return False
+        for tableName, idName, nextId in [('FolderTree', 'foId', self.nextFoId), ('Files', 'fileId', self.nextFileId),
+                                          ('FilesMD5', 'fileId', self.nextFileId),
+                                          ('FilesDigests', 'fileId', self.nextFileId),
+                                          ('FileChunks', 'fileId', self.nextFileId),
+                                          ('FileLinks', 'fileId', self.nextFileId)]:
+            if not self.dbgate.bulk("delete from %s where %s >= ?" % (tableName, idName), (nextId,)):
+                return False
+        return True
+
+    def openBaseImage(self, baseDbname):
+        """For internal usage.
+        Attaches the base image as 'base' and loads its folders.
+
+        Returns:
+            True or False.
+        """
+        if not os.path.exists(baseDbname) or not self.dbgate.attach(baseDbname, 'base'):
+            return False
+
+        # the base image must have the same schema and the same root directory
+        q = self.dbgate.query("pragma base.user_version")
+        if not q or q[0][0] != SCHEMA_VERSION:
+            self.dbgate.trace('warning', 'base image, schema version mismatch')
+            return False
+        for tableName in ['FolderTree', 'Files', 'FilesMD5']:
+            q = self.dbgate.query("select sql from base.sqlite_master where name = '%s'" % tableName)
+            if not q or str(q[0][0]).lower() != self.dbgate.dtables[tableName].lower():
+                self.dbgate.trace('warning', 'base image, table [%s] schema mismatch' % tableName)
+                return False
+        rootName = 'RootDirWin32' if sys.platform == "win32" else 'RootDirLinux'
+        q = self.dbgate.query("select value from base.ScanParams where name = '%s'" % rootName)
+        if not q or normpathEx(q[0][0]) != self.rootDir:
+            self.dbgate.trace('warning', 'base image, root directory mismatch')
+            return False
+        q = self.dbgate.query("select count(1) from base.Checkpoints where name = 'scan'")
+        if not q or q[0][0]:
+            self.dbgate.trace('warning', 'base image, the scan is not finished (use resume() for it)')
+            return False
+        q = self.dbgate.query("select sql from base.sqlite_master where name = 'FilesDigests'")
+        self.baseHasDigests = bool(q) and str(q[0][0]).lower() == self.dbgate.dtables['FilesDigests'].lower()
+        q = self.dbgate.query("select sql from base.sqlite_master where name = 'FileChunks'")
+        self.baseHasChunks = bool(q) and str(q[0][0]).lower() == self.dbgate.dtables['FileChunks'].lower()
+
+        # files of the base image (indexed by folder)
+        if self.dbgate.query("create temp table BaseFiles as "
+                             " select ff.fileId, ff.foId, ff.fname, ff.fsize, ff.wtime, ff.ino, md.fileId is not null as hasMD5 "
+                             " from base.Files ff left join base.FilesMD5 md on md.fileId = ff.fileId") is None:
+            return False
+        if self.dbgate.query("create index BaseFilesFoId on BaseFiles (foId)") is None:
+            return False
+
+        # folders of the base image
+        q = self.dbgate.query("select foId, path, mtime, scanTime from base.Folders")
+        if q is None:
+            return False
+        self.baseFolders = {}
+        self.baseChildren = {}
+        for row in q:
+            path_ = row[1]
+            self.baseFolders[path_] = (row[0], row[2], row[3])
+            if path_ != '/':
+                parent = path_[:path_.rstrip('/').rfind('/') + 1]
+                self.baseChildren.setdefault(parent, []).append(path_[len(parent):-1])
+
+        self.dbgate.trace('base-image', '[%s], dirs=%i' % (baseDbname, len(self.baseFolders)))
+        return True
+
+    def listFolderJob(self, root):
+        """For internal usage.
+        Makes a listing job for walkTree(), reuses the folder listing from the base image if the folder is not changed.
+        """
+        if self.baseFolders is None:
+            return self.ioJob('list-dir', partial(listDir, root))
+
+        curPath = normpathEx(root)[len(self.rootDir) - 1:]
+        if curPath not in self.baseFolders:
+            return self.ioJob('list-dir', partial(listDir, root))
+        baseFoId, baseMtime, baseScanTime = self.baseFolders[curPath]
+
+        # BaseFiles is not written by the scan, so the buffered writes are not flushed for it (see GateSQLite.query())
+        q = self.dbgate.query("select fname, fileId, fsize, wtime, ino, hasMD5 from BaseFiles where foId = ?",
+                              (baseFoId,), sync=False)
+        if q is None:
+            return self.ioJob('list-dir', partial(listDir, root))
+        baseFiles = dict((row[0], row) for row in q)
+        self.baseFilesByDir[root] = baseFiles
+
+        # the folder write time changes if some files/folders are added/removed/renamed in the folder,
+        # the folder was not listed in the base image if it has no scanTime (ignored, listdir() failed)
+        item = self.folderIds.get(curPath)
+        if item is None or not baseMtime or baseScanTime is None or item[3] != baseMtime:
+            return self.ioJob('list-dir', partial(listDir, root))
+
+        self.nDirsReused += 1
+        return self.ioJob('stat-dir', partial(listNames, root, self.baseChildren.get(curPath, []) + baseFiles.keys(),
+                                                 skipMissing=True))
+
+    def ioJob(self, name, job):
+        """For internal usage.
+        Adds latency of the job to metrics and limits its I/O by throttle (if enabled).
+        """
+        if self.throttle is not None:
+            job = partial(self.runThrottledListJob, job)
+        if self.metrics is not None:
+            job = partial(self.metrics.timed, name, job)
+        return job
+
+    def runThrottledListJob(self, job):
+        """For internal usage (runs in worker threads).
+        Listing of a folder is one I/O job, every entry is one operation (stat).
+        """
+        self.throttle.enter()
+        try:
+            self.throttle.acquire(0, 1)
+            time1 = time.time()
+            res = job()
+            nOps = 1 + sum([len(entries) for entries in res])
+            self.throttle.observe((time.time() - time1) / nOps)
+        finally:
+            self.throttle.leave()
+        self.throttle.acquire(0, nOps - 1)
+        return res
+
+    def onWalkError(self, err):
+        """For internal usage.
+        """
+        self.dbgate.trace('error', 'listdir() failed for path "%s", %s' % (err.filename, err.strerror))
+
+    def onDirLink(self, path):
+        """For internal usage.
+        """
+        self.dbgate.trace('dir-ignored-islink', '[%s]' % normpathEx(path))
+
     def onFolderScanBegin(self, curDir):
         """For internal usage.
         """
-        timeStr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # not GMT
+        scanTime = nowNs()
 
         # check that curDir begins with rootDir
-        if curDir.find(self.rootDir) != 0:
+        if not curDir.startswith(self.rootDir):
             self.dbgate.trace('error', 'curDir "%s" must begins with rootDir' % curDir)
             return -1, ''
 
         # remove rootDir from curDir (work with relative path)
         curPath = curDir[len(self.rootDir) - 1:]
 
-        # do initial insert for the root directory
-        if curPath == '/':
-            q = self.dbgate.query("insert into Folders (path) select '/'")
-            if q is None:
-                self.dbgate.trace('error', 'insert rootDir failed')
-
-        # find folder id for curDir
-        q = self.dbgate.query("select foId from Folders where path = '%s'" % curPath.replace("'", "''"))
-        if not q or len(q) != 1:
+        # find folder id for curDir (it was assigned by addFolders())
+        item = self.folderIds.pop(curPath, None)
+        if item is None:
             self.dbgate.trace('error', 'path "%s" not found in Folders' % curPath)
             return -2, curPath
+        curDirId, parentId, name, mtime = item
 
-        curDirId = q[0][0]
-
-        # set scanTime for curDir
-        q = self.dbgate.query("update Folders set scanTime = '%s' where foId = %i" % (timeStr, curDirId))
-        if q is None:
-            self.dbgate.trace('warning', 'update Folders for path "%s" (id = %i) failed' % (curPath, curDirId))
+        # save curDir with scanTime
+        if not self.dbgate.bulk("insert into FolderTree (foId, parentId, name, scanTime, mtime) values (?, ?, ?, ?, ?)",
+                                (curDirId, parentId, name, scanTime, mtime)):
+            self.dbgate.trace('warning', 'insert Folders for path "%s" (id = %i) failed' % (curPath, curDirId))
 
         return curDirId, curPath
 
-    def addFolders(self, curPath, dirs):
+    def addFolders(self, curDirId, curPath, dirs):
+        """For internal usage.
+        Assigns folder ids to subfolders, the rows are saved by onFolderScanBegin() (or at the end of scan).
+        """
+        for entry in dirs:
+            path_ = normpathEx(curPath + entry.name)
+            if path_ in self.folderIds:
+                return False
+            self.folderIds[path_] = (self.nextFoId, curDirId, entry.name, fileTimesNs(entry.st)[1])
+            self.nextFoId += 1
+        return True
+
+    def addFiles(self, curDirId, curDir, files):
         """For internal usage.
         """
-        sql = ''
-        qsz = 0
-        for dirName in dirs:
-            path_ = normpathEx(curPath + dirName)
-            sql += (" union all " if sql else " insert into Folders (path) ")
-            sql += " select '%s' " % path_.replace("'", "''")
-            qsz += 1
-
-            # insert 100 rows at a time to prevent overflow ("too many terms in compound SELECT")
-            if qsz >= 100:
-                if self.dbgate.query(sql) is None:
+        for entry in files:
+            fname = entry.name
+
+            fsize = ino = 0
+            if entry.st is not None:
+                fsize = entry.st.st_size
+                ino = entry.st.st_ino
+            else:
+                self.dbgate.trace('error', 'stat() failed for file "%s"' % (curDir + fname))
+
+            fileId = self.nextFileId
+            self.nextFileId += 1
+
+            ctime, wtime = fileTimesNs(entry.st)
+            if not self.dbgate.bulk("insert into Files (fileId, foId, fname, fsize, ctime, wtime, ino) "
+                                    " values (?, ?, ?, ?, ?, ?, ?)", (fileId, curDirId, fname, fsize, ctime, wtime, ino)):
+                return False
+
+            # hard links (the hash pass reads the inode once)
+            if entry.st is not None and getattr(entry.st, 'st_nlink', 1) > 1 and ino and \
+                    not self.dbgate.bulk("insert into FileLinks (fileId, dev, nlink) values (?, ?, ?)",
+                                         (fileId, entry.st.st_dev, entry.st.st_nlink)):
+                return False
+
+            # copy MD5 from the base image if the file is not changed
+            base = self.baseFiles.get(fname) if self.baseFiles else None
+            if base and base[5] and entry.st is not None and (base[2], base[3], base[4]) == (fsize, wtime, ino):
+                if not self.dbgate.bulk("insert into FilesMD5 (fileId, md5, calcTime) "
+                                        " select ?, md5, calcTime from base.FilesMD5 where fileId = ?", (fileId, base[1])):
                     return False
-                sql = ''
-                qsz = 0
+                if self.baseHasDigests and not self.dbgate.bulk(
+                        "insert into FilesDigests (fileId, algorithm, digest, calcTime) "
+                        " select ?, algorithm, digest, calcTime from base.FilesDigests where fileId = ?", (fileId, base[1])):
+                    return False
+                if self.baseHasChunks and not self.dbgate.bulk(
+                        "insert into FileChunks (fileId, pos, size, hash) "
+                        " select ?, pos, size, hash from base.FileChunks where fileId = ?", (fileId, base[1])):
+                    return False
+                self.nMD5Reused += 1
+        return True
 
-        if sql:
-            return self.dbgate.query(sql) is not None
+    def calcFolderStats(self):
+        """Calculates recursive totals of folders and saves them to 'FolderStats' table (previous rows are deleted).
+        The totals are summed bottom-up from the folder tree (one pass over files, no path matching).
+        Used by createImage(), call it for migrated images (sizes updated by calcMD5forFiles() are not counted).
 
+        Returns:
+            True or False.
+        """
+        parents = {}
+        stats = {}  # foId => [bytes, nfiles, nfolders, newestTime]
+        try:
+            for foId, parentId, mtime in self.dbgate.iterQuery("select foId, parentId, mtime from FolderTree"):
+                parents[foId] = parentId
+                stats[foId] = [0, 0, 0, mtime or 0]
+            for foId, nfiles, bytes_, wtime in self.dbgate.iterQuery("select foId, count(1), sum(fsize), max(wtime) "
+                                                                     " from Files group by foId"):
+                item = stats.get(foId)
+                if item is not None:
+                    item[0] += bytes_ or 0
+                    item[1] += nfiles
+                    item[3] = max(item[3], wtime or 0)
+        except sqlite3.Error, e:
+            logging.exception(e.args[0])
+            return False
+
+        # depth of folders (children are summed before parents)
+        depths = {}
+        for foId in parents:
+            chain = []
+            node = foId
+            while node in parents and node not in depths and len(chain) <= len(parents):
+                chain.append(node)
+                node = parents[node]
+            depth = depths.get(node, -1)
+            for node in reversed(chain):
+                depth += 1
+                depths[node] = depth
+
+        if self.dbgate.query("delete from FolderStats") is None:
+            return False
+        for foId in sorted(stats.keys(), key=depths.get, reverse=True):
+            item = stats[foId]
+            parent = stats.get(parents[foId])
+            if parent is not None and parents[foId] != foId:
+                parent[0] += item[0]
+                parent[1] += item[1]
+                parent[2] += item[2] + 1
+                parent[3] = max(parent[3], item[3])
+            if not self.dbgate.bulk("insert into FolderStats (foId, bytes, nfiles, nfolders, newestTime) "
+                                    " values (?, ?, ?, ?, ?)", tuple([foId] + item)):
+                return False
+
+        self.dbgate.trace('folder-stats-done', 'folders=%i' % len(stats))
         return True
 
-    def addFiles(self, curDirId, curDir, files):
-        """For internal usage.
+    def topFolders(self, n=10, orderBy='bytes', parentPath=None):
+        """Gets the largest folders by recursive totals (see calcFolderStats(), it is called if there are no totals).
+
+        Args:
+            n: Number of folders.
+            orderBy: 'bytes', 'nfiles', 'nfolders' or 'newestTime' (in descending order).
+            parentPath: Relative path of the folder ('/a/b/') to get its subfolders only, or None for all folders.
+
+        Returns:
+            List of (relative path, bytes, nfiles, nfolders, newestTime) or None if failed.
         """
-        sql = ''
-        qsz = 0
-        for fname in files:
-            fullName = curDir + fname
+        if orderBy not in ['bytes', 'nfiles', 'nfolders', 'newestTime']:
+            logging.error('topFolders, unknown orderBy "%s"' % orderBy)
+            return None
 
-            fsize = 0
+        # connect to database
+        if not self.openImage():
+            return None
+
+        q = self.dbgate.query("select (select count(1) from FolderStats), (select count(1) from FolderTree)")
+        if not q:
+            return None
+        if not q[0][0] and q[0][1]:
+            if not self.dbgate.beginBulk():
+                return None
             try:
-                fsize = os.path.getsize(fullName)
-            except OSError:
-                self.dbgate.trace('error', 'getsize() failed for file "%s"' % fullName)
+                if not self.calcFolderStats():
+                    return None
+            finally:
+                self.dbgate.endBulk()
+
+        try:
+            if parentPath is None:
+                rows = list(self.dbgate.iterQuery("select foId, bytes, nfiles, nfolders, newestTime from FolderStats "
+                                                  " order by %s desc limit ?" % orderBy, (n,)))
+            else:
+                parentId = self.findFolderId(parentPath)
+                if parentId is None:
+                    logging.error('topFolders, folder "%s" not found' % parentPath)
+                    return None
+                rows = list(self.dbgate.iterQuery("select st.foId, st.bytes, st.nfiles, st.nfolders, st.newestTime "
+                                                  " from FolderStats st join FolderTree ft on ft.foId = st.foId "
+                                                  " where ft.parentId = ? order by st.%s desc limit ?" % orderBy,
+                                                  (parentId, n)))
+            return [(self.getFolderPath(row[0]),) + tuple(row[1:]) for row in rows]
+        except sqlite3.Error, e:
+            logging.exception(e.args[0])
+            return None
+
+    def findFolderId(self, path_):
+        """Finds folder id by relative path ('/a/b/').
 
-            ctime, wtime = getFileTimes(fullName, gmt=False)  # not GMT
-            sql += (" union all " if sql else " insert into Files (foId, fname, fsize, ctime, wtime) ")
-            sql += " select %i, '%s', %i, '%s', '%s' " % (curDirId, fname.replace("'", "''"), fsize, ctime, wtime)
-            qsz += 1
+        Returns:
+            Folder id or None (not found).
 
-            # insert 100 rows at a time to prevent overflow ("too many terms in compound SELECT")
-            if qsz >= 100:
-                if self.dbgate.query(sql) is None:
-                    return False
-                sql = ''
-                qsz = 0
+        Raises:
+            sqlite3.Error: If some query failed.
+        """
+        q = list(self.dbgate.iterQuery("select foId from FolderTree where parentId is null"))
+        for name in path_.replace('\\', '/').strip('/').split('/'):
+            if not q or not name:
+                break
+            q = list(self.dbgate.iterQuery("select foId from FolderTree where parentId = ? and name = ?", (q[0][0], name)))
+        return q[0][0] if q else None
 
-        if sql:
-            return self.dbgate.query(sql) is not None
+    def getFolderPath(self, foId):
+        """Gets relative path of the folder ('/a/b/') by its id (walks up the folder tree).
 
-        return True
+        Returns:
+            Relative path or None (not found).
+
+        Raises:
+            sqlite3.Error: If the query failed.
+        """
+        q = list(self.dbgate.iterQuery("with recursive up (foId, parentId, name, depth) as ("
+                                       " select foId, parentId, name, 0 from FolderTree where foId = ?"
+                                       " union all"
+                                       " select ft.foId, ft.parentId, ft.name, up.depth + 1"
+                                       " from FolderTree ft join up on ft.foId = up.parentId where up.depth < 10000)"
+                                       " select name from up order by depth desc", (foId,)))
+        if not q:
+            return None
+        return '/' + ''.join([row[0] + '/' for row in q[1:]])
 
     def calcMD5forFiles(self, whereSql, addOnly):
-        """Calculates MD5 checksum for files.
+        """Calculates MD5 checksum for files (and other checksums from 'digests' in the same pass).
 
         Args:
             whereSql: A filter for files (for example, use "fname like '%'" to calculate MD5 for all files).
-            addOnly: If True, do not recalculate existing MD5 checksums (calculate MD5 for files without MD5).
+            addOnly: If True, do not recalculate existing MD5 checksums (calculate for files without MD5, digests
+                or chunks).
 
         Returns:
             True or False.
         """
 
         # connect to database
-        if not self.dbgate.openConn():
+        if not self.openImage():
             return False
 
         # load scan parameters from database
         if not self.loadScanParams():
             return False
 
-        self.dbgate.trace('calc-md5-start', 'where=[%s], add-only=%s' % (whereSql, str(addOnly)))
+        state = {'whereSql': whereSql, 'addOnly': addOnly, 'digests': self.digests,
+                 'chunkMinFileSize': self.chunkMinFileSize, 'startTime': nowNs(),
+                 'lastFileId': 0, 'counters': [0, 0, 0]}
+        return self.hashFiles(state)
+
+    def hashFiles(self, state):
+        """For internal usage.
+        Calculates checksums for files with fileId > state['lastFileId'] (in order of fileId),
+        saves checkpoints with the last saved fileId (see resume()).
+        """
+        whereSql = state['whereSql']
+        addOnly = state['addOnly']
 
-        # fetch timestamps of existing MD5 checksums
-        hasMD5 = {}
-        q0 = self.dbgate.query("select fileId, calcTime from FilesMD5")
-        if q0 is None:
-            self.dbgate.trace('error', 'select md5 timestamps failed')
+        extras = self.initHashAlgorithms()
+
+        if self.hashOrder not in ['fileId', 'inode', 'extent']:
+            logging.error('calcMD5forFiles, unknown hashOrder "%s"' % self.hashOrder)
             return False
-        for row in q0:
-            fileId = int(row[0])
-            hasMD5[fileId] = row[1]
-
-        # fetch the list of files to calculate MD5 checksums for
-        q = self.dbgate.query("select ff.fileId, ff.fsize, ff.fname, fo.path "
-                              " from Files ff, Folders fo where ff.foId = fo.foId "
-                              " and (" + whereSql + ")")
-        if q is None:
+
+        self.dbgate.trace('calc-md5-resume' if state['lastFileId'] else 'calc-md5-start',
+                          'where=[%s], add-only=%s, digests=%s, order=%s, chunk-min-size=%i' %
+                          (whereSql, str(addOnly), ','.join(self.hashAlgorithms), self.hashOrder, self.chunkMinFileSize))
+
+        # folder paths (the view 'Folders' walks the whole tree, so it is queried once)
+        if not self.loadFolderPaths():
+            self.dbgate.trace('error', 'select folders for md5 calc failed')
+            return False
+
+        # the files to calculate MD5 checksums for (by pages of fileId) with existing MD5 time and digests count
+        nDigestsSql = "0"
+        if extras:
+            nDigestsSql = ("(select count(1) from FilesDigests fd where fd.fileId = ff.fileId "
+                           " and fd.algorithm in (%s) and fd.digest is not null)" %
+                           ', '.join(["'%s'" % name for name in extras]))
+        hasChunksSql = "0"
+        if self.chunkMinFileSize > 0:
+            hasChunksSql = "exists (select 1 from FileChunks fc where fc.fileId = ff.fileId)"
+        rows = self.dbgate.iterKeyset("select ff.fileId, ff.fsize, ff.fname, fo.path, md.calcTime, " + nDigestsSql +
+                                      ", ff.ino, " + hasChunksSql + ", fl.dev, fl.nlink"
+                                      " from Files ff join temp.FolderPaths fo on ff.foId = fo.foId "
+                                      " left join FilesMD5 md on md.fileId = ff.fileId "
+                                      " left join FileLinks fl on fl.fileId = ff.fileId "
+                                      " where ff.fileId > ? and (" + whereSql + ") order by ff.fileId limit ?",
+                                      state['lastFileId'], self.pageRows)
+
+        # expected work for ETA (other digests are not counted)
+        if self.metrics is not None:
+            q = self.dbgate.query("select count(1), sum(ff.fsize) from Files ff join temp.FolderPaths fo on ff.foId = fo.foId "
+                                  " left join FilesMD5 md on md.fileId = ff.fileId where ff.fileId > %i and (%s)%s" %
+                                  (state['lastFileId'], whereSql, " and md.fileId is null" if addOnly else ""))
+            self.metrics.start('calc-md5', {'files': q[0][0], 'bytes': q[0][1] or 0} if q else None)
+            self.dbgate.metrics = self.metrics
+
+        # write results in large transactions (see GateSQLite.beginBulk())
+        if not self.dbgate.beginBulk():
+            return False
+        try:
+            self.checkpointTime = time.time()
+            self.nLinksReused = state.get('nLinksReused', 0)
+            nFiles, nHasMD5, nCalcMD5, bytes_, ms = self.calcMD5forRows(rows, len(extras), state)
+
+            # files before the checkpoint (resume), they are counted by the interrupted run
+            if state['lastFileId']:
+                q = self.dbgate.query("select count(1) from Files ff join temp.FolderPaths fo on ff.foId = fo.foId "
+                                      " left join FilesMD5 md on md.fileId = ff.fileId "
+                                      " left join FileLinks fl on fl.fileId = ff.fileId "
+                                      " where ff.fileId <= %i and (%s)" % (state['lastFileId'], whereSql))
+                nFiles += q[0][0] if q else 0
+            if not self.dbgate.bulk("delete from Checkpoints where name = ?", ('calc-md5',)):
+                self.dbgate.trace('error', 'delete checkpoint failed')
+        except sqlite3.Error, e:
+            logging.exception(e.args[0])
             self.dbgate.trace('error', 'select files for md5 calc failed')
             return False
+        finally:
+            self.dbgate.endBulk()
 
-        nFiles = len(q)
-        nHasMD5 = nCalcMD5 = 0
+        # calculate MD5 speed (MB/s, mebibytes per second, hashing and saving to database)
+        rate = float(bytes_) / MB / (ms / 1000.0) if ms > 0 else 0.0
 
-        bytes_ = 0
-        time1 = datetime.now()
+        self.dbgate.trace('calc-md5-done', 'files=%i, has-md5=%i, calc-md5=%i, links-reused=%i, rate=%.1fMB/s' %
+                          (nFiles, nHasMD5, nCalcMD5, self.nLinksReused, rate))
+        if self.throttle is not None:
+            self.dbgate.trace('io-throttle', self.throttle.getStats())
+        if self.metrics is not None:
+            self.metrics.finish()
 
-        for row in q:
-            fileId = int(row[0])
-            fsize = int(row[1])
-            fname = normpathEx(self.rootDir + row[3]) + row[2]
+        return True
 
-            if fileId in hasMD5.keys():
-                nHasMD5 += 1
-                if addOnly:
-                    continue
+    def loadFolderPaths(self):
+        """For internal usage.
+        Copies the view 'Folders' to 'temp.FolderPaths' table (the view walks the whole tree, join the table instead).
 
-            # check/update file size
-            fsize2 = 0
-            try:
-                fsize2 = os.path.getsize(fname)
-            except OSError:
-                self.dbgate.trace('error', 'getsize() failed for file "%s"' % fname)
-            if fsize2 != fsize:
-                self.dbgate.trace('fsize-changed', '[%s], %i => %i' % (fname, fsize, fsize2))
-                q2 = self.dbgate.query("update Files set fsize = %i where fileId = %i" % (fsize2, fileId))
-                if q2 is None:
-                    self.dbgate.trace('warning', 'fsize for "%s" not updated' % fname)
+        Returns:
+            True or False.
+        """
+        return self.dbgate.query("drop table if exists temp.FolderPaths") is not None and \
+            self.dbgate.query("create temp table FolderPaths (foId integer primary key, path text, "
+                              " scanTime integer, mtime integer)") is not None and \
+            self.dbgate.query("insert into temp.FolderPaths select foId, path, scanTime, mtime from Folders") is not None
 
-            # calculate MD5
-            md5 = calcFileMD5(fname) if fsize2 > 0 else calcMD5('')
+    def initHashAlgorithms(self):
+        """For internal usage.
+        Sets hashAlgorithms: MD5 and other checksums from 'digests' (not supported by this python are skipped).
 
-            timeStr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # not GMT
+        Returns:
+            List of other checksums.
+        """
+        extras = []
+        for name in self.digests:
+            if name == 'md5' or name in extras:
+                continue
+            if isDigestAvailable(name):
+                extras.append(name)
+            else:
+                self.dbgate.trace('warning', 'digest [%s] is not supported, skipped' % name)
+        self.hashAlgorithms = ['md5'] + extras
+        return extras
+
+    def calcMD5forRows(self, rows, nExtras, state):
+        """For internal usage.
 
-            logging.debug('%5i %8s   %s   %s' % (fileId, fsize, md5, fname))
+        Args:
+            rows: Iterable of (fileId, fsize, fname, path, MD5 calcTime or None, number of other digests, inode,
+                has chunks, device or None, number of links or None).
+            nExtras: Number of other digests to calculate.
+            state: The state of MD5 calculation (see hashFiles()).
 
-            # save MD5 to database
-            sql = "insert into FilesMD5 (fileId, md5, calcTime) select %i, '%s', '%s'" % (fileId, md5, timeStr)
-            if fileId in hasMD5.keys():
-                sql = "update FilesMD5 set md5 = '%s', calcTime = '%s' where fileId = %i" % (md5, timeStr, fileId)
-            if self.dbgate.query(sql) is None:
-                self.dbgate.trace('warning', 'md5 for "%s" not saved' % fname)
+        Returns:
+            Tuple (nFiles after the checkpoint, nHasMD5, nCalcMD5, bytes, milliseconds),
+            the other counters include the work before the checkpoint and the work done after it before resume().
+        """
+        nCalcMD5, bytes_ = state['counters'][1:]
+        counters = {'files': 0, 'has-md5': state['counters'][0], 'jobs': 0, 'calc-before': 0, 'bytes-before': 0}
+        time1 = datetime.now()
 
-            nCalcMD5 += 1
-            bytes_ += fsize2
+        links = {}  # (dev, inode) => [fileId of the hashed link, result or None, waiting links, links not seen yet]
+        linkKeys = {}  # fileId of the hashed link => (dev, inode)
+
+        def iterJobs():
+            """Files to calculate MD5 for: (fileId, fsize, fname, nHasMD5 up to this file, inode, checkpoint fileId),
+            read lazily. Other links of a hashed inode are not read, they get the result of the first link.
+            """
+            for row in rows:
+                counters['files'] += 1
+                if row[4] is not None:
+                    hasAll = row[5] == nExtras and (row[7] or not 0 < self.chunkMinFileSize <= row[1])
+                    if hasAll and row[4] >= state['startTime']:
+                        counters['calc-before'] += 1  # calculated by this pass after the checkpoint (before resume())
+                        counters['bytes-before'] += row[1] or 0
+                        continue
+                    counters['has-md5'] += 1
+                    if state['addOnly'] and hasAll:
+                        continue
+                counters['jobs'] += 1
+                fileId = int(row[0])
+                fname = normpathEx(self.rootDir + row[3]) + row[2]
+                key = self.getLinkKey(fname, row[8], row[6], row[9])
+                if key is not None:
+                    link = links.get(key)
+                    if link is not None:
+                        self.nLinksReused += 1
+                        link[3] -= 1
+                        if link[1] is None:
+                            link[2].append((fileId, int(row[1]), fname))  # saved with the result of the first link
+                        else:
+                            self.saveHashResult(fileId, int(row[1]), fname, link[1])
+                            if link[3] <= 0:
+                                closeHashResult(links.pop(key)[1])
+                        continue
+                    links[key] = [fileId, None, [], row[9] - 1]
+                    linkKeys[fileId] = key
+                yield fileId, int(row[1]), fname, counters['has-md5'], row[6] or 0, fileId
+
+        # calculate MD5 in worker threads, save results to database in this thread
+        # (the chunk spool of a result is closed when the result is saved for all the links)
+        try:
+            for job, res in self.imapHashJobs(iterJobs()):
+                fileId, fsize, fname, nHasBefore, ino, checkpointId = job
+                try:
+                    fsize2 = self.saveHashResult(fileId, fsize, fname, res)
+
+                    # the same checksums for other links of the inode (found before this result)
+                    key = linkKeys.pop(fileId, None)
+                    if key is not None:
+                        link = links[key]
+                        for waiting in link[2]:
+                            self.saveHashResult(waiting[0], waiting[1], waiting[2], res)
+                        link[2] = []
+                        if link[3] > 0:
+                            link[1] = res
+                            res = None  # kept for the links not seen yet
+                        else:
+                            del links[key]
+                finally:
+                    closeHashResult(res)
+
+                nCalcMD5 += 1
+                bytes_ += fsize2
+                if self.metrics is not None:
+                    self.metrics.add('files')
+                    self.metrics.add('bytes', fsize2)
+                    self.metrics.set('hash-queue',
+                                     counters['jobs'] - nCalcMD5 + state['counters'][1] - self.nLinksReused)
+                    self.metrics.tick()
+
+                # save checkpoint after the file (with all the results before it)
+                if checkpointId and self.isCheckpointTime():
+                    state['lastFileId'] = checkpointId
+                    state['counters'] = [nHasBefore, nCalcMD5, bytes_]
+                    state['nLinksReused'] = self.nLinksReused
+                    if not self.saveCheckpoint('calc-md5', state):
+                        self.dbgate.trace('warning', 'save checkpoint failed')
+        finally:
+            for link in links.values():
+                closeHashResult(link[1])
 
-        # calculate MD5 speed (MB/s, megabyte per second)
         dt = datetime.now() - time1
         ms = float(dt.seconds) * 1000.0 + float(dt.microseconds) / 1000.0
-        kb = float(bytes_) / 1024.0
-        rate = int(kb / ms)
-        # TODO(dan.dolbilov): Fix MD5 speed calculation (it's not MB/s and not MiB/s now).
 
-        self.dbgate.trace('calc-md5-done',
-                          'files=%i, has-md5=%i, calc-md5=%i, rate=%iMB/s' % (nFiles, nHasMD5, nCalcMD5, rate))
+        return counters['files'], counters['has-md5'], nCalcMD5 + counters['calc-before'], \
+            bytes_ + counters['bytes-before'], ms
+
+    def getLinkKey(self, fname, dev, ino, nlink):
+        """For internal usage.
+        Gets the key of the inode for a file with hard links, the file is checked by stat()
+        (the path could be replaced by other file after the scan).
+
+        Returns:
+            Tuple (dev, inode) or None (no hard links, changed or unknown).
+        """
+        if not nlink or nlink < 2 or not ino:
+            return None
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        if (st.st_dev, st.st_ino) != (dev, ino):
+            return None
+        return dev, ino
+
+    def saveHashResult(self, fileId, fsize, fname, res):
+        """For internal usage.
+        Saves checksums of the file (see hashFileJob()), updates the file size if it's changed.
+
+        Returns:
+            The file size.
+        """
+        fsize2, digests, chunks = res
+        md5 = digests['md5']
 
+        # check/update file size
+        if fsize2 is None:
+            self.dbgate.trace('error', 'getsize() failed for file "%s"' % fname)
+            fsize2 = 0
+        if fsize2 != fsize:
+            self.dbgate.trace('fsize-changed', '[%s], %i => %i' % (fname, fsize, fsize2))
+            if not self.dbgate.bulk("update Files set fsize = ? where fileId = ?", (fsize2, fileId)):
+                self.dbgate.trace('warning', 'fsize for "%s" not updated' % fname)
+
+        calcTime = nowNs()
+
+        logging.debug('%5i %8s   %s   %s' % (fileId, fsize, md5, fname))
+
+        # save MD5 to database
+        ok = self.dbgate.bulk("insert or replace into FilesMD5 (fileId, md5, calcTime) values (?, ?, ?)",
+                              (fileId, md5ToBlob(md5), calcTime))
+        for name in self.hashAlgorithms[1:]:
+            if not self.dbgate.bulk("insert or replace into FilesDigests (fileId, algorithm, digest, calcTime) "
+                                    " values (?, ?, ?, ?)", (fileId, name, md5ToBlob(digests[name]), calcTime)):
+                ok = False
+        if chunks is not None:
+            ok = self.saveChunks(fileId, chunks) and ok
+        if not ok:
+            self.dbgate.trace('warning', 'md5 for "%s" not saved' % fname)
+        return fsize2
+
+    def saveChunks(self, fileId, chunks):
+        """For internal usage.
+        Replaces chunks of the file (chunks are read from the spool by the rows of bulk inserts).
+        """
+        if not self.dbgate.bulk("delete from FileChunks where fileId = ?", (fileId,)):
+            return False
+        for pos, size, hash_ in chunks:
+            if not self.dbgate.bulk("insert into FileChunks (fileId, pos, size, hash) values (?, ?, ?, ?)",
+                                    (fileId, pos, size, sqlite3.Binary(hash_))):
+                return False
         return True
 
+    def imapHashJobs(self, jobs):
+        """For internal usage.
+        Calculates checksums for jobs (see calcMD5forRows()) in order of hashOrder.
+        For 'inode' and 'extent' order, the jobs are read by windows of pageRows,
+        only the last job of the window has checkpoint fileId (all the window is done after it).
+
+        Yields:
+            Tuple (job, hashFileJob(job)).
+        """
+        if self.hashOrder == 'fileId':
+            for item in imapThreaded(self.hashFileJob, jobs, self.hashWorkers):
+                yield item
+            return
+
+        jobs = iter(jobs)
+        while True:
+            window = list(itertools.islice(jobs, self.pageRows))
+            if not window:
+                return
+            keys = self.localityKeys(window)
+            small = sorted([(keys[i], job) for i, job in enumerate(window) if job[1] <= self.hashBigSize])
+            big = sorted([(keys[i], job) for i, job in enumerate(window) if job[1] > self.hashBigSize])
+            batches = [([job[:5] + (0,) for key, job in small], self.hashWorkers),
+                       ([job[:5] + (0,) for key, job in big], 1)]
+
+            # the last job of the window saves the checkpoint for the whole window
+            lastBatch = batches[1][0] if big else batches[0][0]
+            lastFileId, nHasMD5 = window[-1][0], window[-1][3]
+            job = lastBatch[-1]
+            lastBatch[-1] = job[:3] + (nHasMD5, job[4], lastFileId)
+
+            for batch, workers in batches:
+                for item in imapThreaded(self.hashFileJob, batch, workers):
+                    yield item
+
+    def localityKeys(self, jobs):
+        """For internal usage.
+        Gets sort keys of jobs for hashOrder: (0, physical offset, fname), (1, inode, fname)
+        or (2, 0, fname) (folder order, if inode is unknown).
+
+        Returns:
+            List of keys.
+        """
+        offsets = [None] * len(jobs)
+        if self.hashOrder == 'extent':
+            offsets = [res for job, res in imapThreaded(lambda job: getFilePhysicalOffset(job[2]), jobs,
+                                                        self.hashWorkers)]
+        keys = []
+        for job, offset in zip(jobs, offsets):
+            if offset is not None:
+                keys.append((0, offset, job[2]))
+            elif job[4]:
+                keys.append((1, job[4], job[2]))
+            else:
+                keys.append((2, 0, job[2]))
+        return keys
+
+    def hashFileJob(self, job):
+        """For internal usage (runs in worker threads, must not use database).
+
+        Returns:
+            Tuple (fsize or None if getsize() failed, dict of checksums (algorithm => hex string or ""),
+            ChunkSpool with chunks or None (see ChunkIndex.Chunker, None if the file is not chunked or can not be read)).
+        Chunks of large files are spilled to a temporary file as they are cut (memory does not depend on file size).
+        """
+        fname = job[2]
+        try:
+            fsize2 = os.path.getsize(fname)
+        except OSError:
+            return None, calcDigests('', self.hashAlgorithms), None
+        if fsize2 == 0:
+            return fsize2, calcDigests('', self.hashAlgorithms), None
+        spool = ChunkSpool() if 0 < self.chunkMinFileSize <= fsize2 else None
+        chunker = Chunker(onChunk=spool.add) if spool is not None else None
+        hashJob = partial(calcFileDigests, fname, self.hashAlgorithms, mmapSize=self.hashMmapSize,
+                          onData=chunker.update if chunker is not None else None, throttle=self.throttle)
+        if self.throttle is not None:
+            hashJob = partial(self.throttle.run, hashJob)
+        if self.metrics is not None:
+            digests = self.metrics.timed('hash', hashJob)
+        else:
+            digests = hashJob()
+        if not digests:
+            if spool is not None:
+                spool.close()
+            return fsize2, dict((name, "") for name in self.hashAlgorithms), None
+        if chunker is not None:
+            chunker.finish()
+        return fsize2, digests, spool
+
+
+def closeHashResult(res):
+    """For internal usage.
+    Deletes the chunk spool of the result (see FileSystemImage.hashFileJob()).
+    """
+    if res is not None and res[2] is not None:
+        res[2].close()
+
+
+def isScanFinished(dbname):
+    """Checks that createImage() of the image is finished (it has no 'scan' checkpoint, see resume()).
+
+    Returns:
+        True or False.
+    """
+    dbgate = GateSQLite(dbname)
+    if not os.path.exists(dbname) or not dbgate.open():
+        return False
+    q = dbgate.query("select count(1) from Checkpoints where name = 'scan'")
+    dbgate.close()
+    return bool(q) and not q[0][0]
+
 
 def test_FileSystemImage():
     """Simple test.
@@ -355,7 +1230,39 @@ def test_FileSystemImage():
     FileSystemImage('test_FileSystemImage.sqlite').calcMD5forFiles("fname like '%'", True)
 
 
+def test_incrementalScan():
+    """Simple test: the incremental scan gives the same folders and files as the full scan,
+    when an exclude rule is removed after the base image (the folders ignored in the base image are listed).
+    """
+    initLogs(u"test_FileSystemImage.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    tempDir = normpathEx(tempfile.mkdtemp())
+    rootDir = tempDir + 'root/'
+    for path_ in ['a/', '.svn/x/', 'b/.svn/']:
+        os.makedirs(rootDir + path_)
+        for fname in ['entries', 'data.txt']:
+            with open(rootDir + path_ + fname, 'w') as f:
+                f.write(path_ + fname)
+    params = {'RootDirWin32': rootDir, 'RootDirLinux': rootDir, 'StorageName': u'TEST'}
+
+    dbnames = [tempDir + 'base.sqlite', tempDir + 'full.sqlite', tempDir + 'incremental.sqlite']
+    FileSystemImage(dbnames[0]).createImage(dict(params, ExcludePath1=u'/.svn/'))
+    FileSystemImage(dbnames[1]).createImage(params)
+    FileSystemImage(dbnames[2]).createImage(params, dbnames[0])
+
+    totals = []
+    for dbname in dbnames[1:]:
+        dbgate = GateSQLite(dbname)
+        dbgate.open()
+        totals.append(dbgate.query("select (select count(1) from Folders), count(1) from Files")[0])
+        dbgate.close()
+    logging.info('full scan: dirs=%i, files=%i; incremental scan: dirs=%i, files=%i => %s' %
+                 (totals[0] + totals[1] + ('OK' if totals[0] == totals[1] else 'FAILED',)))
+    shutil.rmtree(tempDir)
+
+
 if __name__ == '__main__':
     """Run Simple test.
     """
     test_FileSystemImage()
+    test_incrementalScan()
@@ -7,7 +7,15 @@
 
 import logging
 import sqlite3
-from datetime import datetime
+import time
+import atexit
+import weakref
+import threading
+import Queue
+
+
+# connections with buffered trace records (flushed at exit, see GateSQLite.trace())
+openGates = weakref.WeakSet()
 
 
 class GateSQLite:
@@ -16,8 +24,26 @@ class GateSQLite:
     Attributes:
        dbname: The name of SQLite database file.
        con: SQLite database connection (sqlite3.Connection).
-       ntables: List of table names (need tables).
-       dtables: Dict of table schema sql strings (define tables).
+       ntables: List of table names (need tables, also indexes and views).
+       dtables: Dict of table schema sql strings (define tables, also indexes and views).
+       batchRows: Bulk mode, rows to buffer before they are written (consecutive rows of one statement are written
+          by one executemany(), the order of bulk() calls is kept).
+       commitRows: Bulk mode, commit the transaction every N written rows.
+       commitSeconds: Bulk mode, commit the transaction every T seconds.
+       cachedStatements: Size of sqlite3 prepared statements cache (bulk statements are reused from it).
+       traceLevel: Trace records with lower level are not saved to 'History' table (logged only).
+       traceLevels: Dict of trace levels (event => logging level), logging.INFO for other events.
+       traceBufferRows: Trace records are buffered and saved by batches of N rows (or at transaction boundaries).
+       traceBufferSeconds: Outside of bulk mode, buffered trace records are saved after T seconds (on the next trace).
+       traceRepeatLimit: Identical trace records (event, msg) are saved N times at most, the rest are counted.
+       traceRepeatKeys: Max number of distinct records to count repeats for.
+       metrics: ScanMetrics to collect 'db-write' and 'db-commit' latencies, or None.
+       writerQueueSize: Bulk mode, if > 0, buffered rows, trace records and commits are written by a writer thread
+          (the calling thread does not wait for SQLite), bulk() waits if N batches are queued already (backpressure).
+          Queries wait until the queued writes are done (so they see the data), except queries with sync=False
+          (see query()). 0 to write in the calling thread.
+       pragmas: List of (name, value) to set by open(), for example [('journal_mode', 'wal')].
+       bulkFailed: Bulk mode, a buffered write failed: the next flushes and queries fail, endBulk() rolls back.
     """
 
     def __init__(self, dbname):
@@ -29,6 +55,42 @@ class GateSQLite:
         self.ntables = []
         self.dtables = {}
 
+        self.batchRows = 1000
+        self.commitRows = 100000
+        self.commitSeconds = 10.0
+        self.cachedStatements = 100
+
+        # bulk mode state (see beginBulk())
+        self.inBulk = False
+        self.bulkRuns = []  # runs of consecutive rows of one statement, in order of bulk() calls: [statement, rows]
+        self.nPending = 0
+        self.bulkFailed = False  # a buffered write failed, the transaction has lost rows
+        self.transRows = 0
+        self.transTime = 0.0
+
+        self.traceLevel = logging.INFO
+        self.traceLevels = {'error': logging.ERROR, 'warning': logging.WARNING}
+        self.traceBufferRows = 1000
+        self.traceBufferSeconds = 1.0
+        self.traceRepeatLimit = 10
+        self.traceRepeatKeys = 10000
+
+        # buffered trace records (see trace())
+        self.traceRows = []  # list of (time, event, msg)
+        self.traceTime = 0.0
+        self.traceRepeats = {}  # (event, msg) => number of records
+
+        self.metrics = None
+
+        self.writerQueueSize = 0
+        self.pragmas = []
+
+        # writer thread state (see startWriter())
+        self.writer = None
+        self.writerQueue = None
+        self.writerSkip = False  # the writer failed or the transaction is rolled back, queued writes are dropped
+        self.conLock = threading.Lock()  # the writer thread and iterQuery() share the connection
+
         # database always has 'History' table for trace records
         self.ntables.append('History')
         self.defineTable('History', 'timestamp text, event text, msg text')
@@ -46,22 +108,74 @@ class GateSQLite:
         tableSql = "create table " + tableName + " (" + columnsStr + ")"
         self.dtables[tableName] = tableSql
 
+    def defineSql(self, name, createSql):
+        """Sets schema sql string for index or view (created by openConn() like tables).
+        """
+        self.dtables[name] = createSql
+
     def trace(self, event, msg):
         """Logs some message to logging and to 'History' table.
+        Records are buffered in memory and saved by batches: with bulk rows (in the same transaction),
+        by the next query(), when the buffer is full, by close() and at exit of the program.
+        Records below traceLevel are not saved, repeats of identical records over traceRepeatLimit are counted only.
         """
-        timeStr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # not GMT
-
-        if event == 'error':
-            logging.error(msg)
-        elif event == 'warning':
-            logging.warning(msg)
+        level = self.traceLevels.get(event, logging.INFO)
+        if level >= logging.WARNING:
+            logging.log(level, msg)
         else:
-            logging.info(event + ', ' + msg)
+            logging.log(level, event + ', ' + msg)
+
+        if level < self.traceLevel:
+            return
+
+        key = (event, msg)
+        n = self.traceRepeats.get(key, 0) + 1
+        self.traceRepeats[key] = n
+        if n > self.traceRepeatLimit:
+            return
+        if len(self.traceRepeats) > self.traceRepeatKeys:
+            self.flushRepeats()
+
+        now = time.time()
+        if not self.traceRows:
+            self.traceTime = now
+            openGates.add(self)
+        self.traceRows.append((now, event, msg))
+
+        if len(self.traceRows) >= self.traceBufferRows or \
+                (not self.inBulk and now - self.traceTime >= self.traceBufferSeconds):
+            self.flushTrace()
+
+    def flushTrace(self):
+        """Saves buffered trace records to 'History' table (in the current transaction for bulk mode).
 
-        v = " select '%s', '%s', '%s' " % (timeStr, event.replace("'", "''"), msg.replace("'", "''"))
-        q = self.query("insert into History (timestamp, event, msg) " + v)
-        if q is None:
-            pass  # TODO(dan.dolbilov): Handle query error.
+        Returns:
+            True or False.
+        """
+        if not self.traceRows or self.con is None:
+            return not self.traceRows
+        rows = [(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), event, msg)  # not GMT
+                for t, event, msg in self.traceRows]
+        self.traceRows = []
+        queryStr = "insert into History (timestamp, event, msg) values (?, ?, ?)"
+        if self.inBulk:
+            self.transRows += len(rows)
+            return self.writeRows(queryStr, rows)
+        if not self.execSql('begin'):
+            return False
+        if self.executeMany(queryStr, rows) is None:
+            self.execSql('rollback')
+            return False
+        return self.execSql('commit')
+
+    def flushRepeats(self):
+        """For internal usage.
+        Adds trace records with the number of suppressed repeats, resets repeat counters.
+        """
+        repeats = [(key, n) for key, n in self.traceRepeats.items() if n > self.traceRepeatLimit]
+        self.traceRepeats = {}
+        for (event, msg), n in sorted(repeats):
+            self.trace('trace-suppressed', '%i repeats of [%s] %s' % (n - self.traceRepeatLimit, event, msg))
 
     def openConn(self):
         """Connects to database and validates/creates database schema.
@@ -71,11 +185,12 @@ class GateSQLite:
         """
 
         # connect to database
-        logging.debug('sqlite3 open(%s)' % self.dbname)
-        if not self.open():
-            logging.error('sqlite3 open failed')
-            return False
-        logging.debug('sqlite3 open OK')
+        if self.con is None:
+            logging.debug('sqlite3 open(%s)' % self.dbname)
+            if not self.open():
+                logging.error('sqlite3 open failed')
+                return False
+            logging.debug('sqlite3 open OK')
 
         # validate database schema
         for tableName in self.ntables:
@@ -105,23 +220,351 @@ class GateSQLite:
                     return False
         return True
 
-    def query(self, queryStr):
+    def query(self, queryStr, params=(), sync=True):
         """Executes SQL query and fetches all rows of a query result.
+        In bulk mode the buffered rows are written first and the writer thread is waited for (so the query sees them).
+        Reads-your-writes is needed for queries of the tables written in the current bulk (the image tables)
+        and for all statements which modify data (they must be executed after the buffered writes).
+        Reads of the tables which the bulk does not write (an attached base image, temp tables filled before
+        the bulk) can be done with sync=False: buffered rows stay buffered, the writer thread is not waited for.
+
+        Args:
+            queryStr: SQL string.
+            params: Parameters for '?' placeholders.
+            sync: If False, the buffered writes are not written first (read-only queries, see above).
 
         Returns:
             List of rows or None.
         """
+        if sync and not self.syncWrites():
+            logging.error('query "%s" skipped, buffered writes failed' % queryStr)
+            return None
         try:
             logging.debug('query = "%s"' % queryStr)
-            cur = self.con.cursor()
-            cur.execute(queryStr)
-            rows = cur.fetchall()
+            with self.conLock:
+                cur = self.con.cursor()
+                cur.execute(queryStr, params)
+                rows = cur.fetchall()
             logging.debug("rowcount = " + str(len(rows)))
             return rows
         except sqlite3.Error, e:
             logging.exception(e.args[0])
             return None  # --- return []
 
+    def iterQuery(self, queryStr, params=(), arraysize=1000, sync=True):
+        """Executes SQL query and fetches rows of a query result by parts (fetchmany()).
+        Memory usage does not depend on the result size.
+        Do not modify the queried tables until the iteration is done.
+        Use sync=False for reads of tables which the current bulk does not write (see query()).
+
+        Yields:
+            Rows of a query result.
+
+        Raises:
+            sqlite3.Error: If the query failed.
+        """
+        if sync and not self.syncWrites():
+            raise sqlite3.Error('flush bulk rows failed')
+        logging.debug('iter query = "%s"' % queryStr)
+        with self.conLock:
+            cur = self.con.cursor()
+            cur.execute(queryStr, params)
+        while True:
+            with self.conLock:
+                rows = cur.fetchmany(arraysize)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+        cur.close()
+
+    def iterKeyset(self, queryStr, startKey=0, pageSize=1000):
+        """Executes SQL query by pages with keyset pagination (the query is executed again for every page).
+        Memory usage does not depend on the result size, no cursor is open between pages,
+        so the queried tables can be modified and the transaction can be committed during the iteration.
+
+        Args:
+            queryStr: SQL string with the key as the first column, '?' placeholders for the last key and
+                for the page size, for example "select fileId, ... where fileId > ? order by fileId limit ?".
+            startKey: The key to start after.
+            pageSize: Number of rows to fetch per query.
+
+        Yields:
+            Rows of a query result.
+
+        Raises:
+            sqlite3.Error: If the query failed.
+        """
+        lastKey = startKey
+        while True:
+            rows = list(self.iterQuery(queryStr, (lastKey, pageSize), pageSize))
+            for row in rows:
+                yield row
+            if len(rows) < pageSize:
+                break
+            lastKey = rows[-1][0]
+
+    def executeMany(self, queryStr, rows):
+        """Executes parameterized SQL query for every row of parameters.
+
+        Args:
+            queryStr: SQL string with '?' placeholders (compiled once, reused for all rows).
+            rows: List of parameter tuples.
+
+        Returns:
+            Number of modified rows or None.
+        """
+        try:
+            logging.debug('executemany = "%s", rows = %i' % (queryStr, len(rows)))
+            cur = self.con.cursor()
+            cur.executemany(queryStr, rows)
+            return cur.rowcount
+        except sqlite3.Error, e:
+            logging.exception(e.args[0])
+            return None
+
+    def beginBulk(self):
+        """Starts bulk mode: explicit transaction, buffered parameterized writes (see bulk()).
+        The transaction is committed every 'commitRows' rows or every 'commitSeconds' seconds.
+
+        Returns:
+            True or False.
+        """
+        if self.inBulk:
+            return True
+        if not self.execSql('begin'):
+            return False
+        self.inBulk = True
+        self.bulkFailed = False
+        self.transRows = 0
+        self.transTime = time.time()
+        if self.writerQueueSize > 0:
+            self.startWriter()
+        return True
+
+    def bulk(self, queryStr, row):
+        """Adds one row of parameters for parameterized SQL query (insert/update).
+        Rows are buffered and written in order of bulk() calls when 'batchRows' rows are buffered,
+        consecutive rows of one statement are written by one executemany().
+        Outside of bulk mode the row is written immediately.
+
+        Returns:
+            True or False.
+        """
+        if not self.inBulk:
+            return self.executeMany(queryStr, [row]) is not None
+
+        if self.bulkRuns and self.bulkRuns[-1][0] == queryStr:
+            self.bulkRuns[-1][1].append(row)
+        else:
+            self.bulkRuns.append([queryStr, [row]])
+        self.nPending += 1
+
+        if self.nPending >= self.batchRows:
+            if not self.flushBulk():
+                return False
+            if self.transRows >= self.commitRows or time.time() - self.transTime >= self.commitSeconds:
+                return self.commitBulk()
+        return True
+
+    def flushBulk(self):
+        """Writes all buffered rows (in order of bulk() calls) and trace records.
+        If a write fails, the rest of buffered rows are dropped and the next flushes fail too (see bulkFailed),
+        the transaction should be rolled back.
+
+        Returns:
+            True or False.
+        """
+        time1 = time.time() if self.metrics is not None else 0
+        ok = not self.bulkFailed
+        for queryStr, rows in self.bulkRuns:
+            if not ok:
+                break
+            ok = self.writeRows(queryStr, rows)
+            self.transRows += len(rows)
+        self.bulkRuns = []
+        ok = ok and self.flushTrace()
+        if not ok and self.inBulk:
+            self.bulkFailed = True
+        if self.metrics is not None and self.nPending and self.writer is None:
+            self.metrics.observe('db-write', time.time() - time1)
+        self.nPending = 0
+        return ok
+
+    def syncWrites(self):
+        """For internal usage.
+        Writes buffered rows and waits for the writer thread (before a query, so it sees the data).
+
+        Returns:
+            True or False (if some write failed).
+        """
+        if (self.nPending or self.traceRows or self.bulkFailed) and not self.flushBulk():
+            return False
+        self.waitWriter()
+        if self.inBulk and self.writerSkip:
+            self.bulkFailed = True
+            return False
+        return True
+
+    def commitBulk(self):
+        """Writes buffered rows and commits the current transaction (bulk mode continues).
+
+        Returns:
+            True or False.
+        """
+        if not self.flushBulk():
+            return False  # the transaction is not committed without the lost rows
+        if not self.writeSql('commit') or not self.writeSql('begin'):
+            return False
+        logging.debug('bulk commit, rows = %i' % self.transRows)
+        self.transRows = 0
+        self.transTime = time.time()
+        return True
+
+    def endBulk(self):
+        """Writes buffered rows, commits the transaction and stops bulk mode
+        (the transaction is rolled back if some write failed).
+
+        Returns:
+            True or False.
+        """
+        if not self.inBulk:
+            return True
+        self.flushRepeats()
+        ok = self.flushBulk() and self.writeSql('commit')
+        self.inBulk = False
+        self.bulkRuns = []
+        ok = self.stopWriter() and ok
+        if not ok:
+            logging.error('bulk write failed, the transaction is rolled back')
+            self.execSql('rollback')
+        self.bulkFailed = False
+        return ok
+
+    def rollbackBulk(self):
+        """Drops buffered rows, rolls back the current transaction and stops bulk mode.
+
+        Returns:
+            True or False.
+        """
+        if not self.inBulk:
+            return True
+        self.inBulk = False
+        self.bulkRuns = []
+        self.nPending = 0
+        self.bulkFailed = False
+        self.writerSkip = True  # queued writes are dropped
+        self.stopWriter()
+        return self.execSql('rollback')
+
+    def writeRows(self, queryStr, rows):
+        """For internal usage.
+        Writes rows by executemany() or queues them to the writer thread.
+        """
+        if self.writer is None:
+            return self.executeMany(queryStr, rows) is not None
+        self.writerQueue.put((queryStr, rows))
+        return not self.writerSkip
+
+    def writeSql(self, queryStr):
+        """For internal usage.
+        Executes SQL statement without parameters ('commit', 'begin') or queues it to the writer thread.
+        """
+        if self.writer is not None:
+            self.writerQueue.put((queryStr, None))
+            return not self.writerSkip
+        time1 = time.time()
+        if not self.execSql(queryStr):
+            return False
+        if self.metrics is not None and queryStr == 'commit':
+            self.metrics.observe('db-commit', time.time() - time1)
+        return True
+
+    def startWriter(self):
+        """For internal usage.
+        Starts the writer thread (bulk mode), it executes queued writes in order.
+        """
+        self.writerSkip = False
+        self.writerQueue = Queue.Queue(self.writerQueueSize)
+        self.writer = threading.Thread(target=self.runWriter, name='sqlite-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def stopWriter(self):
+        """For internal usage.
+        Waits until the queued writes are done and stops the writer thread.
+
+        Returns:
+            True or False (if some write failed).
+        """
+        if self.writer is None:
+            return True
+        self.writerQueue.put(None)
+        self.writer.join()
+        self.writer = None
+        self.writerQueue = None
+        ok = not self.writerSkip
+        self.writerSkip = False
+        return ok
+
+    def waitWriter(self):
+        """For internal usage.
+        Waits until the queued writes are done (the writer thread does not use the connection after it).
+        """
+        if self.writer is not None:
+            self.writerQueue.join()
+
+    def runWriter(self):
+        """For internal usage (runs in the writer thread).
+        """
+        queue = self.writerQueue
+        while True:
+            item = queue.get()
+            try:
+                if item is None:
+                    return
+                if self.writerSkip:
+                    continue
+                queryStr, rows = item
+                time1 = time.time()
+                try:
+                    with self.conLock:
+                        ok = self.execSql(queryStr) if rows is None else self.executeMany(queryStr, rows) is not None
+                except Exception, e:  # the thread must not die with items in the queue
+                    logging.exception(str(e))
+                    ok = False
+                if not ok:
+                    logging.error('writer thread, write failed, the next writes are dropped')
+                    self.writerSkip = True
+                elif self.metrics is not None and (rows is not None or queryStr == 'commit'):
+                    self.metrics.observe('db-write' if rows is not None else 'db-commit', time.time() - time1)
+            finally:
+                queue.task_done()
+
+    def attach(self, dbname, alias):
+        """Attaches another database file, its tables are available as 'alias.TableName'.
+
+        Returns:
+            True or False.
+        """
+        self.waitWriter()
+        try:
+            self.con.execute("attach database ? as %s" % alias, (dbname,))
+            return True
+        except sqlite3.Error, e:
+            logging.exception(e.args[0])
+            return False
+
+    def execSql(self, queryStr):
+        """For internal usage.
+        """
+        try:
+            self.con.execute(queryStr)
+            return True
+        except sqlite3.Error, e:
+            logging.exception(e.args[0])
+            return False
+
     def open(self):
         """Opens sqlite3 connection.
 
@@ -129,18 +572,49 @@ class GateSQLite:
             True or False.
         """
         try:
-            self.con = sqlite3.connect(self.dbname)
+            # the writer thread uses the connection too (one thread at a time, see startWriter())
+            self.con = sqlite3.connect(self.dbname, cached_statements=self.cachedStatements, check_same_thread=False)
             self.con.text_factory = unicode  # --- str
             self.con.isolation_level = None
+            for name, value in self.pragmas:
+                self.con.execute("pragma %s = %s" % (name, value))
             return True
         except sqlite3.Error, e:
             logging.exception(e.args[0])
             return False
 
     def close(self):
-        """Closes sqlite3 connection.
+        """Closes sqlite3 connection (buffered trace records are saved).
         """
+        if self.inBulk:
+            self.endBulk()
+        self.flushRepeats()
+        self.flushTrace()
         try:
             self.con.close()
         except sqlite3.Error, e:
             logging.exception(e.args[0])
+
+    def __del__(self):
+        """Saves buffered trace records if the object is dropped without close().
+        """
+        try:
+            if self.traceRows and not self.inBulk:
+                self.flushTrace()
+        except Exception:
+            pass
+
+
+@atexit.register
+def flushAtExit():
+    """Saves buffered trace records of all connections at exit of the program (also after unhandled exception).
+    Unfinished bulk transactions are rolled back.
+    """
+    for gate in list(openGates):
+        try:
+            if gate.inBulk:
+                gate.rollbackBulk()  # buffered trace records are kept
+            gate.flushRepeats()
+            gate.flushTrace()
+        except Exception, e:
+            logging.exception(str(e))
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    ImageColumns.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import os
+import time
+import itertools
+import sqlite3
+from helpers import initLogs
+from GateSQLite import GateSQLite
+from ImageSchema import SCHEMA_VERSION, getSchemaVersion, blobToMD5
+
+try:
+    import numpy as np  # "pip install numpy"
+except ImportError:
+    np = None
+
+
+NO_MD5 = '\0' * 16  # MD5 of files without checksum in md5 column
+DAY_NS = 24 * 3600 * 1000000000
+
+
+class ImageColumns:
+    """Columnar in-memory copy of the image for vectorized analytics (NumPy arrays, one element per file).
+    'Files' with MD5 checksums is read by pages of pageRows (keyset pagination), the arrays are allocated once
+    by the number of files, so memory usage is ~70 bytes per file plus unique names
+    (names and extensions are interned: the arrays keep indexes to lists of unique strings).
+    Queries (histograms, top-N, groups of sizes and checksums) run over whole arrays without python loops per file.
+
+    Attributes:
+       dbgate: GateSQLite connection to the image.
+       pageRows: Number of files to fetch per query.
+       count: Number of files loaded.
+       fileId: Array of file ids (int64).
+       foId: Array of folder ids (int32).
+       fsize: Array of file sizes (int64).
+       ctime: Array of creation times (int64 nanoseconds since epoch).
+       wtime: Array of write times (int64 nanoseconds since epoch).
+       ino: Array of inodes (int64).
+       nameIdx: Array of indexes in names (int32).
+       extIdx: Array of indexes in exts (int32).
+       md5: Array of MD5 checksums ('S16', 16 zero bytes if MD5 is not calculated).
+       hasMD5: Array of flags (bool).
+       names: List of unique file names.
+       exts: List of unique extensions (lower case, '' for names without extension).
+       folderIds: Array of folder ids (int32, sorted).
+       folderPaths: List of folder paths (in order of folderIds).
+    """
+
+    def __init__(self, dbname):
+        """Inits ImageColumns object with database file name of the image.
+        """
+        self.dbgate = GateSQLite(dbname)
+        self.pageRows = 100000
+        self.count = 0
+        self.names = []
+        self.exts = []
+        self.folderPaths = []
+
+    def open(self):
+        """Opens the image.
+
+        Returns:
+            True or False.
+        """
+        if np is None:
+            logging.error('numpy is not installed, "pip install numpy"')
+            return False
+        if not os.path.exists(self.dbgate.dbname):
+            logging.error('image "%s" not found' % self.dbgate.dbname)
+            return False
+        if self.dbgate.con is None and not self.dbgate.open():
+            return False
+        version = getSchemaVersion(self.dbgate)
+        if version != SCHEMA_VERSION:
+            logging.error('image "%s" has schema version %s, use ImageSchema.migrateImage()' %
+                          (self.dbgate.dbname, str(version)))
+            return False
+        return True
+
+    def load(self):
+        """Loads files and folders of the image to arrays.
+
+        Returns:
+            True or False.
+        """
+        if not self.open():
+            return False
+        time1 = time.time()
+
+        q = self.dbgate.query("select count(1) from Files")
+        folders = self.dbgate.query("select foId, path from Folders order by foId")
+        if not q or folders is None:
+            logging.error('load files of image "%s" failed' % self.dbgate.dbname)
+            return False
+        n = q[0][0]
+
+        self.folderIds = np.array([row[0] for row in folders], dtype=np.int32)
+        self.folderPaths = [row[1] for row in folders]
+
+        self.fileId = np.zeros(n, dtype=np.int64)
+        self.foId = np.zeros(n, dtype=np.int32)
+        self.fsize = np.zeros(n, dtype=np.int64)
+        self.ctime = np.zeros(n, dtype=np.int64)
+        self.wtime = np.zeros(n, dtype=np.int64)
+        self.ino = np.zeros(n, dtype=np.int64)
+        self.nameIdx = np.zeros(n, dtype=np.int32)
+        self.md5 = np.zeros(n, dtype='S16')
+
+        # the files are read by pages, every page is converted to arrays at once
+        nameIds = {}  # name => index in names
+        rows = self.dbgate.iterKeyset("select ff.fileId, ff.foId, ff.fsize, ff.ctime, ff.wtime, ff.ino, ff.fname, md.md5"
+                                      " from Files ff left join FilesMD5 md on md.fileId = ff.fileId"
+                                      " where ff.fileId > ? order by ff.fileId limit ?", 0, self.pageRows)
+        pos = 0
+        try:
+            while pos < n:
+                page = list(itertools.islice(rows, min(self.pageRows, n - pos)))
+                if not page:
+                    break
+                end = pos + len(page)
+                cols = zip(*page)
+                self.fileId[pos:end] = cols[0]
+                self.foId[pos:end] = cols[1]
+                self.fsize[pos:end] = [v or 0 for v in cols[2]]
+                self.ctime[pos:end] = [v or 0 for v in cols[3]]
+                self.wtime[pos:end] = [v or 0 for v in cols[4]]
+                self.ino[pos:end] = [v or 0 for v in cols[5]]
+                self.nameIdx[pos:end] = [nameIds.setdefault(name, len(nameIds)) for name in cols[6]]
+                self.md5[pos:end] = np.frombuffer(''.join([str(v) if v is not None else NO_MD5 for v in cols[7]]),
+                                                  dtype='S16')
+                pos = end
+        except sqlite3.Error, e:
+            logging.exception(e.args[0])
+            return False
+        if pos < n:  # the image is modified by other process (files added after count are not loaded)
+            for name in ['fileId', 'foId', 'fsize', 'ctime', 'wtime', 'ino', 'nameIdx', 'md5']:
+                setattr(self, name, getattr(self, name)[:pos].copy())
+        self.count = pos
+
+        self.names = [None] * len(nameIds)
+        for name, i in nameIds.iteritems():
+            self.names[i] = name
+        self.hasMD5 = self.md5 != NO_MD5
+
+        # extensions of unique names (a name is checked once)
+        extIds = {}
+        extOfName = np.array([extIds.setdefault(getExtension(name), len(extIds)) for name in self.names],
+                             dtype=np.int32)
+        self.exts = [None] * len(extIds)
+        for ext, i in extIds.iteritems():
+            self.exts[i] = ext
+        self.extIdx = extOfName[self.nameIdx] if len(extOfName) else np.zeros(0, dtype=np.int32)
+
+        logging.info('image "%s" loaded, files=%i, names=%i, folders=%i, %.1fMB, %.1fs' %
+                     (self.dbgate.dbname, self.count, len(self.names), len(self.folderPaths),
+                      self.getArraysSize() / 1048576.0, time.time() - time1))
+        return True
+
+    def getArraysSize(self):
+        """Gets memory size of arrays (without lists of names and paths).
+
+        Returns:
+            Number of bytes.
+        """
+        return sum([getattr(self, name).nbytes for name in ['fileId', 'foId', 'fsize', 'ctime', 'wtime', 'ino',
+                                                             'nameIdx', 'extIdx', 'md5', 'hasMD5', 'folderIds']])
+
+    def getFilePath(self, i):
+        """Gets path + fname of the file by its index in arrays.
+
+        Returns:
+            String.
+        """
+        k = np.searchsorted(self.folderIds, self.foId[i])
+        return self.folderPaths[k] + self.names[self.nameIdx[i]]
+
+    def largestFiles(self, n=10):
+        """Finds the largest files.
+
+        Returns:
+            List of (path + fname, fsize).
+        """
+        n = min(n, self.count)
+        if n <= 0:
+            return []
+        top = np.argpartition(-self.fsize, n - 1)[:n]
+        top = top[np.argsort(-self.fsize[top], kind='mergesort')]
+        return [(self.getFilePath(i), int(self.fsize[i])) for i in top]
+
+    def sizeHistogram(self):
+        """Counts files by power of 2 buckets of size.
+
+        Returns:
+            List of (min size of the bucket: 0, 1, 2, 4, 8..., files, bytes) for non-empty buckets.
+        """
+        exponent = np.frexp(self.fsize.astype(np.float64))[1]  # 0 for empty files, k for [2^(k-1), 2^k)
+        files = np.bincount(exponent)
+        bytes_ = np.bincount(exponent, weights=self.fsize)
+        return [(2 ** (k - 1) if k else 0, int(files[k]), int(bytes_[k])) for k in np.nonzero(files)[0]]
+
+    def ageHistogram(self, days=(1, 7, 30, 90, 365, 3 * 365, 10 * 365), now=None):
+        """Counts files by age (time since the last write).
+
+        Args:
+            days: Upper bounds of buckets (ascending).
+            now: The time to count age from (nanoseconds since epoch), default is the current time.
+
+        Returns:
+            List of (max age in days or None for the last bucket, files, bytes).
+        """
+        now = now if now is not None else int(time.time() * 1000000000)
+        bucket = np.searchsorted(np.array(days, dtype=np.int64) * DAY_NS, now - self.wtime, side='right')
+        files = np.bincount(bucket, minlength=len(days) + 1)
+        bytes_ = np.bincount(bucket, weights=self.fsize, minlength=len(days) + 1)
+        return [(bound, int(files[k]), int(bytes_[k])) for k, bound in enumerate(list(days) + [None])]
+
+    def extensionTotals(self, n=20, orderBy='bytes'):
+        """Counts files and bytes by extension.
+
+        Args:
+            n: Max number of extensions.
+            orderBy: 'bytes' or 'files'.
+
+        Returns:
+            List of (extension, files, bytes).
+        """
+        files = np.bincount(self.extIdx, minlength=len(self.exts))
+        bytes_ = np.bincount(self.extIdx, weights=self.fsize, minlength=len(self.exts))
+        top = np.argsort(-(bytes_ if orderBy == 'bytes' else files), kind='mergesort')[:n]
+        return [(self.exts[k], int(files[k]), int(bytes_[k])) for k in top]
+
+    def sizeGroups(self, n=20, minSize=1):
+        """Finds sizes shared by several files (candidates for duplicates, MD5 is not needed).
+
+        Returns:
+            List of (fsize, files, wasted bytes = fsize * (files - 1)), the most wasted first.
+        """
+        sizes, counts = np.unique(self.fsize[self.fsize >= minSize], return_counts=True)
+        shared = counts > 1
+        sizes, counts = sizes[shared], counts[shared]
+        wasted = sizes * (counts - 1)
+        top = np.argsort(-wasted, kind='mergesort')[:n]
+        return [(int(sizes[k]), int(counts[k]), int(wasted[k])) for k in top]
+
+    def duplicateGroups(self, n=20, minSize=1):
+        """Finds groups of files with the same MD5 checksum.
+
+        Returns:
+            List of (MD5 hex string in uppercase, fsize, files, wasted bytes, list of path + fname), the most wasted first.
+        """
+        index = np.nonzero(self.hasMD5 & (self.fsize >= minSize))[0]
+        digests, first, inverse, counts = np.unique(self.md5[index], return_index=True, return_inverse=True,
+                                                    return_counts=True)
+        sizes = self.fsize[index[first]]
+        wasted = np.where(counts > 1, sizes * (counts - 1), 0)
+        top = [k for k in np.argsort(-wasted, kind='mergesort')[:n] if counts[k] > 1]
+
+        groups = []
+        for k in top:
+            files = index[inverse == k]
+            groups.append((blobToMD5(self.md5[files[0]].ljust(16, '\0')), int(sizes[k]), int(counts[k]),
+                           int(wasted[k]), sorted([self.getFilePath(i) for i in files])))
+        return groups
+
+
+def getExtension(fname):
+    """Gets extension of the file name in lower case ('' for names without extension and for '.name').
+
+    Returns:
+        String.
+    """
+    base, dot, ext = fname.rpartition('.')
+    return ext.lower() if base else ''
+
+
+def test_ImageColumns():
+    """Simple test.
+    """
+    initLogs(u"test_ImageColumns.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    columns = ImageColumns('test_FileSystemImage.sqlite')
+    if not columns.load():
+        return
+    for name, rows in [('largest', columns.largestFiles()), ('sizes', columns.sizeHistogram()),
+                       ('ages', columns.ageHistogram()), ('extensions', columns.extensionTotals()),
+                       ('size groups', columns.sizeGroups()), ('duplicates', columns.duplicateGroups())]:
+        logging.info('%s: %s' % (name, str(rows)))
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_ImageColumns()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    ImageSchema.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import sqlite3
+import binascii
+import time
+from helpers import initLogs
+from GateSQLite import GateSQLite
+
+
+# Compact schema of SQLite image (version 2):
+#   timestamps are integer nanoseconds since epoch (UTC),
+#   MD5 checksums are 16-byte BLOBs,
+#   folders are stored as (parentId, name), view 'Folders' gives (foId, path, scanTime, mtime) as before,
+#   other checksums (sha256, ...) are stored in 'FilesDigests' (fileId, algorithm, digest, calcTime),
+#   'Checkpoints' (name, state, saveTime) keeps the state of unfinished scan/MD5 calculation (JSON),
+#   'FolderStats' (foId, bytes, nfiles, nfolders, newestTime) has recursive totals of folders (by the end of scan),
+#   'FileChunks' (fileId, pos, size, hash) has content-defined chunks of large files (optional, MD5 of chunks),
+#   'FileLinks' (fileId, dev, nlink) has device and number of links of files with hard links (nlink > 1),
+#   the inode is in 'Files' (files with one link can not share the inode, so most files have no row).
+# Version 1 (old images): text timestamps (local time), hex MD5 strings, 'Folders' table with paths.
+SCHEMA_VERSION = 2
+
+# tables of the image
+IMAGE_TABLES = ['FolderTree', 'Files', 'FilesMD5', 'FilesDigests', 'ScanParams', 'Checkpoints', 'FolderStats',
+                'FileChunks', 'FileLinks']
+
+# tables, indexes and views of the image (in order of creation)
+IMAGE_OBJECTS = IMAGE_TABLES + ['FolderTreeParent', 'FilesFoId', 'FilesMD5md5', 'FilesDigestsDigest', 'FolderStatsBytes',
+                                 'FileChunksHash', 'Folders']
+
+# pragmas of the image connection (see GateSQLite.open()): WAL journal, no fsync per commit (only by checkpoints),
+# 64MB page cache; page_size is used for new images only
+IMAGE_PRAGMAS = [('page_size', 4096), ('journal_mode', 'wal'), ('synchronous', 'normal'), ('cache_size', -65536)]
+
+FOLDERS_VIEW = ("create view Folders as with recursive fp (foId, path, scanTime, mtime) as ("
+                " select foId, '/', scanTime, mtime from FolderTree where parentId is null"
+                " union all"
+                " select ft.foId, fp.path || ft.name || '/', ft.scanTime, ft.mtime"
+                " from FolderTree ft join fp on ft.parentId = fp.foId)"
+                " select foId, path, scanTime, mtime from fp")
+
+
+def defineImageTables(dbgate):
+    """Defines tables, indexes and views of the image for GateSQLite (see GateSQLite.openConn()).
+    """
+    dbgate.defineTable('FolderTree', 'foId integer primary key, parentId integer, name text, '
+                                     'scanTime integer, mtime integer')
+    dbgate.defineTable('Files', 'fileId integer primary key, foId integer, fname text, '
+                                'fsize integer, ctime integer, wtime integer, ino integer')
+    dbgate.defineTable('FilesMD5', 'fileId integer primary key, md5 blob, calcTime integer')
+    dbgate.defineTable('FilesDigests', 'fileId integer, algorithm text, digest blob, calcTime integer, '
+                                       'primary key (fileId, algorithm)')
+    dbgate.defineTable('ScanParams', 'name text, value text')
+    dbgate.defineTable('Checkpoints', 'name text primary key, state text, saveTime integer')
+    dbgate.defineTable('FolderStats', 'foId integer primary key, bytes integer, nfiles integer, nfolders integer, '
+                                      'newestTime integer')
+    dbgate.defineTable('FileChunks', 'fileId integer, pos integer, size integer, hash blob, primary key (fileId, pos)')
+    dbgate.defineTable('FileLinks', 'fileId integer primary key, dev integer, nlink integer')
+    dbgate.defineSql('FolderTreeParent', 'create index FolderTreeParent on FolderTree (parentId, name)')
+    dbgate.defineSql('FilesFoId', 'create index FilesFoId on Files (foId)')
+    dbgate.defineSql('FilesMD5md5', 'create index FilesMD5md5 on FilesMD5 (md5)')
+    dbgate.defineSql('FilesDigestsDigest', 'create index FilesDigestsDigest on FilesDigests (digest)')
+    dbgate.defineSql('FolderStatsBytes', 'create index FolderStatsBytes on FolderStats (bytes)')
+    dbgate.defineSql('FileChunksHash', 'create index FileChunksHash on FileChunks (hash)')
+    dbgate.defineSql('Folders', FOLDERS_VIEW)
+
+
+def getSchemaVersion(dbgate):
+    """Gets schema version of the image (the connection must be open).
+
+    Returns:
+        0 for empty database, 1 for old images, SCHEMA_VERSION for compact images, None if failed.
+    """
+    q = dbgate.query("pragma user_version")
+    if not q:
+        return None
+    if q[0][0]:
+        return q[0][0]
+    q = dbgate.query("select count(1) from sqlite_master where type = 'table' and name = 'Folders'")
+    if not q:
+        return None
+    return 1 if q[0][0] else 0
+
+
+def setSchemaVersion(dbgate, version=SCHEMA_VERSION):
+    """Sets schema version of the image.
+
+    Returns:
+        True or False.
+    """
+    return dbgate.query("pragma user_version = %i" % version) is not None
+
+
+def nowNs():
+    """Current time for the image (integer nanoseconds since epoch).
+    """
+    return int(time.time() * 1000000000)
+
+
+def fileTimesNs(st):
+    """Gets timestamps of file from stat info for the image.
+
+    Returns:
+        Tuple of two integers (creation time, modification time) in nanoseconds since epoch, (0, 0) if st is None.
+    """
+    if st is None:
+        return 0, 0
+    if hasattr(st, 'st_mtime_ns'):
+        return st.st_ctime_ns, st.st_mtime_ns
+    return int(st.st_ctime * 1000000000), int(st.st_mtime * 1000000000)
+
+
+def md5ToBlob(md5):
+    """Converts hex string MD5 checksum (or other digest, see helpers.calcFileDigests()) to BLOB for the image.
+
+    Returns:
+        sqlite3.Binary or None (if md5 is empty).
+    """
+    return sqlite3.Binary(binascii.unhexlify(md5)) if md5 else None
+
+
+def blobToMD5(blob):
+    """Converts BLOB MD5 checksum from the image to hex string (the same as helpers.calcFileMD5() returns).
+
+    Returns:
+        Hex string in uppercase or "".
+    """
+    return binascii.hexlify(blob).upper() if blob else ""
+
+
+def migrateImage(dbname):
+    """Converts old image (schema version 1) to compact schema (in place).
+    Folders get parentId/name, timestamps are converted from local time text, MD5 checksums from hex strings.
+    Note: text timestamps are converted with the time zone of this computer (it must be the same as for the scan).
+
+    Returns:
+        True or False.
+    """
+    dbgate = GateSQLite(dbname)
+    if not dbgate.open():
+        return False
+
+    version = getSchemaVersion(dbgate)
+    if version == SCHEMA_VERSION:
+        logging.info('image "%s" has schema version %i already' % (dbname, version))
+        return True
+    if version != 1:
+        logging.error('image "%s" can not be migrated, schema version = %s' % (dbname, str(version)))
+        return False
+
+    # old images may have no Folders.mtime, Files.ino columns
+    foCols = [row[1] for row in dbgate.query("pragma table_info(Folders)") or []]
+    ffCols = [row[1] for row in dbgate.query("pragma table_info(Files)") or []]
+
+    dbgate.needTables(list(IMAGE_OBJECTS))
+    defineImageTables(dbgate)
+
+    # convert in one transaction (old tables stay as is if something failed)
+    dbgate.commitRows = dbgate.commitSeconds = float('inf')
+    if not dbgate.beginBulk():
+        return False
+    try:
+        # keep old tables until the data is converted
+        for tableName in ['Folders', 'Files', 'FilesMD5']:
+            if dbgate.query("alter table %s rename to %sV1" % (tableName, tableName)) is None:
+                raise sqlite3.Error('rename table %s failed' % tableName)
+        if not dbgate.openConn():
+            raise sqlite3.Error('create tables failed')
+
+        # folders: path => (parentId, name)
+        localNs = "strftime('%%s', %s, 'utc') * 1000000000"  # local time text => nanoseconds since epoch (UTC)
+        q = dbgate.query("select foId, path, %s, %s from FoldersV1 order by foId" %
+                         (localNs % 'scanTime', localNs % 'mtime' if 'mtime' in foCols else 'null'))
+        if q is None:
+            raise sqlite3.Error('select folders failed')
+        folderIds = dict((row[1], row[0]) for row in q)
+        for foId, path_, scanTime, mtime in q:
+            parentId, name = None, ''
+            if path_ != '/':
+                parent = path_[:path_.rstrip('/').rfind('/') + 1]
+                parentId, name = folderIds.get(parent, folderIds.get('/')), path_[len(parent):-1]
+            dbgate.bulk("insert into FolderTree (foId, parentId, name, scanTime, mtime) values (?, ?, ?, ?, ?)",
+                        (foId, parentId, name, scanTime, mtime))
+        folderIds = q = None
+
+        # files
+        if dbgate.query("insert into Files (fileId, foId, fname, fsize, ctime, wtime, ino) "
+                        " select fileId, foId, fname, fsize, %s, %s, %s from FilesV1" %
+                        (localNs % 'ctime', localNs % 'wtime', 'ino' if 'ino' in ffCols else 'null')) is None:
+            raise sqlite3.Error('convert files failed')
+
+        # MD5 checksums
+        for fileId, md5, calcTime in dbgate.iterQuery("select fileId, md5, %s from FilesMD5V1" % (localNs % 'calcTime')):
+            dbgate.bulk("insert into FilesMD5 (fileId, md5, calcTime) values (?, ?, ?)",
+                        (fileId, md5ToBlob(md5), calcTime))
+        dbgate.flushBulk()
+
+        for tableName in ['Folders', 'Files', 'FilesMD5']:
+            if dbgate.query("drop table %sV1" % tableName) is None:
+                raise sqlite3.Error('drop table %sV1 failed' % tableName)
+        if not setSchemaVersion(dbgate):
+            raise sqlite3.Error('set schema version failed')
+    except (sqlite3.Error, TypeError, binascii.Error), e:
+        logging.exception(str(e))
+        dbgate.rollbackBulk()
+        return False
+
+    dbgate.trace('migrate-image-done', 'schema version %i => %i' % (version, SCHEMA_VERSION))
+    if not dbgate.endBulk():
+        return False
+
+    dbgate.query("vacuum")  # give back the space of old tables
+    dbgate.close()
+    return True
+
+
+def test_migrateImage():
+    """Simple test.
+    """
+    initLogs(u"test_ImageSchema.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    migrateImage('test_FileSystemImage.sqlite')
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_migrateImage()
@@ -0,0 +1,811 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    ImageWatcher.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import sqlite3
+import sys
+import os
+import time
+import shutil
+import tempfile
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from helpers import initLogs, normpathEx, calcFileMD5
+from DirWalker import listDir, listNames
+from FileSystemImage import FileSystemImage
+from ImageSchema import nowNs, fileTimesNs
+
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+# events of the folder entries (the folder itself is watched by its parent)
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+# struct inotify_event (wd, mask, cookie, len), followed by the name (len bytes, padded by zeros)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+FS_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+
+
+class Inotify:
+    """Linux inotify(7) by ctypes (no extra packages): watches of folders, events are read by readEvents().
+
+    Attributes:
+       fd: inotify file descriptor or -1.
+    """
+
+    def __init__(self):
+        """Inits Inotify object (see open()).
+        """
+        self.fd = -1
+        self.libc = None
+
+    def open(self):
+        """Creates inotify instance.
+
+        Returns:
+            True or False (inotify is not available).
+        """
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError), e:
+            logging.error('inotify is not available, %s' % str(e))
+            return False
+        if self.fd < 0:
+            logging.error('inotify_init1 failed, %s' % os.strerror(ctypes.get_errno()))
+            return False
+        return True
+
+    def close(self):
+        """Closes inotify instance (all watches are removed).
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def addWatch(self, path_, mask=IN_WATCH_MASK):
+        """Adds a watch of the folder.
+
+        Returns:
+            Tuple (watch descriptor or -1, errno).
+        """
+        if isinstance(path_, unicode):
+            try:
+                path_ = path_.encode(FS_ENCODING)
+            except UnicodeEncodeError:
+                return -1, errno.EILSEQ
+        wd = self.libc.inotify_add_watch(self.fd, path_, mask)
+        return wd, ctypes.get_errno() if wd < 0 else 0
+
+    def rmWatch(self, wd):
+        """Removes the watch (IN_IGNORED event follows).
+        """
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def readEvents(self, timeout):
+        """Waits up to timeout seconds for events and reads the available ones.
+
+        Returns:
+            List of (watch descriptor, mask, cookie, name), name is '' for events of the folder itself.
+        """
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return []
+            data = os.read(self.fd, 64 * 1024)
+        except (select.error, OSError), e:
+            if e.args[0] != errno.EINTR:
+                logging.error('inotify read failed, %s' % str(e))
+            return []
+        events = []
+        pos = 0
+        while pos + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            try:
+                name = name.decode(FS_ENCODING)
+            except UnicodeDecodeError:
+                pass  # the same as os.listdir() returns for undecodable names
+            events.append((wd, mask, cookie, name))
+        return events
+
+
+class ImageWatcher(FileSystemImage):
+    """Keeps an existing image live: applies file system changes to 'FolderTree', 'Files' and 'FilesMD5'
+    instead of full rescans, the cost is proportional to the number of changes.
+    Changes come from inotify (Linux), events are collected for batchSeconds and applied in one transaction:
+    the changed entries (folder, name) are checked by stat() and compared with the image,
+    renames keep ids and checksums of files and subfolders.
+    New and modified files lose their checksums (MD5, digests, chunks) and are hashed lazily,
+    hashDelaySeconds after the last change (files being written are not hashed again and again).
+    If events are lost (the kernel queue overflow), all folders are rescanned (readdir + stat, checksums
+    of unchanged files are kept). Folders without watch (inotify is not available, the limit of watches
+    is reached) are rescanned every rescanSeconds.
+    'FolderStats' rows are deleted when the tree changes (topFolders() calculates them again on demand).
+    Changes made while the watcher is not running are found in folders with changed write time only
+    (use createImage() with a base image to find files modified in place).
+
+    Attributes:
+       inotify: Inotify or None (folders are rescanned periodically).
+       batchSeconds: Events are collected for N seconds and applied in one transaction.
+       hashDelaySeconds: Changed files are hashed N seconds after the last change.
+       hashBatchFiles: Max number of files to hash at once (events are not read while hashing).
+       rescanSeconds: Period of rescans of folders without watch.
+       folders: Dict of folders of the image (foId => (parentId, name)).
+       subdirs: Dict of subfolders (foId => dict (name => subfolder foId)).
+       wds: Dict of watches (watch descriptor => foId).
+       foWds: Dict of watches (foId => watch descriptor).
+       unwatched: Set of scanned folders without watch.
+       pendingHash: Dict of files to hash (fileId => time of the last change).
+       counters: Dict of counters ('events', 'batches', 'files-changed', ...).
+    """
+
+    def __init__(self, dbname):
+        """Inits ImageWatcher object with database file name of the image.
+        """
+        FileSystemImage.__init__(self, dbname)
+        self.dbgate.writerQueueSize = 0  # batches are small, reads follow writes
+        self.checkpointSeconds = 0
+
+        self.inotify = None
+        self.batchSeconds = 1.0
+        self.hashDelaySeconds = 10.0
+        self.hashBatchFiles = 100
+        self.rescanSeconds = 300.0
+
+        self.folders = {}
+        self.subdirs = {}
+        self.wds = {}
+        self.foWds = {}
+        self.unwatched = set()
+        self.pendingHash = {}
+        self.counters = {}
+
+        self.overflow = False
+        self.watchesFull = False
+        self.treeChanged = False
+        self.hasStats = False
+        self.stopped = False
+
+    def watch(self, seconds=0):
+        """Watches the root directory and applies changes to the image until stop() or Ctrl+C.
+
+        Args:
+            seconds: Stop after N seconds, 0 to watch until stop().
+
+        Returns:
+            True or False.
+        """
+        if not self.startWatch():
+            return False
+
+        endTime = time.time() + seconds if seconds > 0 else None
+        rescanTime = time.time()
+        try:
+            while not self.stopped and (endTime is None or time.time() < endTime):
+                timeout = 1.0 if endTime is None else max(min(1.0, endTime - time.time()), 0)
+                if self.inotify is not None:
+                    events = self.readBatch(timeout)
+                else:
+                    time.sleep(timeout)
+                    events = []
+
+                if events and not self.applyEvents(events):
+                    return False
+
+                # lost events (all folders) and folders without watch (periodically)
+                rescanIds = None
+                if self.overflow:
+                    self.dbgate.trace('watch-overflow', 'events are lost, rescan %i dirs' % len(self.folders))
+                    rescanIds = list(self.foWds.keys()) + list(self.unwatched)
+                    self.overflow = False
+                elif self.unwatched and time.time() - rescanTime >= self.rescanSeconds:
+                    rescanIds = list(self.unwatched)
+                if rescanIds is not None:
+                    rescanTime = time.time()
+                    if not self.applyRescan(rescanIds):
+                        return False
+
+                if not self.hashPending():
+                    return False
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopWatch()
+        return True
+
+    def stop(self):
+        """Stops watch() (can be called from other thread or signal handler).
+        """
+        self.stopped = True
+
+    def startWatch(self):
+        """For internal usage.
+        Loads folders of the image, adds watches, rescans folders changed since the scan.
+        """
+        if not self.openImage():
+            return False
+        if self.loadCheckpoint('scan') is not None:
+            logging.error('watch, the image has unfinished scan, use resume()')
+            return False
+        if not self.loadScanParams():
+            return False
+        self.initHashAlgorithms()
+
+        q = self.dbgate.query("select max(foId), (select max(fileId) from Files),"
+                              " exists (select 1 from FolderStats) from FolderTree")
+        if not q or q[0][0] is None:
+            logging.error('watch, the image has no folders')
+            return False
+        self.nextFoId = q[0][0] + 1
+        self.nextFileId = (q[0][1] or 0) + 1
+        self.hasStats = bool(q[0][2])
+
+        rows = self.dbgate.query("select foId, parentId, name, scanTime, mtime from FolderTree")
+        if rows is None:
+            return False
+        for foId, parentId, name, scanTime, mtime in rows:
+            self.folders[foId] = (parentId, name)
+            if parentId is not None:
+                self.subdirs.setdefault(parentId, {})[name] = foId
+
+        if self.metrics is not None:
+            self.metrics.start('watch')
+            self.dbgate.metrics = self.metrics
+
+        self.inotify = Inotify()
+        if not self.inotify.open():
+            self.inotify = None
+
+        self.dbgate.trace('watch-start', 'root=[%s], dirs=%i, inotify=%s' %
+                          (self.rootDir, len(self.folders), 'yes' if self.inotify is not None else 'no'))
+
+        # the watch is added before the check, so no change is missed
+        changed = []
+        for foId, parentId, name, scanTime, mtime in rows:
+            if scanTime is None:
+                continue  # ignored folder (or listdir() failed)
+            self.addWatch(foId)
+            try:
+                st = os.stat(self.fullPath(foId))
+            except OSError:
+                st = None
+            if st is None or fileTimesNs(st)[1] != mtime:
+                changed.append(foId)
+
+        # the rescan of folders changed while the watcher was not running
+        if not self.applyRescan(changed):
+            return False
+        self.dbgate.trace('watch-ready', 'watched=%i, unwatched=%i, changed-dirs=%i' %
+                          (len(self.foWds), len(self.unwatched), len(changed)))
+        return True
+
+    def stopWatch(self):
+        """For internal usage.
+        """
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.dbgate.trace('watch-stop', ', '.join(['%s=%i' % item for item in sorted(self.counters.items())]))
+        self.dbgate.flushTrace()
+
+    def readBatch(self, timeout):
+        """For internal usage.
+        Waits up to timeout seconds for events, then reads events for batchSeconds.
+        """
+        events = self.inotify.readEvents(timeout)
+        if not events:
+            return events
+        endTime = time.time() + self.batchSeconds
+        while time.time() < endTime:
+            events.extend(self.inotify.readEvents(endTime - time.time()))
+        return events
+
+    def applyEvents(self, events):
+        """For internal usage.
+        Applies the batch of events in one transaction: renames first, then the changed entries are checked.
+        """
+        self.count('events', len(events))
+        self.count('batches')
+        if not self.dbgate.beginBulk():
+            return False
+        try:
+            entries = set()  # (foId, name)
+            moves = {}  # cookie => (foId, name) of IN_MOVED_FROM
+            for wd, mask, cookie, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    self.overflow = True
+                    continue
+                foId = self.wds.get(wd)
+                if foId is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # the folder is deleted (its parent has the event) or unmounted
+                    del self.wds[wd]
+                    if self.foWds.get(foId) == wd:
+                        del self.foWds[foId]
+                    continue
+                if not name:
+                    continue
+                if mask & IN_MOVED_FROM:
+                    moves[cookie] = (foId, name)
+                elif mask & IN_MOVED_TO and cookie in moves:
+                    self.moveEntry(moves.pop(cookie), (foId, name), mask & IN_ISDIR)
+                entries.add((foId, name))
+
+            for foId, name in sorted(entries):
+                if foId in self.folders:
+                    self.checkEntry(foId, name)
+            for foId in set([foId for foId, name in entries]):
+                if foId in self.folders:
+                    self.saveFolderTimes(foId)
+
+            self.dropFolderStats()
+            return self.dbgate.endBulk()
+        except sqlite3.Error, e:  # a buffered write failed (see GateSQLite.bulkFailed)
+            logging.exception(e.args[0])
+            self.dbgate.rollbackBulk()
+            return False
+        except Exception:
+            self.dbgate.rollbackBulk()
+            raise
+
+    def applyRescan(self, foIds):
+        """For internal usage.
+        Rescans the folders in one transaction.
+        """
+        if not foIds:
+            return True
+        if not self.dbgate.beginBulk():
+            return False
+        try:
+            self.rescanFolders(foIds)
+            self.dropFolderStats()
+            return self.dbgate.endBulk()
+        except sqlite3.Error, e:  # a buffered write failed (see GateSQLite.bulkFailed)
+            logging.exception(e.args[0])
+            self.dbgate.rollbackBulk()
+            return False
+        except Exception:
+            self.dbgate.rollbackBulk()
+            raise
+
+    def moveEntry(self, src, dst, isDir):
+        """For internal usage.
+        Moves the file or the subfolder (with its subtree) in the image (ids and checksums are kept).
+        """
+        srcId, srcName = src
+        dstId, dstName = dst
+        if dstId not in self.folders:
+            return
+        if isDir:
+            childId = self.subdirs.get(srcId, {}).get(srcName)
+            if childId is None or self.excludeMatcher.match(normpathEx(self.fullPath(dstId) + dstName)) is not None:
+                return  # the entries are checked as deleted/created
+            oldId = self.subdirs.get(dstId, {}).get(dstName)
+            if oldId is not None:
+                self.deleteFolder(oldId)  # the replaced empty folder
+            del self.subdirs[srcId][srcName]
+            self.subdirs.setdefault(dstId, {})[dstName] = childId
+            self.folders[childId] = (dstId, dstName)
+            self.dbgate.bulk("update FolderTree set parentId = ?, name = ? where foId = ?", (dstId, dstName, childId))
+        else:
+            rows = self.queryFiles(srcId, srcName)
+            if not rows:
+                return
+            self.deleteFiles([row[0] for row in self.queryFiles(dstId, dstName)])  # the replaced file
+            self.dbgate.bulk("update Files set foId = ?, fname = ? where fileId = ?", (dstId, dstName, rows[0][0]))
+        self.count('moved')
+        self.treeChanged = True
+
+    def checkEntry(self, foId, name):
+        """For internal usage.
+        Compares the folder entry with the image and updates the image.
+        """
+        curDir = self.fullPath(foId)
+        dirs, files, dirLinks = listNames(curDir, [name], skipMissing=True)
+        rows = self.queryFiles(foId, name)
+
+        childId = self.subdirs.get(foId, {}).get(name)
+        if dirs:
+            if childId is None:
+                newId = self.addFolder(foId, dirs[0])
+                if newId is not None:
+                    self.rescanFolders([newId])
+        elif childId is not None:
+            self.deleteFolder(childId)
+
+        if files:
+            self.updateFile(foId, curDir, files[0], rows[0] if rows else None)
+            rows = rows[1:]
+        self.deleteFiles([row[0] for row in rows])
+
+    def rescanFolders(self, foIds):
+        """For internal usage.
+        Rescans the folders (not recursive, but new subfolders are scanned).
+        """
+        stack = list(foIds)
+        while stack:
+            foId = stack.pop()
+            if foId in self.folders:
+                stack.extend(self.rescanFolder(foId))
+
+    def rescanFolder(self, foId):
+        """For internal usage.
+        Lists the folder and compares it with the image.
+
+        Returns:
+            List of new subfolders to scan.
+        """
+        curDir = self.fullPath(foId)
+        try:
+            dirs, files, dirLinks = listDir(curDir)
+        except OSError, e:
+            if e.errno != errno.ENOENT:  # deleted folders are removed by events of the parent
+                self.dbgate.trace('error', 'listdir() failed for path "%s", %s' % (curDir, e.strerror))
+            return []
+        self.count('dirs-rescanned')
+
+        rows = dict((row[1], row) for row in self.dbgate.iterQuery(
+            "select fileId, fname, fsize, wtime, ino from Files where foId = ?", (foId,)))
+        for entry in files:
+            self.updateFile(foId, curDir, entry, rows.pop(entry.name, None))
+        self.deleteFiles([row[0] for row in rows.values()])
+
+        newIds = []
+        subdirs = dict(self.subdirs.get(foId, {}))
+        for entry in dirs:
+            if subdirs.pop(entry.name, None) is None:
+                newId = self.addFolder(foId, entry)
+                if newId is not None:
+                    newIds.append(newId)
+        for childId in subdirs.values():
+            self.deleteFolder(childId)
+
+        self.saveFolderTimes(foId)
+        return newIds
+
+    def addFolder(self, parentId, entry):
+        """For internal usage.
+        Adds the subfolder to the image (it's scanned by rescanFolder()).
+
+        Returns:
+            Folder id or None (the folder is ignored).
+        """
+        foId = self.nextFoId
+        self.nextFoId += 1
+        self.folders[foId] = (parentId, entry.name)
+        self.subdirs.setdefault(parentId, {})[entry.name] = foId
+        self.dbgate.bulk("insert into FolderTree (foId, parentId, name, scanTime, mtime) values (?, ?, ?, ?, ?)",
+                         (foId, parentId, entry.name, None, fileTimesNs(entry.st)[1]))
+        self.count('dirs-added')
+        self.treeChanged = True
+
+        dirFull = normpathEx(self.fullPath(parentId) + entry.name)
+        if self.excludeMatcher.match(dirFull) is not None:
+            self.dbgate.trace('dir-ignored', '[%s]' % dirFull)
+            return None
+        self.addWatch(foId)
+        return foId
+
+    def deleteFolder(self, foId):
+        """For internal usage.
+        Deletes the subfolder with its subtree from the image.
+        """
+        subtree = [foId]
+        for childId in subtree:
+            subtree.extend(self.subdirs.get(childId, {}).values())
+
+        for childId in subtree:
+            self.deleteFiles([row[0] for row in self.dbgate.iterQuery("select fileId from Files where foId = ?",
+                                                                      (childId,))])
+            self.dbgate.bulk("delete from FolderTree where foId = ?", (childId,))
+            wd = self.foWds.pop(childId, None)
+            if wd is not None:
+                self.inotify.rmWatch(wd)  # moved out of the tree (the watch of a deleted folder is removed already)
+            self.unwatched.discard(childId)
+            self.subdirs.pop(childId, None)
+
+        parentId, name = self.folders[foId]
+        self.subdirs.get(parentId, {}).pop(name, None)
+        for childId in subtree:
+            del self.folders[childId]
+        self.count('dirs-deleted', len(subtree))
+        self.treeChanged = True
+
+    def updateFile(self, foId, curDir, entry, row):
+        """For internal usage.
+        Adds the file or updates it (if size, write time or inode is changed), the checksums are calculated later.
+
+        Args:
+            row: The file in the image (fileId, fname, fsize, wtime, ino) or None.
+        """
+        fsize = ino = 0
+        if entry.st is not None:
+            fsize = entry.st.st_size
+            ino = entry.st.st_ino
+        ctime, wtime = fileTimesNs(entry.st)
+
+        oldKey = None
+        if row is None:
+            if not self.addFiles(foId, curDir, [entry]):
+                return
+            fileId = self.nextFileId - 1
+            self.count('files-added')
+        elif (row[2], row[3], row[4]) != (fsize, wtime, ino):
+            fileId = row[0]
+            oldKey = self.queryLinkKey(fileId)
+            self.dbgate.bulk("update Files set fsize = ?, ctime = ?, wtime = ?, ino = ? where fileId = ?",
+                             (fsize, ctime, wtime, ino, fileId))
+            self.deleteChecksums(fileId)
+            self.dbgate.bulk("delete from FileLinks where fileId = ?", (fileId,))
+            if entry.st is not None and getattr(entry.st, 'st_nlink', 1) > 1 and ino:
+                self.dbgate.bulk("insert or replace into FileLinks (fileId, dev, nlink) values (?, ?, ?)",
+                                 (fileId, entry.st.st_dev, entry.st.st_nlink))
+            self.count('files-changed')
+        else:
+            return
+
+        # number of links of other links of the inode (the new link is added, the old inode lost the link)
+        if entry.st is not None and getattr(entry.st, 'st_nlink', 1) > 1 and ino:
+            self.refreshLinks((entry.st.st_dev, ino), fileId)
+        if oldKey is not None and oldKey != (getattr(entry.st, 'st_dev', None), ino):
+            self.refreshLinks(oldKey, fileId)
+        if entry.st is not None:
+            self.pendingHash[fileId] = time.time()
+        self.treeChanged = True
+
+    def deleteFiles(self, fileIds):
+        """For internal usage.
+        """
+        keys = set()  # inodes which lost a link
+        for fileId in fileIds:
+            key = self.queryLinkKey(fileId)
+            if key is not None:
+                keys.add(key)
+        for fileId in fileIds:
+            self.deleteChecksums(fileId)
+            self.dbgate.bulk("delete from FileLinks where fileId = ?", (fileId,))
+            self.dbgate.bulk("delete from Files where fileId = ?", (fileId,))
+            self.pendingHash.pop(fileId, None)
+        if fileIds:
+            self.count('files-deleted', len(fileIds))
+            self.treeChanged = True
+        for key in sorted(keys):
+            self.refreshLinks(key)
+
+    def queryLinkKey(self, fileId):
+        """For internal usage.
+
+        Returns:
+            Tuple (dev, inode) of the file with hard links or None.
+        """
+        for dev, ino in self.dbgate.iterQuery("select fl.dev, ff.ino from FileLinks fl join Files ff"
+                                              " on ff.fileId = fl.fileId where fl.fileId = ?", (fileId,)):
+            return dev, ino
+        return None
+
+    def refreshLinks(self, key, skipFileId=None):
+        """For internal usage.
+        Updates the number of links in 'FileLinks' for other links of the inode (calcMD5forFiles() groups links by it),
+        the rows of files with one link left are deleted. The links are checked by stat() (the path could be
+        replaced by other file, it has its own event then).
+        """
+        dev, ino = key
+        rows = list(self.dbgate.iterQuery("select ff.fileId, ff.foId, ff.fname from Files ff join FileLinks fl"
+                                          " on fl.fileId = ff.fileId where ff.ino = ? and fl.dev = ?", (ino, dev)))
+        for fileId, foId, fname in rows:
+            if fileId == skipFileId or foId not in self.folders:
+                continue
+            try:
+                st = os.stat(self.fullPath(foId) + fname)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) != (dev, ino):
+                continue
+            if st.st_nlink > 1:
+                self.dbgate.bulk("update FileLinks set nlink = ? where fileId = ?", (st.st_nlink, fileId))
+            else:
+                self.dbgate.bulk("delete from FileLinks where fileId = ?", (fileId,))
+            self.count('links-updated')
+
+    def deleteChecksums(self, fileId):
+        """For internal usage.
+        """
+        for tableName in ['FilesMD5', 'FilesDigests', 'FileChunks']:
+            self.dbgate.bulk("delete from %s where fileId = ?" % tableName, (fileId,))
+
+    def saveFolderTimes(self, foId):
+        """For internal usage.
+        Updates scan time and write time of the folder (the listing in the image is up to date).
+        """
+        try:
+            mtime = fileTimesNs(os.stat(self.fullPath(foId)))[1]
+        except OSError:
+            return
+        self.dbgate.bulk("update FolderTree set scanTime = ?, mtime = ? where foId = ?", (nowNs(), mtime, foId))
+
+    def dropFolderStats(self):
+        """For internal usage.
+        Deletes recursive totals if the tree is changed (see topFolders()), in order with the other writes of the batch
+        (if the batch fails, the watch stops, so hasStats is not restored).
+        """
+        if self.treeChanged and self.hasStats:
+            self.dbgate.bulk("delete from FolderStats", ())
+            self.hasStats = False
+        self.treeChanged = False
+
+    def addWatch(self, foId):
+        """For internal usage.
+        """
+        if self.inotify is None:
+            self.unwatched.add(foId)
+            return
+        path_ = self.fullPath(foId)
+        wd, err = self.inotify.addWatch(path_)
+        if wd < 0:
+            if err == errno.ENOSPC:
+                if not self.watchesFull:
+                    self.dbgate.trace('warning', 'inotify watches limit is reached (fs.inotify.max_user_watches), '
+                                                 'other folders are rescanned every %is' % self.rescanSeconds)
+                    self.watchesFull = True
+            elif err != errno.ENOENT:
+                self.dbgate.trace('warning', 'inotify_add_watch() failed for path "%s", %s' %
+                                  (path_, os.strerror(err)))
+            self.unwatched.add(foId)
+            return
+        self.wds[wd] = foId
+        self.foWds[foId] = wd
+        self.unwatched.discard(foId)
+
+    def hashPending(self):
+        """For internal usage.
+        Calculates checksums of files which are not changed for hashDelaySeconds.
+        """
+        now = time.time()
+        due = [fileId for fileId, changeTime in self.pendingHash.items() if now - changeTime >= self.hashDelaySeconds]
+        if not due:
+            return True
+        due = sorted(due)[:self.hashBatchFiles]
+        for fileId in due:
+            del self.pendingHash[fileId]
+
+        rows = []
+        for fileId in due:
+            for row in self.dbgate.iterQuery("select ff.fileId, ff.fsize, ff.fname, ff.foId, ff.ino, fl.dev, fl.nlink"
+                                             " from Files ff left join FileLinks fl on fl.fileId = ff.fileId"
+                                             " where ff.fileId = ?", (fileId,)):
+                if row[3] in self.folders:
+                    rows.append((row[0], row[1], row[2], self.folderPath(row[3]), None, 0, row[4], 0, row[5], row[6]))
+
+        if not self.dbgate.beginBulk():
+            return False
+        try:
+            state = {'addOnly': False, 'startTime': nowNs(), 'counters': [0, 0, 0]}
+            self.calcMD5forRows(rows, len(self.hashAlgorithms) - 1, state)
+            self.count('files-hashed', len(rows))
+            return self.dbgate.endBulk()
+        except Exception:
+            self.dbgate.rollbackBulk()
+            raise
+
+    def queryFiles(self, foId, fname):
+        """For internal usage.
+
+        Returns:
+            List of (fileId, fname, fsize, wtime, ino).
+        """
+        return list(self.dbgate.iterQuery("select fileId, fname, fsize, wtime, ino from Files"
+                                          " where foId = ? and fname = ?", (foId, fname)))
+
+    def folderPath(self, foId):
+        """Gets relative path of the folder ('/a/b/').
+        """
+        names = []
+        parentId, name = self.folders[foId]
+        while parentId is not None:
+            names.append(name)
+            parentId, name = self.folders[parentId]
+        return '/' + ''.join([part + '/' for part in reversed(names)])
+
+    def fullPath(self, foId):
+        """Gets full path of the folder (with trailing '/').
+        """
+        return normpathEx(self.rootDir + self.folderPath(foId))
+
+    def count(self, name, n=1):
+        """For internal usage.
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self.metrics is not None:
+            self.metrics.add(name, n)
+
+
+def test_ImageWatcher():
+    """Simple test.
+    """
+    initLogs(u"test_ImageWatcher.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    watcher = ImageWatcher('test_FileSystemImage.sqlite')
+    watcher.hashDelaySeconds = 2.0
+    watcher.watch(seconds=30)
+    logging.info(str(watcher.counters))
+
+
+def test_ImageWatcherLinks():
+    """Simple test: hard links are added, deleted and a linked file is changed while the watcher is not running,
+    the rescan at start keeps 'FileLinks' (with the actual number of links) and checksums of all the links.
+    """
+    initLogs(u"test_ImageWatcher.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    tempDir = normpathEx(tempfile.mkdtemp())
+    rootDir = tempDir + 'root/'
+    os.makedirs(rootDir + 'a/')
+    with open(rootDir + 'a/old.txt', 'w') as f:
+        f.write('old')
+    os.link(rootDir + 'a/old.txt', rootDir + 'a/old-link.txt')
+    os.link(rootDir + 'a/old.txt', rootDir + 'a/old-link2.txt')
+    with open(rootDir + 'a/lost.txt', 'w') as f:
+        f.write('lost')
+    os.link(rootDir + 'a/lost.txt', rootDir + 'a/lost-link.txt')
+    dbname = tempDir + 'test.sqlite'
+    image = FileSystemImage(dbname)
+    image.createImage({'RootDirWin32': rootDir, 'RootDirLinux': rootDir, 'StorageName': u'TEST'})
+    image.calcMD5forFiles("fname like '%'", False)
+
+    time.sleep(0.01)
+    with open(rootDir + 'a/new.txt', 'w') as f:
+        f.write('new')
+    os.link(rootDir + 'a/new.txt', rootDir + 'a/new-link.txt')
+    os.link(rootDir + 'a/new.txt', rootDir + 'a/new-link2.txt')
+    with open(rootDir + 'a/old.txt', 'a') as f:
+        f.write(' and changed')
+    os.remove(rootDir + 'a/old-link2.txt')
+    os.remove(rootDir + 'a/lost-link.txt')
+
+    watcher = ImageWatcher(dbname)
+    watcher.hashDelaySeconds = 0.0
+    ok = watcher.watch(seconds=1)
+    rows = watcher.dbgate.query("select ff.fname, fl.nlink, hex(md.md5) from Files ff"
+                                " left join FileLinks fl on fl.fileId = ff.fileId"
+                                " left join FilesMD5 md on md.fileId = ff.fileId order by ff.fname")
+    expected = [(fname, nlink, calcFileMD5(rootDir + 'a/' + fname))
+                for fname, nlink in [('lost.txt', None), ('new-link.txt', 3), ('new-link2.txt', 3), ('new.txt', 3),
+                                     ('old-link.txt', 2), ('old.txt', 2)]]
+    logging.info('watch=%s, files=%s => %s' % (str(ok), str(rows), 'OK' if ok and rows == expected else 'FAILED'))
+    watcher.dbgate.close()
+    shutil.rmtree(tempDir)
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_ImageWatcher()
+    test_ImageWatcherLinks()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    IoThrottle.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import time
+import threading
+from helpers import initLogs
+
+
+class IoThrottle:
+    """I/O budget for scans on busy servers (set FileSystemImage.throttle, it is None by default).
+    Token buckets limit bytes/s and operations/s (open, read, listdir, stat), a burst of 'burstSeconds' is allowed.
+    The number of concurrent I/O jobs (files hashed, folders listed) is limited by 'workers':
+    in adaptive mode it is halved when the average read latency is above 'targetLatency'
+    and increased by one when the latency is below the half of it (the device is idle), up to 'maxWorkers'.
+    All methods are thread-safe (they are called by worker threads).
+
+    Attributes:
+       bytesPerSec: Bytes per second (0 for no limit).
+       opsPerSec: Operations per second (0 for no limit).
+       burstSeconds: Tokens are accumulated for N seconds at most.
+       maxWorkers: Max number of concurrent I/O jobs (the pools of threads are not larger than it anyway).
+       minWorkers: Min number of concurrent I/O jobs (adaptive mode).
+       workers: The current limit of concurrent I/O jobs.
+       adaptive: If True, 'workers' follows the read latency.
+       targetLatency: Max average latency of one operation (seconds), adaptive mode.
+       adjustSeconds: Period of 'workers' adjustments.
+       waitSeconds: Total time of waits for tokens (for all threads).
+    """
+
+    def __init__(self, bytesPerSec=0, opsPerSec=0, maxWorkers=4, adaptive=False, targetLatency=0.05):
+        """Inits IoThrottle object with limits.
+        """
+        self.bytesPerSec = bytesPerSec
+        self.opsPerSec = opsPerSec
+        self.burstSeconds = 1.0
+        self.maxWorkers = maxWorkers
+        self.minWorkers = 1
+        self.workers = maxWorkers
+        self.adaptive = adaptive
+        self.targetLatency = targetLatency
+        self.adjustSeconds = 2.0
+        self.waitSeconds = 0.0
+
+        self.cond = threading.Condition()
+        self.active = 0  # I/O jobs in progress
+        self.byteTokens = bytesPerSec * self.burstSeconds
+        self.opTokens = opsPerSec * self.burstSeconds
+        self.refillTime = time.time()
+        self.adjustTime = self.refillTime
+        self.nSamples = 0
+        self.sumLatency = 0.0
+
+    def acquire(self, nbytes=0, ops=1):
+        """Takes tokens for I/O (waits if the budget is spent).
+        Tokens can go below zero, the caller waits for the debt, so big reads are not starved by small ones.
+        """
+        if not self.bytesPerSec and not self.opsPerSec:
+            return
+        with self.cond:
+            now = time.time()
+            dt = now - self.refillTime
+            self.refillTime = now
+            wait = 0.0
+            if self.bytesPerSec:
+                self.byteTokens = min(self.byteTokens + dt * self.bytesPerSec, self.bytesPerSec * self.burstSeconds)
+                self.byteTokens -= nbytes
+                wait = max(wait, -self.byteTokens / float(self.bytesPerSec))
+            if self.opsPerSec:
+                self.opTokens = min(self.opTokens + dt * self.opsPerSec, self.opsPerSec * self.burstSeconds)
+                self.opTokens -= ops
+                wait = max(wait, -self.opTokens / float(self.opsPerSec))
+            self.waitSeconds += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def enter(self):
+        """Starts I/O job (waits while 'workers' jobs are in progress).
+        """
+        with self.cond:
+            while self.active >= max(self.workers, 1):
+                self.cond.wait()
+            self.active += 1
+
+    def leave(self):
+        """Finishes I/O job.
+        """
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def observe(self, seconds):
+        """Adds latency of one operation (read, stat), adjusts 'workers' in adaptive mode.
+        """
+        if not self.adaptive:
+            return
+        with self.cond:
+            self.nSamples += 1
+            self.sumLatency += seconds
+            now = time.time()
+            if now - self.adjustTime < self.adjustSeconds:
+                return
+            latency = self.sumLatency / self.nSamples
+            workers = self.workers
+            if latency > self.targetLatency:
+                workers = max(self.workers // 2, self.minWorkers)
+            elif latency < self.targetLatency / 2:
+                workers = min(self.workers + 1, self.maxWorkers)
+            if workers != self.workers:
+                logging.debug('io throttle, latency = %.1fms, workers %i => %i' % (latency * 1000, self.workers, workers))
+                self.workers = workers
+                self.cond.notify_all()
+            self.adjustTime = now
+            self.nSamples = 0
+            self.sumLatency = 0.0
+
+    def run(self, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) as one I/O job (see enter()).
+
+        Returns:
+            The result of func.
+        """
+        self.enter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.leave()
+
+    def getStats(self):
+        """Gets the state for traces.
+
+        Returns:
+            String.
+        """
+        return 'workers=%i, waited=%.1fs, limits=%iB/s,%iops/s' % (self.workers, self.waitSeconds,
+                                                                   self.bytesPerSec, self.opsPerSec)
+
+
+def test_IoThrottle():
+    """Simple test.
+    """
+    initLogs(u"test_IoThrottle.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    throttle = IoThrottle(bytesPerSec=10 * 1024 * 1024, opsPerSec=100)
+    time1 = time.time()
+    for i in xrange(20):
+        throttle.acquire(1024 * 1024)
+    logging.info('20MB at 10MB/s in %.1fs, %s' % (time.time() - time1, throttle.getStats()))
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_IoThrottle()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    PathMatcher.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import re
+import fnmatch
+from helpers import initLogs
+
+
+class PathMatcher:
+    """Matches folder paths with the list of exclude rules (see 'ExcludePath%' scan parameters).
+    The rules are compiled once, a path is checked by tries of path segments, by dicts of name suffixes/prefixes
+    (for 'glob:*.ext', 'glob:name*', 'glob:name') and by one combined regex for other patterns.
+    The cost of the check does not grow with the number of rules, except for regexes
+    (the combined regex is slower with every alternative, so prefer other rules for long lists).
+
+    Rules (compared in lower case, '\\' is the same as '/'):
+       '/.svn/', '/a/b/'   - folders anywhere in the path (substring of the full path, as before),
+       'root:/build/'      - the path relative to the root directory begins with it,
+       'glob:*.egg-info'   - shell pattern for the folder name (pattern without '/'),
+       'glob:/*/cache/'    - shell pattern for the path relative to the root directory ('*' matches '/' too),
+       're:/tmp[0-9]+/'    - regular expression to search in the full path,
+       any other text      - substring of the full path (as before).
+
+    Attributes:
+       rootDir: The root directory (see normpathEx()).
+       rules: The list of rules.
+       hits: The list of hit counters (one for every rule).
+    """
+
+    def __init__(self, rootDir='/', rules=()):
+        """Inits PathMatcher object with the root directory and the list of rules.
+        """
+        self.rootDir = rootDir.replace('\\', '/').lower()
+        self.rules = []
+        self.hits = []
+
+        self.segTrie = {}   # reversed segments of '/a/b/' rules, '' key => rule index
+        self.rootTrie = {}  # segments of 'root:/a/b/' rules, '' key => rule index
+        self.globNames = {}  # kind ('name', 'suffix', 'prefix') => dict (length => dict (text => rule index))
+        self.regexes = {'name': [], 'rel': [], 'full': []}  # checked string => list of (rule index, regex)
+        self.combined = {}  # checked string => combined regex of all rules (None if they can not be combined)
+
+        for rule in rules:
+            self.addRule(rule)
+
+    def addRule(self, rule):
+        """Adds the rule (see the list of rules above).
+
+        Returns:
+            True or False (bad regular expression).
+        """
+        index = len(self.rules)
+        if rule.startswith('re:'):
+            target, pattern = 'full', rule[3:]
+        elif rule.startswith('glob:'):
+            rule = rule.replace('\\', '/').lower()
+            target = 'rel' if '/' in rule[5:] else 'name'
+            pattern = '^(?:%s)' % fnmatch.translate(rule[5:])
+            if target == 'name' and self.addGlobName(rule[5:], index):
+                target = None
+        else:
+            rule = rule.replace('\\', '/').lower()
+            anchored = rule.startswith('root:')
+            path_ = rule[5:] if anchored else rule
+            segs = path_.split('/')
+            if len(segs) > 2 and segs[0] == '' and segs[-1] == '' and all(segs[1:-1]):
+                self.addToTrie(self.rootTrie if anchored else self.segTrie,
+                               segs[1:-1] if anchored else reversed(segs[1:-1]), index)
+                target, pattern = None, None
+            else:
+                target, pattern = ('rel', '^' + re.escape(path_)) if anchored else ('full', re.escape(path_))
+
+        if target is not None:
+            try:
+                self.regexes[target].append((index, re.compile(pattern, re.IGNORECASE)))
+            except re.error, e:
+                logging.error('bad exclude rule "%s", %s' % (rule, str(e)))
+                return False
+            self.combined.pop(target, None)
+
+        self.rules.append(rule)
+        self.hits.append(0)
+        return True
+
+    def addGlobName(self, glob, index):
+        """For internal usage.
+        Adds simple name pattern ('*.ext', 'name*' or 'name') to dicts of names.
+
+        Returns:
+            True or False (if the pattern is not simple).
+        """
+        text = glob.strip('*')
+        if not text or '*' in text or '?' in text or '[' in text or glob.count('*') > 1:
+            return False
+        kind = 'suffix' if glob.startswith('*') else 'prefix' if glob.endswith('*') else 'name'
+        self.globNames.setdefault(kind, {}).setdefault(len(text), {}).setdefault(text, index)
+        return True
+
+    def addToTrie(self, trie, segs, index):
+        """For internal usage.
+        """
+        node = trie
+        for seg in segs:
+            node = node.setdefault(seg, {})
+        node.setdefault('', index)  # the first rule wins for duplicates
+
+    def match(self, path_):
+        """Checks the folder path, increments hit counter of the matched rule.
+
+        Args:
+            path_: Full path of the folder with trailing '/' (see normpathEx()).
+
+        Returns:
+            The matched rule (one of them if several rules match) or None.
+        """
+        full = path_.replace('\\', '/').lower()
+        rel = full[len(self.rootDir) - 1:] if full.startswith(self.rootDir) else None
+        parts = full.split('/')[1:-1]  # path segments enclosed by '/'
+
+        index = self.matchSegments(parts)
+        if index < 0 and rel is not None:
+            index = self.matchRootSegments(rel.split('/')[1:-1])
+        if index < 0 and self.globNames and parts:
+            index = self.matchGlobNames(parts[-1])
+        if index < 0:
+            index = self.matchRegexes({'name': parts[-1] if parts else '', 'rel': rel, 'full': full})
+        if index < 0:
+            return None
+
+        self.hits[index] += 1
+        return self.rules[index]
+
+    def matchSegments(self, parts):
+        """For internal usage.
+        """
+        for end in xrange(len(parts) - 1, -1, -1):
+            node = self.segTrie
+            for i in xrange(end, -1, -1):
+                node = node.get(parts[i])
+                if node is None:
+                    break
+                if '' in node:
+                    return node['']
+        return -1
+
+    def matchRootSegments(self, parts):
+        """For internal usage.
+        """
+        node = self.rootTrie
+        for part in parts:
+            node = node.get(part)
+            if node is None:
+                break
+            if '' in node:
+                return node['']
+        return -1
+
+    def matchGlobNames(self, name):
+        """For internal usage.
+        """
+        for kind, byLength in self.globNames.items():
+            for length, texts in byLength.items():
+                if length > len(name):
+                    continue
+                text = name if kind == 'name' else name[-length:] if kind == 'suffix' else name[:length]
+                index = texts.get(text, -1)
+                if index >= 0:
+                    return index
+        return -1
+
+    def matchRegexes(self, strings):
+        """For internal usage.
+        The combined regex rejects most of paths, the rules are checked one by one for the matched paths only.
+        """
+        for target in ['name', 'rel', 'full']:
+            regexes = self.regexes[target]
+            s = strings[target]
+            if not regexes or s is None:
+                continue
+            if target not in self.combined:
+                self.combined[target] = self.combineRegexes(regexes)
+            combined = self.combined[target]
+            if combined is not None and not combined.search(s):
+                continue
+            for index, regex in regexes:
+                if regex.search(s):
+                    return index
+        return -1
+
+    def combineRegexes(self, regexes):
+        """For internal usage.
+
+        Returns:
+            Compiled regex or None (if the rules can not be combined, for example, too many groups).
+        """
+        try:
+            return re.compile('|'.join(['(?:%s)' % regex.pattern for index, regex in regexes]), re.IGNORECASE)
+        except (re.error, AssertionError, OverflowError, RuntimeError), e:
+            logging.debug('exclude rules are checked one by one, %s' % str(e))
+            return None
+
+    def getHits(self):
+        """Gets hit counters.
+
+        Returns:
+            List of (rule, hits) in order of rules.
+        """
+        return zip(self.rules, self.hits)
+
+
+def test_PathMatcher():
+    """Simple test.
+    """
+    initLogs(u"test_PathMatcher.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    matcher = PathMatcher(u'/media/DATA/', [u'/.svn/', u'\\RECYCLER\\', u'root:/list-files/', u'glob:*.egg-info',
+                                            u're:/tmp[0-9]+/', u'cache'])
+    for path_ in [u'/media/DATA/src/.svn/', u'/media/DATA/RECYCLER/', u'/media/DATA/list-files/',
+                  u'/media/DATA/src/list-files/', u'/media/DATA/src/x.egg-info/', u'/media/DATA/tmp12/',
+                  u'/media/DATA/.cache/', u'/media/DATA/src/']:
+        logging.info('%s => %s' % (path_, matcher.match(path_)))
+    logging.info(str(matcher.getHits()))
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_PathMatcher()
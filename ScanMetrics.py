@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    ScanMetrics.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import os
+import time
+import json
+import threading
+from helpers import initLogs
+
+
+MB = 1024 * 1024  # MB/s figures are in mebibytes per second
+
+
+class Histogram:
+    """Latency histogram with power of 2 buckets (in microseconds).
+
+    Attributes:
+       count: Number of values.
+       total: Sum of values (seconds).
+       maxValue: Max value (seconds).
+       buckets: Dict (k => number of values in [2^(k-1), 2^k) microseconds).
+    """
+
+    def __init__(self):
+        """Inits empty Histogram object.
+        """
+        self.count = 0
+        self.total = 0.0
+        self.maxValue = 0.0
+        self.buckets = {}
+
+    def add(self, seconds):
+        """Adds one value.
+        """
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maxValue:
+            self.maxValue = seconds
+        k = int(seconds * 1000000).bit_length()
+        self.buckets[k] = self.buckets.get(k, 0) + 1
+
+    def percentile(self, p):
+        """Estimates percentile (upper bound of the bucket).
+
+        Returns:
+            Seconds.
+        """
+        if not self.count:
+            return 0.0
+        n = 0
+        for k in sorted(self.buckets.keys()):
+            n += self.buckets[k]
+            if n >= self.count * p / 100.0:
+                return min((2 ** k) / 1000000.0, self.maxValue)
+        return self.maxValue
+
+    def snapshot(self):
+        """Gets summary of the histogram.
+
+        Returns:
+            Dict with count, sum, average, p50/p90/p99, max (in milliseconds) and buckets.
+        """
+        ms = 1000.0
+        return {'count': self.count, 'sumMs': round(self.total * ms, 3),
+                'avgMs': round(self.total * ms / self.count, 3) if self.count else 0.0,
+                'p50Ms': round(self.percentile(50) * ms, 3), 'p90Ms': round(self.percentile(90) * ms, 3),
+                'p99Ms': round(self.percentile(99) * ms, 3), 'maxMs': round(self.maxValue * ms, 3),
+                'bucketsUs': dict(('<%i' % (2 ** k), n) for k, n in self.buckets.items())}
+
+
+class ScanMetrics:
+    """Counters, gauges and latency histograms for FileSystemImage.createImage() and calcMD5forFiles().
+    Set FileSystemImage.metrics to collect them (it is None by default, so there is no overhead).
+    Histograms: 'list-dir' (readdir + stat of a folder), 'stat-dir' (stat only, folder reused from the base image),
+    'hash' (checksums of a file), 'db-write' (executemany of buffered rows), 'db-commit'.
+    Counters: 'dirs', 'files', 'bytes', ... Gauges: 'dirs-to-visit', 'hash-queue', ...
+    A snapshot (dict) has rates (files/s, MB/s) and ETA (if totals are known),
+    it is passed to onProgress and saved to snapshotFile periodically.
+
+    Attributes:
+       onProgress: Function to call with snapshot every progressSeconds, or None.
+       progressSeconds: Period of onProgress calls.
+       snapshotFile: JSON file to save snapshot to every snapshotSeconds (and at the end of phase), or ''.
+       snapshotSeconds: Period of snapshot saves.
+    """
+
+    def __init__(self, snapshotFile='', onProgress=None, progressSeconds=5.0, snapshotSeconds=30.0):
+        """Inits ScanMetrics object with JSON file name for snapshots and progress callback.
+        """
+        self.onProgress = onProgress
+        self.progressSeconds = progressSeconds
+        self.snapshotFile = snapshotFile
+        self.snapshotSeconds = snapshotSeconds
+
+        self.lock = threading.Lock()  # histograms are updated by worker threads
+        self.start('')
+
+    def start(self, phase, totals=None):
+        """Starts the phase of work (all counters are reset).
+
+        Args:
+            phase: Name of the phase ('create-image', 'calc-md5').
+            totals: Dict of expected counter values for ETA ('files', 'bytes', 'dirs'), or None.
+        """
+        self.phase = phase
+        self.totals = dict(totals or {})
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.startTime = time.time()
+        self.progressTime = self.snapshotTime = self.startTime
+
+    def add(self, name, n=1):
+        """Increments the counter (in the main thread).
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        """Sets the gauge (in the main thread).
+        """
+        self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        """Adds latency to the histogram (thread-safe).
+        """
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.add(seconds)
+
+    def timed(self, name, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) and adds its latency to the histogram (thread-safe).
+
+        Returns:
+            The result of func.
+        """
+        time1 = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.observe(name, time.time() - time1)
+
+    def tick(self):
+        """Calls onProgress and saves snapshot if it's time (call it often from the main thread, it's cheap).
+        """
+        now = time.time()
+        if self.onProgress is not None and now - self.progressTime >= self.progressSeconds:
+            self.progressTime = now
+            self.onProgress(self.snapshot())
+        if self.snapshotFile and now - self.snapshotTime >= self.snapshotSeconds:
+            self.snapshotTime = now
+            self.saveSnapshot()
+
+    def finish(self):
+        """Finishes the phase: calls onProgress and saves the final snapshot.
+        """
+        snapshot = self.snapshot()
+        snapshot['done'] = True
+        if self.onProgress is not None:
+            self.onProgress(snapshot)
+        if self.snapshotFile:
+            self.saveSnapshot(snapshot)
+
+    def snapshot(self):
+        """Gets current values of metrics.
+
+        Returns:
+            Dict (phase, elapsed seconds, counters, gauges, rates, ETA, histograms).
+        """
+        elapsed = time.time() - self.startTime
+        with self.lock:
+            histograms = dict((name, hist.snapshot()) for name, hist in self.histograms.items())
+        rates = {}
+        if elapsed > 0:
+            for name in ['dirs', 'files']:
+                if name in self.counters:
+                    rates[name + 'PerSec'] = round(self.counters[name] / elapsed, 1)
+            if 'bytes' in self.counters:
+                rates['MBps'] = round(self.counters['bytes'] / float(MB) / elapsed, 2)
+
+        # ETA by bytes, files or dirs (the first known total)
+        eta = None
+        for name in ['bytes', 'files', 'dirs']:
+            done = self.counters.get(name, 0)
+            if self.totals.get(name) and done > 0:
+                eta = round(max(self.totals[name] - done, 0) * elapsed / done, 1)
+                break
+
+        return {'phase': self.phase, 'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'elapsed': round(elapsed, 3),
+                'counters': dict(self.counters), 'totals': dict(self.totals), 'gauges': dict(self.gauges),
+                'rates': rates, 'etaSeconds': eta, 'histograms': histograms}
+
+    def saveSnapshot(self, snapshot=None):
+        """Saves snapshot to snapshotFile (replaces the file atomically).
+
+        Returns:
+            True or False.
+        """
+        tmpName = self.snapshotFile + '.tmp'
+        try:
+            with open(tmpName, 'w') as f:
+                json.dump(snapshot or self.snapshot(), f, indent=2, sort_keys=True)
+            if os.name == 'nt' and os.path.exists(self.snapshotFile):
+                os.remove(self.snapshotFile)  # rename() does not replace files on Windows
+            os.rename(tmpName, self.snapshotFile)
+            return True
+        except (IOError, OSError), e:
+            logging.error('save metrics to "%s" failed, %s' % (self.snapshotFile, str(e)))
+            return False
+
+
+def formatProgress(snapshot):
+    """Formats snapshot as one line for logs/console (can be used as onProgress with logging).
+
+    Returns:
+        String.
+    """
+    counters = snapshot['counters']
+    rates = snapshot['rates']
+    text = '%s: dirs=%i, files=%i, %.1f files/s' % (snapshot['phase'], counters.get('dirs', 0),
+                                                     counters.get('files', 0), rates.get('filesPerSec', 0.0))
+    if 'MBps' in rates:
+        text += ', %.2f MB/s' % rates['MBps']
+    if snapshot['etaSeconds'] is not None:
+        text += ', ETA %is' % snapshot['etaSeconds']
+    return text
+
+
+def test_ScanMetrics():
+    """Simple test.
+    """
+    initLogs(u"test_ScanMetrics.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    metrics = ScanMetrics('test_ScanMetrics.json', lambda s: logging.info(formatProgress(s)), progressSeconds=0.0)
+    metrics.start('test', {'files': 10})
+    for i in xrange(5):
+        metrics.add('files')
+        metrics.add('bytes', 1024 * 1024)
+        metrics.timed('hash', time.sleep, 0.01)
+        metrics.tick()
+    metrics.finish()
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_ScanMetrics()
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    ScanOrchestrator.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import sys
+import os
+import glob
+import time
+import json
+import Queue
+import multiprocessing
+from datetime import datetime
+from helpers import initLogs, getPhysicalDevice
+from FileSystemImage import FileSystemImage, isScanFinished
+from IoThrottle import IoThrottle
+
+
+class ScanOrchestrator:
+    """Scans several storages by the config file (JSON, see doScan.json), every scan in its own process:
+    createImage() or resume() (if the image of today exists), then calcMD5forFiles().
+    Scans of one physical device run one by one ('deviceLimit' at a time), so two scans do not thrash one disk,
+    scans of different devices run at the same time: the run takes the time of the slowest device.
+    The device of a scan is found by its root directory (helpers.getPhysicalDevice()), 'device' of the scan overrides
+    it (LVM, RAID, network shares). Every scan writes its own log, the combined summary is saved to 'summaryFile'.
+
+    Config keys:
+       saveDirWin32, saveDirLinux: Folder for images, logs and summary.
+       incremental: If True, the latest previous image of the scan is used as a base image (see createImage()).
+       md5Where: A filter for calcMD5forFiles() ('' to skip MD5 calculation).
+       deviceLimit: Max number of scans of one device at a time.
+       maxProcesses: Max number of scans at a time.
+       image: Dict of FileSystemImage attributes (hashWorkers, hashOrder, digests, ...).
+       throttle: Dict of IoThrottle arguments (bytesPerSec, opsPerSec, adaptive, ...) or null.
+       summaryFile: JSON file name for the summary (in saveDir).
+       scans: List of scans: name ('xxx-%date%.sqlite'), params (see createImage()), enabled, and optional device,
+          md5Where, image, throttle (override the config keys above).
+
+    Attributes:
+       configFile: The config file name.
+       config: Dict of the config.
+       saveDir: Folder for images, logs and summary.
+       jobs: List of scans to run (dicts with resolved dbname, baseDbname, device, logFile),
+          the scans which can not be started have 'error' (they are failed jobs of the summary).
+       summary: Dict of the last run (see run()).
+    """
+
+    def __init__(self, configFile):
+        """Inits ScanOrchestrator object with the config file name.
+        """
+        self.configFile = configFile
+        self.config = {}
+        self.saveDir = ''
+        self.jobs = []
+        self.summary = None
+
+    def loadConfig(self):
+        """Loads the config and prepares the list of jobs.
+
+        Returns:
+            True or False.
+        """
+        try:
+            with open(self.configFile) as f:
+                self.config = json.load(f)
+        except (IOError, ValueError), e:
+            logging.error('load config "%s" failed, %s' % (self.configFile, str(e)))
+            return False
+
+        self.saveDir = self.config['saveDirWin32' if sys.platform == "win32" else 'saveDirLinux']
+        if not os.path.exists(self.saveDir):
+            os.mkdir(self.saveDir)
+
+        today = datetime.now().strftime("%Y.%m.%d")
+        self.jobs = []
+        for scan in self.config.get('scans', []):
+            if not scan.get('enabled', True):
+                continue
+            name = scan['name']
+            params = scan['params']
+            dbname = self.saveDir + name.replace('%date%', today)
+            rootDir = params['RootDirWin32' if sys.platform == "win32" else 'RootDirLinux']
+            device = scan.get('device') or getPhysicalDevice(rootDir)
+            error = ''
+            if not os.path.exists(rootDir):
+                logging.error('scan "%s", root directory "%s" not found' % (name, rootDir))
+                error = 'root directory not found'
+            image = dict(self.config.get('image') or {})
+            image.update(scan.get('image') or {})
+            self.jobs.append({'name': name, 'params': params, 'dbname': dbname, 'device': device,
+                              'baseDbname': findBaseImage(self.saveDir, name, dbname)
+                              if self.config.get('incremental', True) else None,
+                              'md5Where': scan.get('md5Where', self.config.get('md5Where', "fname like '%'")),
+                              'image': image, 'throttle': scan.get('throttle', self.config.get('throttle')),
+                              'logFile': os.path.splitext(dbname)[0] + '.log', 'error': error})
+        return True
+
+    def run(self):
+        """Runs the jobs: starts a process for every job as soon as its device and a process slot are free.
+
+        Returns:
+            True or False (False if any job failed).
+        """
+        deviceLimit = max(self.config.get('deviceLimit', 1), 1)
+        maxProcesses = max(self.config.get('maxProcesses', 4), 1)
+        logging.info('scan %i storages on %i devices, deviceLimit=%i, maxProcesses=%i' %
+                     (len(self.jobs), len(set(job['device'] for job in self.jobs if job['device'])), deviceLimit,
+                      maxProcesses))
+
+        time1 = time.time()
+        results = multiprocessing.Queue()
+        pending = [job for job in self.jobs if not job['error']]  # in order of the config
+        running = {}  # name => (process, job, start time, exit time)
+        busy = {}  # device => number of running jobs
+        done = dict((job['name'], makeJobSummary(job, error=job['error'])) for job in self.jobs if job['error'])
+        try:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= maxProcesses:
+                        break
+                    if busy.get(job['device'], 0) >= deviceLimit:
+                        continue
+                    proc = multiprocessing.Process(target=runScanJob, args=(job, results), name=job['name'])
+                    proc.start()
+                    pending.remove(job)
+                    running[job['name']] = [proc, job, time.time(), None]
+                    busy[job['device']] = busy.get(job['device'], 0) + 1
+                    logging.info('job "%s" started, device=%s, pid=%i' % (job['name'], job['device'], proc.pid))
+
+                try:
+                    result = results.get(timeout=0.2)
+                    done[result['name']] = result
+                except Queue.Empty:
+                    pass
+
+                # the job is finished when its summary is received and the process is gone
+                for name, item in running.items():
+                    proc, job, startTime = item[0], item[1], item[2]
+                    if proc.is_alive():
+                        continue
+                    if name not in done:
+                        item[3] = item[3] or time.time()
+                        if time.time() - item[3] < 5.0:
+                            continue  # the summary can be late
+                        done[name] = makeJobSummary(job, error='process exit code %s' % str(proc.exitcode))
+                        done[name]['seconds'] = round(time.time() - startTime, 3)
+                    proc.join()
+                    del running[name]
+                    busy[job['device']] -= 1
+                    result = done[name]
+                    logging.info('job "%s" %s in %.1fs, files=%i, %.1fMB, md5=%i%s' %
+                                 (name, 'done' if result['ok'] else 'FAILED', result['seconds'], result['files'],
+                                  result['bytes'] / 1048576.0, result['md5'],
+                                  ', ' + result['error'] if result['error'] else ''))
+        except KeyboardInterrupt:
+            logging.error('interrupted, the images can be continued by the next run (resume)')
+            for proc, job, startTime, exitTime in running.values():
+                proc.terminate()
+                proc.join()
+                done.setdefault(job['name'], makeJobSummary(job, error='interrupted'))
+            for job in pending:
+                done[job['name']] = makeJobSummary(job, error='not started')
+
+        elapsed = time.time() - time1
+        jobs = [done[job['name']] for job in self.jobs if job['name'] in done]
+        self.summary = {'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'configFile': self.configFile,
+                        'elapsed': round(elapsed, 3), 'sumOfJobs': round(sum(job['seconds'] for job in jobs), 3),
+                        'ok': len(jobs) == len(self.jobs) and all(job['ok'] for job in jobs), 'jobs': jobs}
+        logging.info('scan done in %.1fs (%.1fs one by one), jobs=%i, failed=%i, files=%i, %.1fMB' %
+                     (elapsed, self.summary['sumOfJobs'], len(jobs), len([job for job in jobs if not job['ok']]),
+                      sum(job['files'] for job in jobs), sum(job['bytes'] for job in jobs) / 1048576.0))
+        self.saveSummary()
+        return self.summary['ok']
+
+    def saveSummary(self):
+        """Saves the summary to 'summaryFile' (in saveDir).
+
+        Returns:
+            True or False.
+        """
+        fileName = self.saveDir + self.config.get('summaryFile', 'doScan-summary.json')
+        try:
+            with open(fileName, 'w') as f:
+                json.dump(self.summary, f, indent=2, sort_keys=True)
+            return True
+        except (IOError, OSError), e:
+            logging.error('save summary to "%s" failed, %s' % (fileName, str(e)))
+            return False
+
+
+def findBaseImage(saveDir, name, dbname):
+    """Finds the latest previous image for incremental scan (images with unfinished scan are skipped).
+
+    Returns:
+        Database file name or None.
+    """
+    found = [f.replace('\\', '/') for f in glob.glob(saveDir + name.replace('%date%', '*'))]
+    found = [f for f in found if f < dbname]  # %date% is "%Y.%m.%d"
+    found = [f for f in found if isScanFinished(f)]  # a crashed scan misses files of reused folders
+    return max(found) if found else None
+
+
+def makeJobSummary(job, error=''):
+    """For internal usage.
+    """
+    return {'name': job['name'], 'dbname': job['dbname'], 'device': job['device'], 'ok': False, 'error': error,
+            'seconds': 0.0, 'scanSeconds': 0.0, 'md5Seconds': 0.0, 'dirs': 0, 'files': 0, 'bytes': 0, 'md5': 0}
+
+
+def newImage(job):
+    """For internal usage.
+    Creates FileSystemImage with attributes of the job.
+    """
+    image = FileSystemImage(job['dbname'])
+    for name, value in job['image'].items():
+        if not hasattr(image, name):
+            raise ValueError('FileSystemImage has no attribute "%s"' % name)
+        setattr(image, name, value)
+    if job['throttle']:
+        image.throttle = IoThrottle(**job['throttle'])
+    return image
+
+
+def runScanJob(job, results):
+    """Runs one job in the child process, puts its summary to results queue.
+    """
+    root = logging.getLogger("")
+    for handler in list(root.handlers):  # inherited from the parent process (fork)
+        root.removeHandler(handler)
+    initLogs(job['logFile'], fileAppend=True, fileLevel=logging.INFO, consoleLevel=logging.WARNING)
+
+    summary = makeJobSummary(job)
+    time1 = time.time()
+    try:
+        image = newImage(job)
+        if os.path.exists(job['dbname']):
+            ok = image.resume()  # continue the interrupted scan from the last checkpoint
+        else:
+            ok = image.createImage(job['params'], job['baseDbname'])
+        time2 = time.time()
+        summary['scanSeconds'] = round(time2 - time1, 3)
+
+        if ok and job['md5Where']:
+            image = newImage(job)
+            ok = image.calcMD5forFiles(job['md5Where'], True)
+            summary['md5Seconds'] = round(time.time() - time2, 3)
+
+        q = image.dbgate.query("select (select count(1) from FolderTree), count(1), coalesce(sum(fsize), 0),"
+                               " (select count(1) from FilesMD5) from Files")
+        if q:
+            summary['dirs'], summary['files'], summary['bytes'], summary['md5'] = q[0]
+        summary['ok'] = bool(ok)
+        if not ok:
+            summary['error'] = 'see "%s"' % job['logFile']
+    except Exception, e:
+        logging.exception(str(e))
+        summary['error'] = str(e)
+    summary['seconds'] = round(time.time() - time1, 3)
+    results.put(summary)
+
+
+def test_ScanOrchestrator():
+    """Simple test.
+    """
+    initLogs(u"test_ScanOrchestrator.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    config = {'saveDirWin32': 'test_ScanOrchestrator/', 'saveDirLinux': 'test_ScanOrchestrator/',
+              'incremental': True, 'deviceLimit': 1, 'maxProcesses': 4,
+              'scans': [{'name': 'test%i-%%date%%.sqlite' % i, 'device': 'disk%i' % (i % 2),
+                         'params': {'StorageName': 'test', 'RootDirWin32': '.', 'RootDirLinux': '.'}}
+                        for i in xrange(3)]}
+    with open('test_ScanOrchestrator.json', 'w') as f:
+        json.dump(config, f, indent=2)
+    orchestrator = ScanOrchestrator('test_ScanOrchestrator.json')
+    if orchestrator.loadConfig():
+        orchestrator.run()
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_ScanOrchestrator()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    SnapshotDiff.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import os
+import sqlite3
+from helpers import initLogs
+from GateSQLite import GateSQLite
+from ImageSchema import SCHEMA_VERSION, getSchemaVersion
+
+
+NS = 1000000000  # nanoseconds in second
+
+
+class SnapshotDiff:
+    """Compares two SQLite images (created by FileSystemImage.createImage()) of the same root directory.
+    Both images are read as streams sorted by (folder path, file name) and merge-joined,
+    so memory usage does not depend on the number of files.
+    File changes: 'added', 'removed', 'resized', 'touched' (write time changed), 'content-changed' (MD5 changed).
+    Folder rollups: number of changed files of every kind and the size delta for files of the folder.
+    Table 'Changes' contains the list of changed files (change, path, file name, old/new size, old/new write time).
+    Table 'FolderChanges' contains folder rollups (path, added, removed, resized, touched, content-changed, size delta).
+
+    Attributes:
+       oldGate: GateSQLite connection to the old image.
+       newGate: GateSQLite connection to the new image.
+       onFolderDone: Function to call with (path, rollup) for every folder with changed files, or None.
+          Rollup is a dict (change => number of files, 'bytes' => size delta).
+    """
+
+    CHANGES = ['added', 'removed', 'resized', 'touched', 'content-changed']
+
+    def __init__(self, oldDbname, newDbname):
+        """Inits SnapshotDiff object with database file names of the old and the new images.
+        """
+        self.oldGate = GateSQLite(oldDbname)
+        self.newGate = GateSQLite(newDbname)
+        self.onFolderDone = None
+
+    def open(self):
+        """Opens both images.
+
+        Returns:
+            True or False.
+        """
+        for gate in [self.oldGate, self.newGate]:
+            if not os.path.exists(gate.dbname):
+                logging.error('image "%s" not found' % gate.dbname)
+                return False
+            if gate.con is None and not gate.open():
+                return False
+            version = getSchemaVersion(gate)
+            if version != SCHEMA_VERSION:
+                logging.error('image "%s" has schema version %s, use ImageSchema.migrateImage()' %
+                              (gate.dbname, str(version)))
+                return False
+        return True
+
+    def iterFiles(self, gate):
+        """For internal usage.
+
+        Yields:
+            Tuple (sort key, (path, fname, fsize, wtime, md5)).
+        """
+        q = gate.iterQuery("select fo.path, ff.fname, ff.fsize, ff.wtime, hex(md.md5) "
+                           " from Files ff join Folders fo on ff.foId = fo.foId "
+                           " left join FilesMD5 md on md.fileId = ff.fileId "
+                           " order by fo.path, ff.fname")
+        for row in q:
+            # sqlite compares text as utf-8 bytes (BINARY collation), so do the same
+            yield (row[0].encode('utf-8'), row[1].encode('utf-8')), row
+
+    def compareFiles(self, oldRow, newRow):
+        """For internal usage.
+
+        Returns:
+            Change name or None (if the file is not changed).
+        """
+        if oldRow[2] != newRow[2]:
+            return 'resized'
+        if oldRow[4] and newRow[4] and oldRow[4] != newRow[4]:
+            return 'content-changed'
+        if oldRow[3] != newRow[3]:
+            # images migrated from schema version 1 have whole seconds only
+            if oldRow[3] // NS != newRow[3] // NS or (oldRow[3] % NS and newRow[3] % NS):
+                return 'touched'
+        return None
+
+    def iterChanges(self):
+        """Compares files of the images (folder rollups are passed to onFolderDone).
+
+        Yields:
+            Tuple (change, old row or None, new row or None), row is (path, fname, fsize, wtime, md5).
+
+        Raises:
+            sqlite3.Error: If some query failed.
+        """
+        oldIt = self.iterFiles(self.oldGate)
+        newIt = self.iterFiles(self.newGate)
+        old = next(oldIt, None)
+        new = next(newIt, None)
+
+        curPath = None
+        rollup = None
+
+        while old is not None or new is not None:
+            if new is None or (old is not None and old[0] < new[0]):
+                change, oldRow, newRow = 'removed', old[1], None
+                old = next(oldIt, None)
+            elif old is None or new[0] < old[0]:
+                change, oldRow, newRow = 'added', None, new[1]
+                new = next(newIt, None)
+            else:
+                oldRow, newRow = old[1], new[1]
+                change = self.compareFiles(oldRow, newRow)
+                old = next(oldIt, None)
+                new = next(newIt, None)
+
+            # folder rollup (files of the same folder go one by one)
+            path_ = (oldRow or newRow)[0]
+            if path_ != curPath:
+                self.folderDone(curPath, rollup)
+                curPath = path_
+                rollup = None
+            if change is None:
+                continue
+            if rollup is None:
+                rollup = dict((name, 0) for name in self.CHANGES)
+                rollup['bytes'] = 0
+            rollup[change] += 1
+            rollup['bytes'] += (newRow[2] if newRow else 0) - (oldRow[2] if oldRow else 0)
+
+            yield change, oldRow, newRow
+
+        self.folderDone(curPath, rollup)
+
+    def folderDone(self, path_, rollup):
+        """For internal usage.
+        """
+        if rollup is not None and self.onFolderDone is not None:
+            self.onFolderDone(path_, rollup)
+
+    def saveChanges(self, dbname):
+        """Compares the images and saves changes to 'Changes' and 'FolderChanges' tables (previous rows are deleted).
+
+        Args:
+            dbname: Database file name for results (not the old or the new image, they are being read).
+
+        Returns:
+            True or False.
+        """
+        if not self.open():
+            return False
+        if os.path.abspath(dbname) in [os.path.abspath(self.oldGate.dbname), os.path.abspath(self.newGate.dbname)]:
+            logging.error('diff results can not be saved to the image "%s"' % dbname)
+            return False
+
+        dbgate = GateSQLite(dbname)
+        dbgate.needTables(['Changes', 'FolderChanges'])
+        dbgate.defineTable('Changes', 'change text, path text, fname text, '
+                                      'oldSize integer, newSize integer, oldWtime integer, newWtime integer')
+        dbgate.defineTable('FolderChanges', 'path text, added integer, removed integer, resized integer, '
+                                            'touched integer, changed integer, bytes integer')
+        if not dbgate.openConn():
+            return False
+        if dbgate.query("delete from Changes") is None or dbgate.query("delete from FolderChanges") is None:
+            return False
+
+        dbgate.trace('diff-start', 'old=[%s], new=[%s]' % (self.oldGate.dbname, self.newGate.dbname))
+
+        def saveRollup(path_, rollup):
+            dbgate.bulk("insert into FolderChanges (path, added, removed, resized, touched, changed, bytes) "
+                        " values (?, ?, ?, ?, ?, ?, ?)",
+                        (path_, rollup['added'], rollup['removed'], rollup['resized'], rollup['touched'],
+                         rollup['content-changed'], rollup['bytes']))
+
+        counts = dict((name, 0) for name in self.CHANGES)
+        onFolderDone = self.onFolderDone
+        self.onFolderDone = saveRollup
+
+        if not dbgate.beginBulk():
+            return False
+        try:
+            for change, oldRow, newRow in self.iterChanges():
+                counts[change] += 1
+                row = newRow or oldRow
+                dbgate.bulk("insert into Changes (change, path, fname, oldSize, newSize, oldWtime, newWtime) "
+                            " values (?, ?, ?, ?, ?, ?, ?)",
+                            (change, row[0], row[1], oldRow[2] if oldRow else None, newRow[2] if newRow else None,
+                             oldRow[3] if oldRow else None, newRow[3] if newRow else None))
+        except sqlite3.Error, e:
+            logging.exception(e.args[0])
+            dbgate.trace('error', 'diff failed')
+            return False
+        finally:
+            self.onFolderDone = onFolderDone
+            dbgate.endBulk()
+
+        dbgate.trace('diff-done', ', '.join(['%s=%i' % (name, counts[name]) for name in self.CHANGES]))
+
+        return True
+
+
+def test_SnapshotDiff():
+    """Simple test.
+    """
+    initLogs(u"test_SnapshotDiff.log", fileAppend=False, fileLevel=logging.DEBUG, consoleLevel=logging.INFO)
+
+    SnapshotDiff('test_FileSystemImage.sqlite', 'test_FileSystemImage.sqlite').saveChanges('test_SnapshotDiff.sqlite')
+
+
+if __name__ == '__main__':
+    """Run Simple test.
+    """
+    test_SnapshotDiff()
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+    File:    doBenchmark.py
+    Author:  Daniil Dolbilov
+    Created: 17-Oct-2026
+"""
+
+import logging
+import sys
+import os
+import platform
+import subprocess
+import random
+import shutil
+import json
+import argparse
+from timeit import default_timer
+from datetime import datetime
+from helpers import initLogs, normpathEx, calcFileDigests
+from GateSQLite import GateSQLite
+from DirWalker import listDir, listNames
+from PathMatcher import PathMatcher
+from FileSystemImage import FileSystemImage
+from ImageSchema import IMAGE_OBJECTS, defineImageTables
+
+
+MB = 1024 * 1024  # MB/s figures are in mebibytes per second
+
+
+def makeTree(top, depth=3, fanout=4, files=20, maxSize=256 * 1024, seed=1, longNames=True, unicodeNames=True):
+    """Creates a synthetic directory tree for benchmarks (the same tree for the same parameters).
+    File sizes have log-uniform distribution (many small files, some large ones).
+
+    Args:
+        top: The root directory (it is deleted and created again).
+        depth: Number of folder levels below the root.
+        fanout: Number of subfolders in every folder.
+        files: Number of files in every folder.
+        maxSize: Max file size in bytes.
+        seed: Seed for random sizes and names.
+        longNames: Make some names close to 255 bytes.
+        unicodeNames: Make some names with non-ASCII characters.
+
+    Returns:
+        Tuple (number of folders, number of files, total size in bytes).
+    """
+    rnd = random.Random(seed)
+    try:
+        u'-файл-文件'.encode(sys.getfilesystemencoding() or 'ascii')
+    except UnicodeError:
+        logging.warning('file system encoding is %s, unicode names are not used' % sys.getfilesystemencoding())
+        unicodeNames = False
+    if os.path.exists(top):
+        shutil.rmtree(top)
+    os.makedirs(top)
+
+    def makeName(prefix, i):
+        name = u'%s%04i' % (prefix, i)
+        if longNames and i % 17 == 0:
+            name += u'-' + u'x' * (200 - len(name))
+        if unicodeNames and i % 5 == 0:
+            name += u'-файл-文件'
+        return name
+
+    nDirs = nFiles = nBytes = 0
+    chunk = ''.join(chr(rnd.randint(0, 255)) for i in xrange(64 * 1024))
+    stack = [(top, 0)]
+    while stack:
+        curDir, level = stack.pop()
+        nDirs += 1
+        for i in xrange(files):
+            size = int(2 ** rnd.uniform(0, max(maxSize, 2).bit_length() - 1)) - 1
+            with open(os.path.join(curDir, makeName(u'file', i) + u'.bin'), 'wb') as f:
+                left = size
+                while left > 0:
+                    f.write(chunk[:left])
+                    left -= len(chunk)
+            nFiles += 1
+            nBytes += size
+        if level < depth:
+            for i in xrange(fanout):
+                subDir = os.path.join(curDir, makeName(u'dir', i))
+                os.mkdir(subDir)
+                stack.append((subDir, level + 1))
+    return nDirs, nFiles, nBytes
+
+
+class Benchmark:
+    """Times the phases of scan separately on the synthetic tree:
+    traversal (readdir), stat, exclude matching, SQLite insert, SQLite commit, hashing,
+    and the whole FileSystemImage.createImage() and calcMD5forFiles().
+    Every phase runs 'repeat' times, the best and the median times are saved.
+
+    Attributes:
+       top: The root directory of the tree.
+       workDir: Directory for temporary databases.
+       repeat: Number of runs for every phase.
+       nRules: Number of exclude rules for the exclude matching phase.
+       results: Dict (phase => dict of results).
+    """
+
+    def __init__(self, top, workDir, repeat=3, nRules=200):
+        """Inits Benchmark object with the tree root and directory for temporary databases.
+        """
+        self.top = normpathEx(top)
+        self.workDir = workDir
+        self.repeat = repeat
+        self.nRules = nRules
+        self.results = {}
+
+        self.dirs = []  # full paths of folders
+        self.names = {}  # folder => list of entry names
+        self.fileNames = []  # full paths of files
+
+    def timePhase(self, name, func, items=0, bytes_=0):
+        """For internal usage.
+        Runs func() 'repeat' times, saves the best and the median times.
+        """
+        times = []
+        for i in xrange(self.repeat):
+            time1 = default_timer()
+            func()
+            times.append(default_timer() - time1)
+        times.sort()
+        best = times[0]
+        res = {'best': round(best, 6), 'median': round(times[len(times) // 2], 6), 'runs': len(times), 'items': items}
+        if items and best > 0:
+            res['itemsPerSec'] = round(items / best, 1)
+        if bytes_:
+            res['bytes'] = bytes_
+            res['MBps'] = round(bytes_ / float(MB) / best, 2) if best > 0 else 0
+        self.results[name] = res
+        logging.info('%-16s best=%.4fs median=%.4fs items=%i%s' %
+                     (name, best, res['median'], items, ', %.2fMB/s' % res['MBps'] if bytes_ else ''))
+
+    def runAll(self):
+        """Runs all phases.
+
+        Returns:
+            Dict (phase => dict of results).
+        """
+        self.phaseTraversal()
+        self.phaseStat()
+        self.phaseListDir()
+        self.phaseExclude()
+        self.phaseInsert()
+        self.phaseHash()
+        self.phaseImage()
+        return self.results
+
+    def phaseTraversal(self):
+        """Readdir only (os.listdir() of every folder, no stat).
+        """
+        def walk():
+            self.dirs = []
+            self.names = {}
+            stack = [self.top]
+            while stack:
+                curDir = stack.pop()
+                names = os.listdir(curDir)
+                self.dirs.append(curDir)
+                self.names[curDir] = names
+                # folders of the synthetic tree are named 'dir...' (no stat needed)
+                stack.extend(os.path.join(curDir, name) for name in names if name.startswith(u'dir'))
+        walk()
+        nEntries = sum(len(names) for names in self.names.values())
+        self.timePhase('traversal', walk, nEntries)
+
+    def phaseStat(self):
+        """One stat() per entry of known folders (see DirWalker.listNames()).
+        """
+        def statAll():
+            self.fileNames = []
+            for curDir in self.dirs:
+                dirs, files, dirLinks = listNames(curDir, self.names[curDir])
+                self.fileNames.extend(os.path.join(curDir, entry.name) for entry in files)
+        statAll()
+        self.timePhase('stat', statAll, sum(len(names) for names in self.names.values()))
+
+    def phaseListDir(self):
+        """Readdir + stat as the scanner does it (see DirWalker.listDir()).
+        """
+        def listAll():
+            for curDir in self.dirs:
+                listDir(curDir)
+        self.timePhase('listdir+stat', listAll, sum(len(names) for names in self.names.values()))
+
+    def phaseExclude(self):
+        """Exclude matching of every folder path (10 times) with nRules rules (none of them matches):
+        50% of '/name/' rules, 40% of 'glob:*.ext' rules, 10% of 're:' rules.
+        """
+        nGlobs = self.nRules * 4 // 10
+        nRegexes = self.nRules // 10
+        rules = [u'/rule%i/' % i for i in xrange(self.nRules - nGlobs - nRegexes)] + \
+                [u'glob:*.skip%i' % i for i in xrange(nGlobs)] + \
+                [u're:/tmp%i[0-9]+/' % i for i in xrange(nRegexes)]
+        matcher = PathMatcher(self.top, rules)
+        paths = [normpathEx(curDir) for curDir in self.dirs] * 10
+
+        def matchAll():
+            for path_ in paths:
+                matcher.match(path_)
+        self.timePhase('exclude-match', matchAll, len(paths))
+
+    def phaseInsert(self):
+        """SQLite insert of file rows (bulk mode, one transaction) and commit of them, timed separately.
+        """
+        dbname = os.path.join(self.workDir, 'bench-insert.sqlite')
+        rows = [(i + 1, i // 20 + 1, u'file%08i.bin' % i, i * 7, i, i, i) for i in xrange(max(len(self.fileNames), 1) * 20)]
+        commits = []
+
+        def insertAll():
+            if os.path.exists(dbname):
+                os.remove(dbname)
+            dbgate = GateSQLite(dbname)
+            dbgate.needTables(list(IMAGE_OBJECTS))
+            defineImageTables(dbgate)
+            dbgate.openConn()
+            dbgate.commitRows = len(rows) + 1  # no commits inside
+            dbgate.beginBulk()
+            for row in rows:
+                dbgate.bulk("insert into Files (fileId, foId, fname, fsize, ctime, wtime, ino) "
+                            " values (?, ?, ?, ?, ?, ?, ?)", row)
+            dbgate.flushBulk()
+            time1 = default_timer()
+            dbgate.endBulk()
+            commits.append(default_timer() - time1)
+            dbgate.close()
+        self.timePhase('sqlite-insert', insertAll, len(rows))
+        commits.sort()
+        self.results['sqlite-commit'] = {'best': round(commits[0], 6), 'median': round(commits[len(commits) // 2], 6),
+                                         'runs': len(commits), 'items': len(rows)}
+        if os.path.exists(dbname):
+            os.remove(dbname)
+
+    def phaseHash(self):
+        """Hashing of all files: MD5 only and MD5 + SHA-256 in one pass.
+        """
+        nBytes = sum(os.path.getsize(fname) for fname in self.fileNames)
+        for name, algorithms in [('hash-md5', ('md5',)), ('hash-md5+sha256', ('md5', 'sha256'))]:
+            self.timePhase(name, lambda: [calcFileDigests(fname, algorithms) for fname in self.fileNames],
+                           len(self.fileNames), nBytes)
+
+    def phaseImage(self):
+        """The whole FileSystemImage.createImage() and calcMD5forFiles().
+        """
+        dbname = os.path.join(self.workDir, 'bench-image.sqlite')
+        params = {'RootDirWin32': self.top, 'RootDirLinux': self.top, 'StorageName': u'bench'}
+        nBytes = sum(os.path.getsize(fname) for fname in self.fileNames)
+
+        def createImage():
+            if os.path.exists(dbname):
+                os.remove(dbname)
+            FileSystemImage(dbname).createImage(params)
+        self.timePhase('create-image', createImage, len(self.fileNames))
+        self.timePhase('calc-md5', lambda: FileSystemImage(dbname).calcMD5forFiles("fname like '%'", False),
+                       len(self.fileNames), nBytes)
+        if os.path.exists(dbname):
+            os.remove(dbname)
+
+
+def getCodeVersion():
+    """Gets git commit of this code (to compare results of versions).
+
+    Returns:
+        Commit hash or "".
+    """
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=cwd, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+if __name__ == '__main__':
+    """Benchmark scan, hash and write paths on a synthetic tree, save results to JSON file.
+    """
+    parser = argparse.ArgumentParser(description='FileSystemScan benchmark')
+    parser.add_argument('--dir', default='bench-tree', help='directory for the synthetic tree')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--files', type=int, default=20, help='files per folder')
+    parser.add_argument('--max-size', type=int, default=256 * 1024, help='max file size in bytes')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--rules', type=int, default=200, help='number of exclude rules')
+    parser.add_argument('--keep-tree', action='store_true', help='do not create the tree again if it exists')
+    parser.add_argument('--out', default='', help='JSON file for results (default is doBenchmark-<time>.json)')
+    args = parser.parse_args()
+
+    initLogs(u"doBenchmark.log", fileAppend=False, fileLevel=logging.INFO, consoleLevel=logging.INFO)
+    logging.getLogger().setLevel(logging.INFO)
+
+    top = os.path.abspath(args.dir).decode(sys.getfilesystemencoding() or 'utf-8')
+    treeParams = {'depth': args.depth, 'fanout': args.fanout, 'files': args.files, 'maxSize': args.max_size,
+                  'seed': args.seed}
+    if not (args.keep_tree and os.path.exists(top)):
+        nDirs, nFiles, nBytes = makeTree(top, **treeParams)
+        logging.info('tree [%s], dirs=%i, files=%i, bytes=%i' % (top, nDirs, nFiles, nBytes))
+
+    bench = Benchmark(top, os.path.dirname(top), repeat=args.repeat, nRules=args.rules)
+    results = {'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'code': getCodeVersion(),
+               'python': sys.version.split()[0], 'platform': platform.platform(), 'host': platform.node(),
+               'tree': treeParams, 'repeat': args.repeat, 'rules': args.rules, 'phases': bench.runAll()}
+
+    out = args.out or 'doBenchmark-%s.json' % datetime.now().strftime("%Y.%m.%d-%H%M%S")
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logging.info('results saved to "%s"' % out)
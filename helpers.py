@@ -9,7 +9,28 @@ import logging
 import sys
 import os
 import hashlib
+import mmap
 import time
+import errno
+import struct
+import array
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl  # not available on Windows
+except ImportError:
+    fcntl = None
+
+
+# FIEMAP ioctl (Linux): struct fiemap (32 bytes) + struct fiemap_extent (56 bytes) for one extent
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQQQI12x')
+
+# lseek() whence for sparse files (os.SEEK_DATA/SEEK_HOLE since python 3.3, the values differ on other systems)
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3 if sys.platform.startswith('linux') else None)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4 if sys.platform.startswith('linux') else None)
 
 
 def initLogs(fileName, fileAppend=True, fileLevel=logging.DEBUG, consoleLevel=logging.INFO):
@@ -60,43 +81,253 @@ def calcFileMD5(fname):
     Returns:
         Hex string in uppercase with MD5 checksum of file.
     """
+    digests = calcFileDigests(fname)
+    return digests['md5'] if digests else ""
+
+
+def calcDigests(data, algorithms=('md5',)):
+    """Calculates several checksums for data (for example, checksums of empty file).
+
+    Returns:
+        Dict (algorithm => hex string in uppercase).
+    """
+    return dict((name, hashlib.new(name, str(data)).hexdigest().upper()) for name in algorithms)
+
+
+def isDigestAvailable(name):
+    """Checks that hashlib supports the algorithm (for example, 'blake2b' needs python 3.6+).
+
+    Returns:
+        True or False.
+    """
+    try:
+        hashlib.new(name)
+        return True
+    except ValueError:
+        return False
+
+
+def calcFileDigests(fname, algorithms=('md5',), chunkSize=0, mmapSize=0, onData=None, throttle=None):
+    """Calculates several checksums for file in one pass (every byte is read once).
+    The file is read by readinto() to one reusable buffer (no allocations per chunk),
+    files larger than mmapSize are mapped to memory and hashed without copying.
+    Holes of sparse files (see iterFileHoles()) are not read, they are hashed as zeros (the same checksums).
+    Note: mmap is faster for large cached files, but a file truncated while mapped kills the process (SIGBUS).
+
+    Args:
+        fname: File name.
+        algorithms: Names of hashlib algorithms ('md5', 'sha1', 'sha256', 'blake2b', ...).
+        chunkSize: Read size, default is a multiple of the file system block size (st_blksize), 1MB at least.
+        mmapSize: Files larger than mmapSize are hashed by mmap (0 to disable).
+        onData: Function to call with every chunk of data (read-only buffer, valid during the call only), or None.
+           It gets the data of the same read pass (for example, ChunkIndex.Chunker.update()).
+        throttle: IoThrottle to limit and time reads, or None (mmap is not used with it, page faults can not be timed).
+
+    Returns:
+        Dict (algorithm => hex string in uppercase) or None (if the file can not be read).
+    """
+    sums = [hashlib.new(name) for name in algorithms]
+    try:
+        if throttle is not None:
+            throttle.acquire(0, 1)
+        f = open(fname, "rb")
+        try:
+            st = os.fstat(f.fileno())
+            if chunkSize <= 0:
+                blockSize = getattr(st, 'st_blksize', 0) or 4096
+                chunkSize = max(1024 * 1024 // blockSize, 1) * blockSize
+            sparse = SEEK_DATA is not None and getattr(st, 'st_blocks', None) is not None and \
+                st.st_blocks * 512 < st.st_size
+            if 0 < mmapSize < st.st_size and throttle is None and not sparse:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in xrange(0, len(m), chunkSize):
+                        chunk = buffer(m, offset, chunkSize)  # no copy
+                        for sum_ in sums:
+                            sum_.update(chunk)
+                        if onData is not None:
+                            onData(chunk)
+                finally:
+                    m.close()
+            else:
+                buf = bytearray(chunkSize)
+                view = memoryview(buf)
+                remain = st.st_size
+                holes = iterFileHoles(fname, st.st_size) if sparse else iter([])
+                hole = next(holes, None)
+                zeros = None
+                pos = 0
+                while True:
+                    if hole is not None and pos >= hole[0]:
+                        # the hole is hashed as zeros without reading
+                        zeros = zeros or bytearray(chunkSize)
+                        end = hole[0] + hole[1]
+                        while pos < end:
+                            n = min(chunkSize, end - pos)
+                            for sum_ in sums:
+                                sum_.update(buffer(zeros, 0, n))
+                            if onData is not None:
+                                onData(buffer(zeros, 0, n))
+                            pos += n
+                            remain -= n
+                        f.seek(pos)
+                        hole = next(holes, None)
+                        continue
+                    size = chunkSize if hole is None else min(chunkSize, hole[0] - pos)
+                    if throttle is not None:
+                        throttle.acquire(max(min(size, remain), 0), 1)
+                    time1 = time.time()
+                    n = f.readinto(view[:size] if size < chunkSize else buf)
+                    if not n:
+                        break
+                    if throttle is not None:
+                        throttle.observe(time.time() - time1)
+                    pos += n
+                    remain -= n
+                    chunk = view[:n] if n < chunkSize else view
+                    for sum_ in sums:
+                        sum_.update(chunk)
+                    if onData is not None:
+                        onData(buffer(buf, 0, n))
+        finally:
+            f.close()
+    except (IOError, OSError, mmap.error, ValueError):
+        return None
+    return dict((name, sum_.hexdigest().upper()) for name, sum_ in zip(algorithms, sums))
+
+
+def iterFileHoles(fname, fsize):
+    """Finds holes of sparse file (lseek() with SEEK_DATA/SEEK_HOLE: Linux 3.1+, ext4, xfs, btrfs, tmpfs, ...).
+    File systems without support of holes report the whole file as data (no holes).
+
+    Yields:
+        Tuple (offset, length) for every hole in [0, fsize), in order of offsets.
+    """
+    if SEEK_DATA is None:
+        return
+    try:
+        fd = os.open(fname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        pos = 0
+        while pos < fsize:
+            try:
+                data = os.lseek(fd, pos, SEEK_DATA)
+            except OSError, e:
+                if e.errno != errno.ENXIO:
+                    return  # not supported
+                data = fsize  # no data after pos
+            if data > pos:
+                yield pos, min(data, fsize) - pos
+            if data >= fsize:
+                return
+            try:
+                pos = os.lseek(fd, data, SEEK_HOLE)
+            except OSError:
+                return
+    finally:
+        os.close(fd)
+
+
+def calcFilePartialMD5(fname, fsize, blockSize=64*1024):
+    """Calculates MD5 checksum for the first, the middle and the last blocks of file.
+    For small files (fsize <= 3 * blockSize) it is MD5 checksum of the whole file (the same as calcFileMD5()).
+
+    Returns:
+        Hex string in uppercase with MD5 checksum of blocks.
+    """
+    if fsize <= 3 * blockSize:
+        return calcFileMD5(fname)
     try:
         f = open(fname, "rb")
-        buf = f.read(1)  # first chunk
-        sum_ = hashlib.md5(buf)
-        while len(buf) > 0:
-            buf = f.read(1024*100)  # next chunk
-            sum_.update(buf)
+        sum_ = hashlib.md5()
+        for offset in [0, (fsize - blockSize) // 2, fsize - blockSize]:
+            f.seek(offset)
+            sum_.update(f.read(blockSize))
         f.close()
         return sum_.hexdigest().upper()
     except IOError:
         return ""
 
 
-def getFileTimes(fname, gmt=True, checkMT=True):
-    """Gets timestamps of file (creation time, modification time).
+def getFilePhysicalOffset(fname):
+    """Gets physical offset of the first extent of file on the disk (Linux FIEMAP ioctl, ext4, xfs, btrfs, ...).
+
+    Returns:
+        Offset in bytes or None (no data, not supported by the platform/filesystem, failed).
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return None
+    buf = array.array('B', [0] * (FIEMAP_HEADER.size + FIEMAP_EXTENT.size))
+    FIEMAP_HEADER.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)  # all the file, 1 extent
+    try:
+        fd = os.open(fname, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+        finally:
+            os.close(fd)
+    except (IOError, OSError):
+        return None
+    if FIEMAP_HEADER.unpack_from(buf, 0)[3] < 1:
+        return None  # empty or sparse file, inline data
+    return FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size)[1]
 
-    Args:
-        gmt: If True, return timestamps in UTC.
-        checkMT: If True, fix timestamps if creation_time > modification_time.
+
+def getPhysicalDevice(path_):
+    """Gets the name of the physical disk of the path: Linux sysfs (partitions of one disk give the same name, 'sda'),
+    the drive letter on Windows ('C:'), the device number of the file system otherwise ('8:2').
+    Note: LVM, RAID and network file systems give the name of the virtual device.
 
     Returns:
-        Tuple of two strings (creation time, modification time).
-        If failed returns ('1970-01-01 05:00:00', '1970-01-01 05:00:00').
+        String or None (the path does not exist).
     """
+    if sys.platform == "win32":
+        return os.path.splitdrive(os.path.abspath(path_))[0].upper() or None
     try:
-        fs = "%Y-%m-%d %H:%M:%S"  # datetime string format
-        os.stat_float_times(False)
-        if gmt:
-            ct = time.gmtime(os.path.getctime(fname))
-            mt = time.gmtime(os.path.getmtime(fname))
-        else:
-            ct = time.localtime(os.path.getctime(fname))
-            mt = time.localtime(os.path.getmtime(fname))
-        if checkMT:
-            # TODO(dan.dolbilov): Fix timestamps if creation_time > modification_time (creation_time is overwritten).
-            # datetime.strptime(ctime,self.dateFormat) > datetime.strptime(mtime,self.dateFormat)
-            pass  # --- if ct > mt: ct = mt
-        return time.strftime(fs, ct), time.strftime(fs, mt)
+        st = os.stat(path_)
     except OSError:
-        return '1970-01-01 05:00:00', '1970-01-01 05:00:00'
+        return None
+    major, minor = os.major(st.st_dev), os.minor(st.st_dev)
+    sysPath = '/sys/dev/block/%i:%i' % (major, minor)
+    if not os.path.exists(sysPath):
+        return '%i:%i' % (major, minor)
+    sysPath = os.path.realpath(sysPath)
+    if os.path.exists(os.path.join(sysPath, 'partition')):
+        sysPath = os.path.dirname(sysPath)  # the disk of the partition
+    return os.path.basename(sysPath)
+
+
+def imapThreaded(func, items, workers, window=0):
+    """Calls func(item) for every item in a pool of threads (results are returned in order of items).
+    Good for I/O-bound functions and for hashlib (it releases the GIL on large buffers).
+
+    Args:
+        func: Function of one argument.
+        items: Iterable of items (it is consumed lazily).
+        workers: Number of threads (if workers <= 1, calls func in the current thread).
+        window: Max number of items in progress (default is 4 * workers).
+
+    Yields:
+        Tuple (item, func(item)).
+    """
+    if workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+
+    window = window if window > 0 else 4 * workers
+    pool = ThreadPool(workers)
+    try:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.apply_async(func, (item,))))
+            if len(pending) >= window:
+                item_, res = pending.popleft()
+                yield item_, res.get()
+        while pending:
+            item_, res = pending.popleft()
+            yield item_, res.get()
+    finally:
+        pool.terminate()
+        pool.join()